@@ -164,6 +164,42 @@ class Merkle(object):
             raise ValueError('leaf hashes inconsistent with level')
         return leaf_branch + level_branch, root
 
+    def levels(self, hashes):
+        '''Return all the levels of the merkle tree of a non-empty list of
+        hashes, from the hashes themselves up to the single root.  The
+        final hash of an odd-length level is not repeated.'''
+        if not hashes:
+            raise ValueError('hashes must not be empty')
+        hash_func = self.hash_func
+        levels = [hashes]
+        while len(hashes) > 1:
+            if len(hashes) & 1:
+                hashes = hashes + hashes[-1:]
+            hashes = [hash_func(hashes[n] + hashes[n + 1])
+                      for n in range(0, len(hashes), 2)]
+            levels.append(hashes)
+        return levels
+
+    def branch_and_root_from_levels(self, levels, index, tsc_format=False):
+        '''Return a (merkle branch, merkle_root) pair for the hash at index
+        given the levels of its tree as returned by levels().'''
+        if not isinstance(index, int):
+            raise TypeError('index must be an integer')
+        if not 0 <= index < len(levels[0]):
+            raise ValueError('index out of range')
+        branch = []
+        for level in levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                branch.append(level[sibling])
+            elif tsc_format:
+                # Asterix used in place of "duplicated" hashes in TSC format
+                branch.append(b"*")
+            else:
+                branch.append(level[index])
+            index >>= 1
+        return branch, levels[-1][0]
+
 
 class MerkleCache(object):
     '''A cache to calculate merkle branches efficiently.'''
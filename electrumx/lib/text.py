@@ -1,3 +1,4 @@
+import json
 import time
 
 from electrumx.lib import util
@@ -84,3 +85,40 @@ def peers_lines(data):
                          item['try_count'],
                          item['source'][:20],
                          item['ip_addr'] or '')
+
+
+def dbstats_lines(data):
+    '''A generator returning lines for a list of database statistics.
+
+    data is the return value of rpc_dbstats().'''
+    def latency_fmt(us):
+        return '' if us is None else '{:,.1f}'.format(us)
+
+    fmt = '{:<6} {:<7} {:<6} {:>12} {:>14} {:>12} {:>10} {:>10}'
+    yield fmt.format('DB', 'Op', 'Prefix', 'Ops', 'Keys', 'KB',
+                     'p50 us', 'p99 us')
+    for name, op, prefix, ops, keys, nbytes, p50, p99 in data:
+        yield fmt.format(name, op, prefix,
+                         '{:,d}'.format(ops),
+                         '{:,d}'.format(keys),
+                         '{:,d}'.format(nbytes // 1024),
+                         latency_fmt(p50),
+                         latency_fmt(p99))
+
+
+def slowlog_lines(data):
+    '''A generator returning lines for a list of slow requests.
+
+    data is the return value of rpc_slowlog().'''
+    def ms_fmt(ms):
+        return '' if ms is None else '{:,.1f}'.format(ms)
+
+    fmt = '{:<6} {:<40} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10} {}'
+    yield fmt.format('ID', 'Method', 'Age', 'Total', 'Queue', 'Handler',
+                     'Pool', 'Daemon', 'Size', 'Params')
+    for (id_, method, params, age, total, queue, handler, pool, daemon,
+         size) in data:
+        yield fmt.format(id_, method[:40], util.formatted_time(age, sep=''),
+                         ms_fmt(total), ms_fmt(queue), ms_fmt(handler),
+                         ms_fmt(pool), ms_fmt(daemon), '{:,d}'.format(size),
+                         json.dumps(params))
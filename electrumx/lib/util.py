@@ -27,9 +27,12 @@
 '''Miscellaneous utility classes and functions.'''
 
 import array
+import contextvars
 import inspect
 import logging
+import os
 import sys
+from collections import OrderedDict
 from collections.abc import Container, Mapping
 from ipaddress import ip_address
 from struct import Struct
@@ -181,6 +184,163 @@ def increment_byte_string(bs):
     return None
 
 
+class LRUCache:
+    '''A least-recently-used cache bounded by the total estimated size in
+    bytes of its values, as returned by size_func(value).  Values larger
+    than the bound are not cached.  Keeps lookup, hit and eviction counts.
+    '''
+
+    def __init__(self, max_size, size_func):
+        self.max_size = max_size
+        self.size_func = size_func
+        self.size = 0
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self._entries = OrderedDict()    # key -> (value, size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        size = self.size_func(value)
+        if size > self.max_size:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        _, size = self._entries.pop(key)
+        self.size -= size
+
+    def get(self, key, default=None):
+        '''Return the value of key, marking it most recently used, or default.'''
+        self.lookups += 1
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self.size -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def info(self):
+        '''A one-line summary of the cache's statistics.'''
+        return (f'{self.lookups:,d} lookups {self.hits:,d} hits '
+                f'{self.lookups - self.hits:,d} misses {self.evictions:,d} evictions '
+                f'{len(self):,d} entries {self.size / 1_000_000:,.1f}/'
+                f'{self.max_size / 1_000_000:,.1f} MB')
+
+
+class Histogram:
+    '''Counts of non-negative integer values in power-of-two buckets, which
+    is cheap and good enough for percentiles.'''
+
+    __slots__ = ('count', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.buckets = [0] * 64
+
+    def record(self, value):
+        value = int(value)
+        self.count += 1
+        self.total += value
+        self.buckets[min(value.bit_length(), 63)] += 1
+
+    def percentile(self, fraction):
+        '''Return an upper bound of the given percentile, or None if no
+        values were recorded.'''
+        if not self.count:
+            return None
+        target = self.count * fraction
+        running = 0
+        for n, bucket_count in enumerate(self.buckets):
+            running += bucket_count
+            if running >= target:
+                return 1 << n
+        return None
+
+
+class RequestUsage:
+    '''Resources used serving one request: seconds of CPU time used by
+    client pool threads, bytes read from instrumented databases, and
+    seconds spent waiting for the client pool and the daemon.  These are
+    added to by add_request_usage().
+
+    The session also records when the request was received, the seconds
+    it was queued and handled for, and the bytes of its response.
+    '''
+
+    __slots__ = ('cpu_time', 'db_bytes', 'pool_time', 'daemon_time',
+                 'received', 'queue_time', 'handler_time', 'response_size')
+
+    def __init__(self, cpu_time=0.0, db_bytes=0, pool_time=0.0, daemon_time=0.0):
+        self.cpu_time = cpu_time
+        self.db_bytes = db_bytes
+        self.pool_time = pool_time
+        self.daemon_time = daemon_time
+        self.received = None
+        self.queue_time = None
+        self.handler_time = None
+        self.response_size = 0
+
+    def resources(self):
+        return (self.cpu_time, self.db_bytes, self.pool_time, self.daemon_time)
+
+    def __eq__(self, other):
+        return self.resources() == other.resources()
+
+    def add(self, other):
+        self.cpu_time += other.cpu_time
+        self.db_bytes += other.db_bytes
+        self.pool_time += other.pool_time
+        self.daemon_time += other.daemon_time
+
+    def subtract(self, other):
+        self.cpu_time -= other.cpu_time
+        self.db_bytes -= other.db_bytes
+        self.pool_time -= other.pool_time
+        self.daemon_time -= other.daemon_time
+
+    def share(self, count):
+        '''Return an equal share of the resources among count requests.'''
+        return RequestUsage(*(value / count for value in self.resources()))
+
+
+# The usage of the request being served by the current task, if any
+request_usage = contextvars.ContextVar('request_usage', default=None)
+
+
+def add_request_usage(usage):
+    '''Add usage to that of the current request, if any.'''
+    current = request_usage.get()
+    if current is not None:
+        current.add(usage)
+
+
 class LogicalFile(object):
     '''A logical binary file split across several separate files on disk.'''
 
@@ -209,6 +369,37 @@ class LogicalFile(object):
                 size -= len(part)
         return b''.join(parts)
 
+    def read_many(self, starts, size):
+        '''Return a list of the size bytes read at each offset in starts,
+        which must be ascending.  Each underlying file is opened once.'''
+        result = []
+        file_size = self.file_size
+        f = None
+        f_num = None
+        try:
+            for start in starts:
+                file_num, offset = divmod(start, file_size)
+                if offset + size > file_size:
+                    result.append(self.read(start, size))
+                    continue
+                if file_num != f_num:
+                    if f:
+                        f.close()
+                        f = None
+                    f_num = file_num
+                    try:
+                        f = open_file(self.filename_fmt.format(file_num), False)
+                    except FileNotFoundError:
+                        pass
+                if f:
+                    result.append(os.pread(f.fileno(), size, offset))
+                else:
+                    result.append(b'')
+        finally:
+            if f:
+                f.close()
+        return result
+
     def write(self, start, b):
         '''Write the bytes-like object, b, to the underlying virtual file.'''
         while b:
@@ -1882,6 +1882,8 @@ class BlockProcessor:
             assert min_h160_id == state.h160_count - len(seen_h160_ids), f'{min_h160_id}, {state.h160_count}, {seen_h160_ids}'
         state.h160_count -= len(seen_h160_ids)
 
+        # Before the tx counts and hashes change; see ReadView
+        self.db.reorg_generation += 1
         self.db.tx_counts.pop()
 
         # self.touched can include other addresses which is harmless, but remove None.
@@ -239,6 +239,8 @@ class Controller(ServerBase):
             async def wait_for_catchup():
                 await caught_up_event.wait()
                 await group.spawn(db.populate_header_merkle_cache())
+                await group.spawn(db.recount_utxos())
+                await group.spawn(db.compact_history_online())
                 await group.spawn(mempool.keep_synchronized(mempool_event))
 
             async with TaskGroup() as group:
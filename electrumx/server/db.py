@@ -10,27 +10,32 @@
 
 
 import ast
+import asyncio
 import copy
+import itertools
 import os
+import threading
 import time
 import pylru
 from array import array
-from bisect import bisect_right
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
+from functools import partial
 from typing import Optional, List, Dict
 
 import attr
-from aiorpcx import run_in_thread, sleep
+from aiorpcx import run_in_thread, sleep, TaskGroup
 
 from electrumx.lib import util
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
 from electrumx.lib.merkle import Merkle, MerkleCache
 from electrumx.lib.util import (
     formatted_time, pack_be_uint32, pack_le_uint32,
-    unpack_le_uint32, unpack_be_uint32, unpack_le_uint64, base_encode,
+    unpack_le_uint32, unpack_le_uint64, base_encode,
+    RequestUsage, add_request_usage, request_usage,
 )
-from electrumx.server.history import History
-from electrumx.server.storage import db_class, Storage
+from electrumx.server.history import History, compact_rows
+from electrumx.server.storage import db_class, ColumnFamily, Storage, StorageStats
 from electrumx.server.env import Env
 
 UTXO = namedtuple("UTXO", "tx_num tx_pos tx_hash height name value")
@@ -118,6 +123,49 @@ _asset_db_prefixes = [
 ]
 assert len(_asset_db_prefixes) == len(set(_asset_db_prefixes))
 
+# Column family layouts.  Undo information is written every block but
+# only read on reorgs.
+_undo_family = ColumnFamily('undo', low_priority=True)
+
+_utxo_db_families = {
+    # Looked up by prefix + compressed tx hash + tx_idx
+    PREFIX_UTXO_HISTORY: ColumnFamily('utxo_history', prefix_len=9),
+    # Scanned by hashX
+    PREFIX_HASHX_LOOKUP: ColumnFamily('hashx_lookup', block_size=64 * 1024),
+    PREFIX_UTXO_UNDO: _undo_family,
+}
+
+_suid_db_families = {
+    PREFIX_ASSET_ID_UNDO: _undo_family,
+    PREFIX_H160_ID_UNDO: _undo_family,
+}
+
+_asset_db_families = {
+    prefix: _undo_family for prefix in [
+        PREFIX_METADATA_UNDO,
+        PREFIX_METADATA_HISTORY_UNDO,
+        PREFIX_BROADCAST_UNDO,
+        PREFIX_TAG_HISTORY_UNDO,
+        PREFIX_TAG_CURRENT_UNDO,
+        PREFIX_FREEZE_CURRENT_UNDO,
+        PREFIX_FREEZE_HISTORY_UNDO,
+        PREFIX_VERIFIER_CURRENT_UNDO,
+        PREFIX_VERIFIER_HISTORY_UNDO,
+        PREFIX_ASSOCIATION_CURRENT_UNDO,
+        PREFIX_ASSOCIATION_HISTORY_UNDO,
+    ]
+}
+
+# The column families of each database by name.  They must be passed
+# whenever a database is opened, as engines with column families cannot
+# open the database without them.
+DB_FAMILIES = {
+    'utxo': _utxo_db_families,
+    'asset': _asset_db_families,
+    'suid': _suid_db_families,
+    'hist': None,
+}
+
 # Storage Protocol
 # flush_utxo_db:
 #   history
@@ -295,6 +343,154 @@ class FlushData(object):
     association_history_undo_infos = attr.ib()
     association_history_deletes = attr.ib()
 
+class ReadView:
+    '''A consistent read-only view of the UTXO and history DBs.
+
+    It is pinned to the state of the last completed flush, so reads
+    through it never see part of a flush and all tx numbers found in
+    it resolve to a tx hash.  Must be closed after use; can be used as
+    a context manager.
+
+    The tx counts and hashes files are not snapshotted; a reorg pops
+    the first and rewrites the second.  So tx hashes are only returned
+    if no reorg began since the view was created, otherwise StaleError
+    is raised and the caller should retry with a new view.  A reorg
+    begins a new generation when it pops the tx counts and again when
+    its backup flush completes, as a view created in between still has
+    the tx count of the old chain, whose hashes the next flush_fs()
+    overwrites.  Views created later have the lower tx count, and
+    flush_fs() only writes hashes above it.
+    '''
+
+    class StaleError(Exception):
+        '''Raised when a reorg has begun since the view was created.'''
+
+    def __init__(self, db):
+        self.height = db.state.height
+        self.tx_count = db.state.tx_count
+        self.reorg_generation = db.reorg_generation
+        self.utxo_db = db.utxo_db.snapshot()
+        self.hist_db = db.history.db.snapshot()
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.utxo_db.close()
+        self.hist_db.close()
+
+    def check_current(self):
+        '''Raise StaleError if a reorg has begun since the view was created.
+        Call after reading, so the reads predate any reorg.'''
+        if self.db.reorg_generation != self.reorg_generation:
+            raise self.StaleError('chain reorganised during read')
+
+    def fs_tx_hash(self, tx_num):
+        '''As for DB.fs_tx_hash() but as of the view's height.'''
+        return self.fs_tx_hashes([tx_num])[0]
+
+    def fs_tx_hashes(self, tx_nums):
+        '''Return a list of (tx_hash, tx_height) pairs as for fs_tx_hash()
+        for each of tx_nums, which must be ascending.  The hashes are read
+        in one pass.'''
+        tx_counts = self.db.tx_counts
+        hi = min(len(tx_counts), self.height + 1)
+        on_disk = bisect_left(tx_nums, self.tx_count)
+        heights = []
+        tx_height = 0
+        for tx_num in tx_nums[:on_disk]:
+            tx_height = bisect_right(tx_counts, tx_num, tx_height, hi)
+            heights.append(tx_height)
+        tx_hashes = self.db.hashes_file.read_many(
+            [tx_num * 32 for tx_num in tx_nums[:on_disk]], 32)
+        self.check_current()
+        heights.extend(self.height + 1 for _ in range(on_disk, len(tx_nums)))
+        tx_hashes.extend(None for _ in range(on_disk, len(tx_nums)))
+        return list(zip(tx_hashes, heights))
+
+    def fs_tx_hashes_many(self, tx_nums_lists):
+        '''As for fs_tx_hashes() for each list of tx_nums, reading the hashes
+        of all the lists in one pass.'''
+        if len(tx_nums_lists) == 1:
+            return [self.fs_tx_hashes(tx_nums_lists[0])]
+        all_tx_nums = sorted(set(itertools.chain.from_iterable(tx_nums_lists)))
+        pairs = dict(zip(all_tx_nums, self.fs_tx_hashes(all_tx_nums)))
+        return [[pairs[tx_num] for tx_num in tx_nums] for tx_nums in tx_nums_lists]
+
+
+class ReadBatcher:
+    '''Coalesces concurrent reads into one call of a batch read function.
+
+    Reads requested before the event loop next runs, such as those of the
+    items of a JSON RPC batch which are processed together, are passed
+    together to read_batch(keys).  It returns a (result, usage) pair per
+    key; a result that is an exception is raised by the read of that key
+    only.  An exception raised by read_batch itself is raised by every
+    read of the batch.  Each request is charged the usage of its key
+    plus an equal share of the rest of the batch's measured usage, such
+    as the time waiting for the thread pool.
+    '''
+
+    def __init__(self, read_batch):
+        self.read_batch = read_batch
+        self.pending = None
+
+    async def read(self, key):
+        while self.pending is not None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending.append((key, future))
+            try:
+                result, usage = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Retry if the reading task was cancelled, not us
+                if not future.cancelled():
+                    raise
+            else:
+                add_request_usage(usage)
+                return self.result(result)
+
+        pending = self.pending = []
+        usage = RequestUsage()
+        token = request_usage.set(usage)
+        try:
+            # Let concurrent reads join the batch
+            await sleep(0)
+            self.pending = None
+            results = await self.read_batch([key] + [key for key, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            raise
+        except BaseException:
+            for _, future in pending:
+                future.cancel()
+            raise
+        finally:
+            request_usage.reset(token)
+            if self.pending is pending:
+                self.pending = None
+        for _, key_usage in results:
+            usage.subtract(key_usage)
+        share = usage.share(len(results))
+        for _, key_usage in results:
+            key_usage.add(share)
+        for (_, future), result in zip(pending, results[1:]):
+            future.set_result(result)
+        result, usage = results[0]
+        add_request_usage(usage)
+        return self.result(result)
+
+    @staticmethod
+    def result(result):
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
 class DB:
     '''Simple wrapper of the backend database for querying.
 
@@ -303,6 +499,8 @@ class DB:
     '''
 
     DB_VERSIONS = [0]
+    # Reads made stale by reorgs this many times in a row fail
+    READ_ATTEMPTS = 5
 
     class DBError(Exception):
         '''Raised on general DB errors generally indicating corruption.'''
@@ -319,10 +517,23 @@ class DB:
         os.chdir(env.db_dir)
 
         self.db_class = db_class(self.env.db_engine)
+        # Read and write counters by database and key prefix
+        self.storage_stats = StorageStats() if env.db_stats else None
         self.history = History()
         self.utxo_db: Storage = None
         self.state: Optional[ChainState] = None
         self.last_flush_state = None
+        # Held while a flush updates the DBs so read views are consistent
+        self.flush_lock = threading.Lock()
+        # Incremented as each block is backed up, before the tx counts and
+        # hashes files change, so read views can detect reorgs
+        self.reorg_generation = 0
+        # UTXO counts by first hashX byte found by a background recount.
+        # None unless the stored UTXO count is unknown (old DBs)
+        self.utxo_recount = None
+        # Ranges being recounted mapped to the net UTXOs flushed to them
+        # since their count's snapshot was taken
+        self.utxo_recounting = {}
 
         self.fs_height = -1
         self.fs_tx_count = 0
@@ -350,16 +561,45 @@ class DB:
         self.tx_counts_file = util.LogicalFile('meta/txcounts', 2, 2000000)
         self.hashes_file = util.LogicalFile('meta/hashes', 4, 16000000)
 
+        # Client reads of many addresses are made in one thread hop
+        self._history_reads = ReadBatcher(self._read_histories)
+        self._history_after_reads = ReadBatcher(self._read_histories_after)
+        self._utxo_reads = ReadBatcher(self._read_utxos)
+
     async def run_in_thread_client(self, func, *args):
         '''Run a function in the client thread pool.
         
         Uses dedicated client pool if available, otherwise falls back to default pool.
+        The time taken, and CPU time and database bytes used, are added to the
+        current request's usage.
         '''
+        usage = request_usage.get()
+        if usage is None:
+            return await self._run_in_client_pool(func, *args)
+        start = time.perf_counter()
+        try:
+            return await self._run_in_client_pool(partial(self._measured_call, usage, func),
+                                                  *args)
+        finally:
+            usage.pool_time += time.perf_counter() - start
+
+    async def _run_in_client_pool(self, func, *args):
         if self.thread_pools:
             return await self.thread_pools.run_in_client_thread(func, *args)
         else:
             return await run_in_thread(func, *args)
 
+    def _measured_call(self, usage, func, *args):
+        thread_bytes = self.storage_stats.thread_bytes if self.storage_stats else None
+        start_bytes = thread_bytes.nbytes if thread_bytes is not None else 0
+        start_time = time.thread_time()
+        try:
+            return func(*args)
+        finally:
+            usage.cpu_time += time.thread_time() - start_time
+            if thread_bytes is not None:
+                usage.db_bytes += thread_bytes.nbytes - start_bytes
+
     async def _read_tx_counts(self):
         if self.tx_counts is not None:
             return
@@ -380,7 +620,7 @@ class DB:
         assert self.suid_db is None
 
         # First UTXO DB
-        self.utxo_db = self.db_class('utxo', for_sync)
+        self.utxo_db = self.db_class('utxo', for_sync, DB_FAMILIES['utxo'])
         if self.utxo_db.is_new:
             self.logger.info('created new database')
             self.logger.info('creating metadata directory')
@@ -392,10 +632,10 @@ class DB:
             self.logger.info(f'opened UTXO DB (for sync: {for_sync})')
 
         # Asset DB
-        self.asset_db = self.db_class('asset', for_sync)
+        self.asset_db = self.db_class('asset', for_sync, DB_FAMILIES['asset'])
 
         # Sequential unique id DB
-        self.suid_db = self.db_class('suid', for_sync)
+        self.suid_db = self.db_class('suid', for_sync, DB_FAMILIES['suid'])
 
         self.read_utxo_state()
 
@@ -403,6 +643,10 @@ class DB:
         self.state.flush_count = self.history.open_db(self.db_class, for_sync,
                                                       self.state.flush_count,
                                                       compacting)
+        if self.storage_stats:
+            for name, storage in (('utxo', self.utxo_db), ('asset', self.asset_db),
+                                  ('suid', self.suid_db), ('hist', self.history.db)):
+                storage.instrument(name, self.storage_stats)
         self.clear_excess_undo_info()
 
         # Read TX counts (requires meta directory)
@@ -437,6 +681,57 @@ class DB:
             
         return await self._open_dbs(False, False)
 
+    def compact_history_step(self, limit=1_000_000, max_prefixes=64):
+        '''Compact the history of a few prefixes whilst serving.  The rows
+        are read from a snapshot and compacted without the flush lock,
+        which is held only to write the result.'''
+        history = self.history
+        with self.flush_lock:
+            snapshot = history.db.snapshot()
+            flush_count = history.flush_count
+        try:
+            rows, cursor = history._read_compaction_rows(
+                snapshot, history.comp_cursor, limit, max_prefixes)
+        finally:
+            snapshot.close()
+        write_items, keys_to_delete, _write_size, max_rows = compact_rows(
+            rows, history.max_hist_row_entries)
+        with self.flush_lock:
+            # A flush since the snapshot may have taken flush ids of the
+            # compacted rows, and a backup rewritten rows read.  Try again
+            if history.flush_count != flush_count:
+                return
+            history.comp_flush_count = max(history.comp_flush_count, max_rows - 1)
+            history._flush_compaction(cursor, write_items, keys_to_delete)
+
+    async def compact_history_online(self):
+        '''Compact history in the background whilst serving, once
+        COMPACT_HISTORY_FLUSHES history flushes have happened since the
+        last compaction.  Each step compacts a few prefixes, then sleeps
+        so flushes and clients are not held up.'''
+        flushes = self.env.compact_history_flushes
+        if not flushes:
+            return
+        history = self.history
+
+        while True:
+            if history.flush_count - history.compacted_flush_count < flushes:
+                await sleep(60)
+                continue
+            self.logger.info(f'compacting history after {flushes:,d} flushes')
+            start = time.monotonic()
+            history.start_compaction(online=True)
+            next_log = 10
+            while history.comp_cursor != -1:
+                await run_in_thread(self.compact_history_step)
+                progress = history.compaction_progress()
+                if progress is not None and progress >= next_log:
+                    self.logger.info(f'history compaction {progress:.0f}% complete')
+                    next_log += 10
+                await sleep(0.2)
+            self.logger.info(f'history compaction complete in '
+                             f'{formatted_time(time.monotonic() - start)}')
+
     # Header merkle cache
     async def populate_header_merkle_cache(self):
         self.logger.info('populating header merkle cache...')
@@ -518,11 +813,15 @@ class DB:
         asset_delta = flush_data.state.asset_count - self.last_flush_state.asset_count
         size_delta = flush_data.state.chain_size - self.last_flush_state.chain_size
         utxo_count_delta = flush_data.state.utxo_count - self.last_flush_state.utxo_count
+        if self.utxo_recount is None:
+            utxos = f'{flush_data.state.utxo_count:,d} ({utxo_count_delta:+,d})'
+        else:
+            utxos = f'recounting ({utxo_count_delta:+,d})'
 
         self.logger.info(f'flush #{self.history.flush_count:,d} took {elapsed:.1f}s.  '
                          f'Height {flush_data.state.height:,d} '
                          f'txs: {flush_data.state.tx_count:,d} ({tx_delta:+,d}) '
-                         f'utxos: {flush_data.state.utxo_count:,d} ({utxo_count_delta:+,d}) '
+                         f'utxos: {utxos} '
                          f'assets: {flush_data.state.asset_count:,d} ({asset_delta:+,d}) '
                          f'size: {flush_data.state.chain_size:,d} ({size_delta:+,d})')
         return size_delta
@@ -537,32 +836,39 @@ class DB:
 
         start_time = time.time()
 
+        # With group durability only the final, state-bearing batch is
+        # synced; the others rely on the write-ahead log.  After a crash
+        # excess history is removed by History.clear_excess().
+        sync_all = self.env.db_durability == Env.DURABILITY_FULL
+
         # Flush to file system
         self.flush_fs(flush_data)
 
-        # Then history
-        self.flush_history()
-        flush_data.state.flush_count = self.history.flush_count
-
-        # Flush state last as it reads the wall time.
-        if flush_utxos:
-            self.flush_suid_db(flush_data)
-            self.flush_asset_db(flush_data)
-            self.flush_utxo_db(flush_data)
-
-        end_time = time.time()
-        elapsed = end_time - start_time
-        flush_interval = end_time - self.last_flush_state.flush_time
-        flush_data.state.flush_time = end_time
-        flush_data.state.sync_time += flush_interval
+        with self.flush_lock:
+            # Then history
+            self.flush_history(sync=sync_all or not flush_utxos)
+            flush_data.state.flush_count = self.history.flush_count
+
+            # Flush state last as it reads the wall time.
+            if flush_utxos:
+                self.flush_suid_db(flush_data, sync=sync_all)
+                self.flush_asset_db(flush_data, sync=sync_all)
+                self.flush_utxo_db(flush_data)
+                self.history.utxo_flush_count = flush_data.state.flush_count
+
+            end_time = time.time()
+            elapsed = end_time - start_time
+            flush_interval = end_time - self.last_flush_state.flush_time
+            flush_data.state.flush_time = end_time
+            flush_data.state.sync_time += flush_interval
+
+            # CRITICAL: Always update db.state after flush so clients see correct height
+            # Sessions use db.state.height in _refresh_hsub_results (line 384 of session.py)
+            self.state = flush_data.state.copy()
 
-        # CRITICAL: Always update db.state after flush so clients see correct height
-        # Sessions use db.state.height in _refresh_hsub_results (line 384 of session.py)
-        self.state = flush_data.state.copy()
-        
-        # Write UTXO state to disk only when doing full UTXO flush
-        if flush_utxos:
-            self.write_utxo_state(self.utxo_db)
+            # Write UTXO state to disk only when doing full UTXO flush
+            if flush_utxos:
+                self.write_utxo_state(self.utxo_db)
 
         size_delta = self.log_flush_stats('flush', flush_data, elapsed)
 
@@ -615,14 +921,14 @@ class DB:
         self.fs_asset_count = flush_data.state.asset_count
         self.fs_h160_count = flush_data.state.h160_count
 
-    def flush_history(self):
-        self.history.flush()
+    def flush_history(self, sync=True):
+        self.history.flush(sync=sync)
 
-    def flush_suid_db(self, flush_data: FlushData):
+    def flush_suid_db(self, flush_data: FlushData, sync=True):
         start_time = time.monotonic()
         asset_add_count = len(flush_data.asset_id_adds)
         h160_add_count = len(flush_data.h160_id_adds)
-        with self.suid_db.write_batch() as batch:
+        with self.suid_db.write_batch(sync=sync) as batch:
             # Walk-backs
             batch_delete = batch.delete
             for deletion_list in [flush_data.asset_id_deletes, 
@@ -652,7 +958,7 @@ class DB:
                              f'{h160_add_count:,d} h160 ids in '
                              f'{elapsed:.1f}s, committing...')
 
-    def flush_asset_db(self, flush_data: FlushData):
+    def flush_asset_db(self, flush_data: FlushData, sync=True):
         start_time = time.monotonic()
         metadata_sets = len(flush_data.metadata_sets)
         metadata_history_adds = len(flush_data.metadata_history_adds)
@@ -665,7 +971,7 @@ class DB:
         verifier_history_adds = len(flush_data.verifier_history_adds)
         association_sets = len(flush_data.association_sets)
         association_history_adds = len(flush_data.association_history_adds)
-        with self.asset_db.write_batch() as batch:
+        with self.asset_db.write_batch(sync=sync) as batch:
             batch_delete = batch.delete
             for deletion_list in [flush_data.metadata_deletes, 
                                   flush_data.metadata_history_deletes,
@@ -748,6 +1054,8 @@ class DB:
         start_time = time.monotonic()
         add_count = len(flush_data.utxo_adds)
         spend_count = len(flush_data.utxo_deletes) // 2
+        if self.utxo_recount is not None:
+            self.update_utxo_recount(flush_data)
         with self.utxo_db.write_batch() as batch:
             # Spends
             batch_delete = batch.delete
@@ -787,6 +1095,74 @@ class DB:
             self.state = flush_data.state.copy()
             self.write_utxo_state(batch)
 
+    def update_utxo_recount(self, flush_data: FlushData):
+        '''Apply the UTXO adds and spends of a flush to the ranges that have
+        been or are being recounted.  Once all are counted the UTXO count
+        of the chain state is set to their total.'''
+        counts = self.utxo_recount
+        recounting = self.utxo_recounting
+        for key in flush_data.utxo_deletes:
+            if key[:1] == PREFIX_HASHX_LOOKUP:
+                first = key[1]
+                if first in counts:
+                    counts[first] -= 1
+                elif first in recounting:
+                    recounting[first] -= 1
+        for value in flush_data.utxo_adds.values():
+            first = value[0]
+            if first in counts:
+                counts[first] += 1
+            elif first in recounting:
+                recounting[first] += 1
+
+        if len(counts) == 256:
+            flush_data.state.utxo_count = sum(counts.values())
+            self.utxo_recount = None
+            self.logger.info(f'UTXO recount complete: '
+                             f'{flush_data.state.utxo_count:,d} UTXOs')
+
+    async def recount_utxos(self):
+        '''Count the UTXOs of a DB whose UTXO count is unknown, in the
+        background whilst serving.
+
+        The key range of each first hashX byte is counted in a snapshot
+        taken at a flush, several at a time.  Counts are kept current by
+        later flushes and written with them, so an interrupted recount
+        resumes with the ranges still to do.'''
+        if self.utxo_recount is None:
+            return
+
+        def count_range(first):
+            with self.flush_lock:
+                snapshot = self.utxo_db.snapshot()
+                self.utxo_recounting[first] = 0
+            try:
+                count = 0
+                for _db_key in snapshot.iterator(prefix=PREFIX_HASHX_LOOKUP + bytes((first, )),
+                                                 include_value=False, fill_cache=False):
+                    count += 1
+            finally:
+                snapshot.close()
+            with self.flush_lock:
+                self.utxo_recount[first] = count + self.utxo_recounting.pop(first)
+
+        async def count_ranges():
+            while pending:
+                await run_in_thread(count_range, pending.pop())
+
+        pending = [first for first in range(255, -1, -1)
+                   if first not in self.utxo_recount]
+        self.logger.info(f'UTXO count unknown; recounting {len(pending)} of 256 '
+                         f'ranges in the background')
+        start = time.monotonic()
+        async with TaskGroup() as group:
+            for _ in range(min(len(pending), os.cpu_count() or 1, 8)):
+                await group.spawn(count_ranges())
+        if group.exception:
+            raise group.exception
+        self.logger.info(f'UTXO ranges recounted in {time.monotonic() - start:.1f}s; '
+                         f'the count is set at the next flush')
+
     def flush_backup(self, flush_data, touched):
         '''Like flush_dbs() but when backing up.  All UTXOs are flushed.'''
         assert not flush_data.headers
@@ -795,13 +1171,20 @@ class DB:
         self.history.assert_flushed()
 
         start_time = time.time()
-        
-        self.backup_fs(flush_data.state.height, flush_data.state.tx_count, flush_data.state.asset_count, flush_data.state.h160_count)
-        self.history.backup(touched, flush_data.state.tx_count)
 
-        self.flush_utxo_db(flush_data)
-        self.flush_asset_db(flush_data)
-        self.flush_suid_db(flush_data)
+        with self.flush_lock:
+            self.backup_fs(flush_data.state.height, flush_data.state.tx_count,
+                           flush_data.state.asset_count, flush_data.state.h160_count)
+            self.history.backup(touched, flush_data.state.tx_count)
+            flush_data.state.flush_count = self.history.flush_count
+
+            self.flush_utxo_db(flush_data)
+            self.history.utxo_flush_count = flush_data.state.flush_count
+            self.flush_asset_db(flush_data)
+            self.flush_suid_db(flush_data)
+            # Views created since the reorg began have the old tx count;
+            # see ReadView
+            self.reorg_generation += 1
 
         elapsed = time.time() - start_time
         self.log_flush_stats('backup flush', flush_data, time.time() - start_time)
@@ -996,6 +1379,59 @@ class DB:
 
         return [self.coin.header_hash(header) for header in headers]
 
+    def read_view(self):
+        '''Return a ReadView of the UTXO and history DBs as of the last
+        completed flush.  Blocks whilst a flush is writing.'''
+        with self.flush_lock:
+            return ReadView(self)
+
+    def read_keys(self, keys, read_key, usages):
+        '''Return read_key(*key) for each of the (hashX, ...) keys, reading
+        them in hashX order, and add the usage of each read to the
+        RequestUsage of its key in usages.  An exception raised reading a
+        key is returned as its result, so that only the request of that key
+        fails; a stale view is raised so the whole read is retried.'''
+        results = [None] * len(keys)
+        for n in sorted(range(len(keys)), key=lambda n: keys[n][0]):
+            try:
+                results[n] = self._measured_call(usages[n], read_key, *keys[n])
+            except ReadView.StaleError:
+                raise
+            except Exception as e:
+                results[n] = e
+        return results
+
+    def read_tx_hashes(self, view, tx_nums_lists, usages):
+        '''Return view.fs_tx_hashes_many(tx_nums_lists), where a list may be
+        an exception which is returned in place of its hashes.  The usage
+        of the shared pass is charged to usages in proportion to the
+        number of tx_nums of each list.'''
+        counts = [0 if isinstance(tx_nums, Exception) else len(tx_nums)
+                  for tx_nums in tx_nums_lists]
+        usage = RequestUsage()
+        histories = self._measured_call(usage, view.fs_tx_hashes_many, [
+            [] if isinstance(tx_nums, Exception) else tx_nums
+            for tx_nums in tx_nums_lists])
+        total = sum(counts)
+        for key_usage, count in zip(usages, counts):
+            if count:
+                key_usage.add(usage.share(total / count))
+        return [tx_nums if isinstance(tx_nums, Exception) else history
+                for tx_nums, history in zip(tx_nums_lists, histories)]
+
+    def read_consistent(self, read):
+        '''Return read(view) for a new read view, retrying with another view
+        if a reorg made it stale.  Raises StaleError if every one of
+        READ_ATTEMPTS views was made stale.'''
+        for attempt in range(1, self.READ_ATTEMPTS + 1):
+            with self.read_view() as view:
+                try:
+                    return read(view)
+                except ReadView.StaleError:
+                    if attempt == self.READ_ATTEMPTS:
+                        raise
+                    self.logger.info('chain reorganised during read; retrying')
+
     async def limited_history(self, hashX, *, limit=1000):
         '''Return an unpruned, sorted list of (tx_hash, height) tuples of
         confirmed transactions that touched the address, earliest in
@@ -1003,17 +1439,52 @@ class DB:
         transactions.  By default returns at most 1000 entries.  Set
         limit to None to get them all.
         '''
-        def read_history():
-            tx_nums = list(self.history.get_txnums(hashX, limit))
-            fs_tx_hash = self.fs_tx_hash
-            return [fs_tx_hash(tx_num) for tx_num in tx_nums]
-
-        while True:
-            history = await self.run_in_thread_client(read_history)
-            if all(hash is not None for hash, height in history):
-                return history
-            self.logger.warning('limited_history: tx hash not found (reorg?), retrying...')
-            await sleep(0.25)
+        return await self._history_reads.read((hashX, limit))
+
+    async def _read_histories(self, keys):
+        '''Read the histories of (hashX, limit) keys in hashX order.'''
+        def read_histories(view):
+            def read_key(hashX, limit):
+                return self.history.get_txnum_array(hashX, limit, snapshot=view.hist_db)
+
+            usages = [RequestUsage() for _ in keys]
+            tx_nums_lists = self.read_keys(keys, read_key, usages)
+            return list(zip(self.read_tx_hashes(view, tx_nums_lists, usages), usages))
+
+        return await self.run_in_thread_client(self.read_consistent, read_histories)
+
+    async def history_after(self, hashX, tx_num, *, limit=1000):
+        '''Return a (count, tx_nums, history) triple for the address: its
+        number of confirmed transactions, and the ascending tx_nums and
+        (tx_hash, height) pairs of those after tx_num.  A negative tx_num
+        returns the whole history.  If count reaches limit nothing is read
+        and both lists are empty.
+        '''
+        return await self._history_after_reads.read((hashX, tx_num, util.resolve_limit(limit)))
+
+    async def _read_histories_after(self, keys):
+        '''Read the history tails of (hashX, tx_num, limit) keys in hashX order.'''
+        def read_histories(view):
+            def read_key(hashX, tx_num, limit):
+                count = self.history.get_count(hashX, snapshot=view.hist_db)
+                if 0 < limit <= count:
+                    return count, []
+                return count, self.history.get_txnum_tail(hashX, tx_num,
+                                                          snapshot=view.hist_db)
+
+            usages = [RequestUsage() for _ in keys]
+            tails = self.read_keys(keys, read_key, usages)
+            histories = self.read_tx_hashes(view, [
+                tail if isinstance(tail, Exception) else tail[1] for tail in tails], usages)
+            return [(history if isinstance(history, Exception) else (*tail, history), usage)
+                    for tail, history, usage in zip(tails, histories, usages)]
+
+        return await self.run_in_thread_client(self.read_consistent, read_histories)
+
+    async def history_count(self, hashX):
+        '''Return the number of confirmed transactions that touched the
+        address, without reading its history.'''
+        return await self.run_in_thread_client(self.history.get_count, hashX)
 
     # -- Undo information
     
@@ -1073,15 +1544,14 @@ class DB:
             batch_put(self.undo_key(prefix, height), b''.join(undo_info))
 
     def clear_suid_undo_info(self, height: int, verbose=True):
-        min_height = self.min_undo_height(self.state.height)
+        # Undo keys are unsigned so the bound cannot go below zero
+        min_height = max(self.min_undo_height(self.state.height), 0)
         keys = []
         for prefix in [PREFIX_ASSET_ID_UNDO,
                        PREFIX_H160_ID_UNDO]:
-            for key, _hist in self.suid_db.iterator(prefix=prefix):
-                height, = unpack_be_uint32(key[-4:])
-                if height >= min_height:
-                    break
-                keys.append(key)
+            keys.extend(self.suid_db.iterator(
+                prefix=prefix, stop=self.undo_key(prefix, min_height),
+                include_value=False, fill_cache=False))
 
         if keys:
             with self.suid_db.write_batch() as batch:
@@ -1091,7 +1561,8 @@ class DB:
                 self.logger.info(f'deleted {len(keys):,d} stale sequential unique id undo entries')
 
     def clear_asset_undo_info(self, height: int, verbose=True):
-        min_height = self.min_undo_height(self.state.height)
+        # Undo keys are unsigned so the bound cannot go below zero
+        min_height = max(self.min_undo_height(self.state.height), 0)
         keys = []
         for prefix in [PREFIX_METADATA_UNDO,
                        PREFIX_METADATA_HISTORY_UNDO,
@@ -1104,11 +1575,9 @@ class DB:
                        PREFIX_VERIFIER_HISTORY_UNDO,
                        PREFIX_ASSOCIATION_CURRENT_UNDO,
                        PREFIX_ASSOCIATION_HISTORY_UNDO]:
-            for key, _hist in self.asset_db.iterator(prefix=prefix):
-                height, = unpack_be_uint32(key[-4:])
-                if height >= min_height:
-                    break
-                keys.append(key)
+            keys.extend(self.asset_db.iterator(
+                prefix=prefix, stop=self.undo_key(prefix, min_height),
+                include_value=False, fill_cache=False))
 
         if keys:
             with self.asset_db.write_batch() as batch:
@@ -1119,13 +1588,12 @@ class DB:
 
     def clear_excess_undo_info(self, verbose=True):
         '''Clear excess undo info.  Only most recent N are kept.'''
-        min_height = self.min_undo_height(self.state.height)
-        keys = []
-        for key, _hist in self.utxo_db.iterator(prefix=PREFIX_UTXO_UNDO):
-            height, = unpack_be_uint32(key[-4:])
-            if height >= min_height:
-                break
-            keys.append(key)
+        # Undo keys are unsigned so the bound cannot go below zero
+        min_height = max(self.min_undo_height(self.state.height), 0)
+        keys = list(self.utxo_db.iterator(
+            prefix=PREFIX_UTXO_UNDO,
+            stop=self.undo_key(PREFIX_UTXO_UNDO, min_height),
+            include_value=False, fill_cache=False))
 
         if keys:
             with self.utxo_db.write_batch() as batch:
@@ -1141,13 +1609,8 @@ class DB:
 
     def read_utxo_state(self):
 
-        def count_utxos():
-            count = 0
-            for db_key, db_value in self.utxo_db.iterator(prefix=PREFIX_HASHX_LOOKUP):
-                count += 1
-            return count
-
         now = time.time()
+        utxo_recount = {}
         state = self.utxo_db.get(b'state')
         if not state:
             state = ChainState(height=-1, tx_count=0, asset_count=0, h160_count=0, 
@@ -1164,6 +1627,7 @@ class DB:
                 raise self.DBError(f'DB genesis hash {state["genesis"]} does not match '
                                    f'coin {self.coin.GENESIS_HASH}')
 
+            utxo_recount = state.get('utxo_recount', utxo_recount)
             state = ChainState(
                 height=state['height'],
                 tx_count=state['tx_count'],
@@ -1184,9 +1648,10 @@ class DB:
             raise self.DBError(f'your UTXO DB version is {state.db_version} but this '
                                f'software only handles versions {self.DB_VERSIONS}')
 
+        self.utxo_recount = None
+        self.utxo_recounting.clear()
         if self.state.utxo_count == -1:
-            self.logger.info('counting UTXOs, please wait...')
-            self.state.utxo_count = count_utxos()
+            self.utxo_recount = utxo_recount
 
         self.last_flush_state = state.copy()
 
@@ -1208,7 +1673,11 @@ class DB:
         self.logger.info(f'height: {state.height:,d}')
         self.logger.info(f'tip: {hash_to_hex_str(state.tip)}')
         self.logger.info(f'tx count: {state.tx_count:,d}')
-        self.logger.info(f'utxo count: {state.utxo_count:,d}')
+        if self.utxo_recount is None:
+            self.logger.info(f'utxo count: {state.utxo_count:,d}')
+        else:
+            self.logger.info(f'utxo count: unknown, {len(self.utxo_recount)}/256 '
+                             f'ranges recounted')
         self.logger.info(f'chain size: {state.chain_size // 1_000_000_000} GB '
                          f'({state.chain_size:,d} bytes)')
         self.logger.info('VOUT debugging: {}'.format(self.env.write_bad_vouts_to_file))
@@ -1231,8 +1700,10 @@ class DB:
             'wall_time': self.state.sync_time,
             'first_sync': self.state.first_sync,
             'db_version': self.state.db_version,
-            'utxo_count': self.state.utxo_count,
+            'utxo_count': -1 if self.utxo_recount is not None else self.state.utxo_count,
         }
+        if self.utxo_recount is not None:
+            state['utxo_recount'] = self.utxo_recount
         batch.put(b'state', repr(state).encode())
 
     def set_flush_count(self, count):
@@ -1276,30 +1747,50 @@ class DB:
                 asset_name_to_id[asset_name] = idb
             asset_ids = asset_name_to_id.values()
 
-        def read_utxos():
-            utxos = []
-            utxos_append = utxos.append
-            # Key: b'u' + address_hashX + asset_id + tx_idx + tx_num
-            # Value: the UTXO value as a 64-bit unsigned integer
-            for asset_id in asset_ids:
-                prefix = PREFIX_HASHX_LOOKUP + hashX + asset_id
-                for db_key, db_value in self.utxo_db.iterator(prefix=prefix):
-                    value, = unpack_le_uint64(db_value)
-                    if value > 0:
-                        tx_pos, = unpack_le_uint32(db_key[-9:-5])
-                        tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
-                        tx_hash, height = self.fs_tx_hash(tx_num)
-                        asset_id = db_key[-13:-9]
-                        asset_str = self.get_asset_for_id(asset_id)
-                        utxos_append(UTXO(tx_num, tx_pos, tx_hash, height, asset_str, value))
-            return utxos
-
-        while True:
-            utxos = await self.run_in_thread_client(read_utxos)
-            if all(utxo.tx_hash is not None for utxo in utxos):
+        return await self._utxo_reads.read((hashX, tuple(asset_ids)))
+
+    async def _read_utxos(self, keys):
+        '''Read the UTXOs of (hashX, asset_ids) keys in hashX order.'''
+        def read_utxos(view):
+            def read_key(hashX, asset_ids):
+                # Key: b'u' + address_hashX + asset_id + tx_idx + tx_num
+                # Value: the UTXO value as a 64-bit unsigned integer
+                rows = []
+                for asset_id in asset_ids:
+                    prefix = PREFIX_HASHX_LOOKUP + hashX + asset_id
+                    for db_key, db_value in view.utxo_db.iterator(prefix=prefix):
+                        value, = unpack_le_uint64(db_value)
+                        if value > 0:
+                            rows.append((db_key, value))
+                tx_nums = sorted(unpack_le_uint64(db_key[-5:] + bytes(3))[0]
+                                 for db_key, _ in rows)
+                return rows, tx_nums
+
+            def utxos(hashX, rows, pairs):
+                if isinstance(rows, Exception):
+                    raise rows
+                rows, tx_nums = rows
+                pairs = dict(zip(tx_nums, pairs))
+                utxos = []
+                for db_key, value in rows:
+                    tx_pos, = unpack_le_uint32(db_key[-9:-5])
+                    tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
+                    tx_hash, height = pairs[tx_num]
+                    asset_str = self.get_asset_for_id(db_key[-13:-9])
+                    utxos.append(UTXO(tx_num, tx_pos, tx_hash, height, asset_str, value))
                 return utxos
-            self.logger.warning('all_utxos: tx hash not found (reorg?), retrying...')
-            await sleep(0.25)
+
+            usages = [RequestUsage() for _ in keys]
+            rows_lists = self.read_keys(keys, read_key, usages)
+            pairs_lists = self.read_tx_hashes(view, [
+                rows if isinstance(rows, Exception) else rows[1] for rows in rows_lists],
+                usages)
+            utxos_lists = self.read_keys(
+                [(hashX, rows, pairs) for (hashX, _), rows, pairs
+                 in zip(keys, rows_lists, pairs_lists)], utxos, usages)
+            return list(zip(utxos_lists, usages))
+
+        return await self.run_in_thread_client(self.read_consistent, read_utxos)
 
     async def lookup_utxos(self, prevouts):
         '''For each prevout, lookup it up in the DB and return a (hashX, asset, value) pair or None if not found.
@@ -29,6 +29,8 @@ class Env(EnvBase):
 
     # Peer discovery
     PD_OFF, PD_SELF, PD_ON = ('OFF', 'SELF', 'ON')
+    # DB durability
+    DURABILITY_FULL, DURABILITY_GROUP = ('full', 'group')
     SSL_PROTOCOLS = {'ssl', 'wss'}
     KNOWN_PROTOCOLS = {'ssl', 'tcp', 'ws', 'wss', 'rpc'}
 
@@ -62,11 +64,18 @@ class Env(EnvBase):
         # Misc
 
         self.db_engine = self.default('DB_ENGINE', 'leveldb')
+        self.db_durability = self.db_durability_enum()
+        self.db_stats = self.boolean('DB_STATS', True)
+        self.compact_history_flushes = self.integer('COMPACT_HISTORY_FLUSHES', 0)
         self.banner_file = self.default('BANNER_FILE', None)
         self.tor_banner_file = self.default('TOR_BANNER_FILE',
                                             self.banner_file)
         self.anon_logs = self.boolean('ANON_LOGS', False)
         self.log_sessions = self.integer('LOG_SESSIONS', 3600)
+        self.slowlog_threshold = self.integer('SLOWLOG_THRESHOLD', 1000)
+        self.slowlog_size = self.integer('SLOWLOG_SIZE', 100)
+        if self.slowlog_size < 0:
+            raise self.Error('SLOWLOG_SIZE cannot be negative')
         self.log_level = self.default('LOG_LEVEL', 'info').upper()
         self.donation_address = self.default('DONATION_ADDRESS', '')
         self.drop_client = self.custom("DROP_CLIENT", None, re.compile)
@@ -81,6 +90,8 @@ class Env(EnvBase):
         self.cost_soft_limit = self.integer('COST_SOFT_LIMIT', 10000)
         self.cost_hard_limit = self.integer('COST_HARD_LIMIT', 100000)
         self.bw_unit_cost = self.integer('BANDWIDTH_UNIT_COST', 500)
+        self.cpu_unit_cost = self.integer('CPU_UNIT_COST', 1000)
+        self.db_read_unit_cost = self.integer('DB_READ_UNIT_COST', 10000)
         self.initial_concurrent = self.integer('INITIAL_CONCURRENT', 10)
         self.request_sleep = self.integer('REQUEST_SLEEP', 2500)
         self.request_timeout = self.integer('REQUEST_TIMEOUT', 30)
@@ -172,6 +183,12 @@ class Env(EnvBase):
 
         return services
 
+    def db_durability_enum(self):
+        durability = self.default('DB_DURABILITY', 'full').strip().lower()
+        if durability not in (self.DURABILITY_FULL, self.DURABILITY_GROUP):
+            raise self.Error(f'unknown DB_DURABILITY "{durability}"')
+        return durability
+
     def peer_discovery_enum(self):
         pd = self.default('PEER_DISCOVERY', 'on').strip().lower()
         if pd in ('off', ''):
@@ -11,30 +11,203 @@
 import array
 import ast
 import bisect
+import itertools
+import sys
 import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from electrumx.lib import util
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
 
 from electrumx.lib.util import (
-    pack_be_uint32, pack_le_uint64, unpack_be_uint32_from, unpack_le_uint64,
+    pack_be_uint16, pack_be_uint32, pack_le_uint32,
+    unpack_be_uint32_from, unpack_le_uint32,
 )
 
 
+# Keys of the per-flush journals of the hashXs written, followed by the
+# flush id.  Their length differs from history keys.
+JOURNAL_PREFIX = b'journal\0'
+
+
+def journal_key(flush_id):
+    return JOURNAL_PREFIX + pack_be_uint32(flush_id)
+
+
+# Appended to a hashX, the key of the count of its history entries.  It
+# sorts amongst the hashX's rows but differs in length from them, and
+# reads as flush id 0 so clear_excess() never deletes it.
+COUNT_SUFFIX = bytes(5)
+# The length of history row keys
+ROW_KEY_LEN = HASHX_LEN + 4
+
+# The memory taken by a hashX bytes object
+HASHX_SIZE = sys.getsizeof(bytes(HASHX_LEN))
+
+# History is compacted a 2-byte hashX prefix at a time
+COMP_CURSOR_END = 65536
+
+
+# From DB version 2 the count of each hashX's history entries is kept.
+# From DB version 1 a history row holds its first tx number followed by
+# the differences between successive tx numbers, each as a varint of 7
+# bits a byte, low bits first.  Version 0 rows hold 5-byte tx numbers.
+
+# NumPy is used, if installed, to decode rows longer than this in bytes;
+# it is slower for short rows
+NUMPY_MIN_ROW = 256
+
+def encode_txnums(tx_nums):
+    '''Return an ascending sequence of tx numbers as a history row.'''
+    row = bytearray()
+    append = row.append
+    prior = 0
+    for tx_num in tx_nums:
+        delta = tx_num - prior
+        prior = tx_num
+        while delta > 0x7f:
+            append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        append(delta)
+    return bytes(row)
+
+
+def decode_txnums(row):
+    '''Return the tx numbers of a history row as an array('Q').'''
+    result = array.array('Q')
+    if numpy is not None and len(row) > NUMPY_MIN_ROW:
+        data = numpy.frombuffer(row, numpy.uint8)
+        ends = numpy.flatnonzero(data < 0x80)
+        starts = numpy.empty_like(ends)
+        starts[0:1] = 0
+        starts[1:] = ends[:-1] + 1
+        shifts = numpy.arange(len(data)) - numpy.repeat(starts, ends - starts + 1)
+        parts = (data & 0x7f).astype(numpy.uint64) << (shifts * 7).astype(numpy.uint64)
+        result.frombytes(numpy.cumsum(numpy.add.reduceat(parts, starts)).tobytes())
+        return result
+
+    append = result.append
+    tx_num = delta = shift = 0
+    for byte in row:
+        if byte & 0x80:
+            delta |= (byte & 0x7f) << shift
+            shift += 7
+        else:
+            tx_num += delta | (byte << shift)
+            append(tx_num)
+            delta = shift = 0
+    return result
+
+
+def count_txnums(row):
+    '''Return the number of tx numbers in a history row.'''
+    # Each varint ends with the one byte that has the high bit clear
+    return len(row) - len(row.translate(None, LOW_BYTES))
+
+
+LOW_BYTES = bytes(range(0x80))
+
+
+def unpack_txnums(hist):
+    '''Return the concatenated 5-byte tx numbers hist as an array('Q').'''
+    result = array.array('Q')
+    if numpy is not None and len(hist) > NUMPY_MIN_ROW:
+        padded = numpy.zeros((len(hist) // 5, 8), numpy.uint8)
+        padded[:, :5] = numpy.frombuffer(hist, numpy.uint8).reshape(-1, 5)
+        result.frombytes(padded.tobytes())
+    else:
+        result.frombytes(b''.join(item + bytes(3) for item in util.chunks(hist, 5)))
+    return result
+
+
+def compact_hashX(hashX, hist_map, hist_list, max_row_entries,
+                  write_items, keys_to_delete):
+    '''Compact the history of a hashX.  hist_map maps its keys to its rows
+    and hist_list is the rows in order.  Add the rows to write to
+    write_items and the keys to delete to keys_to_delete.  Return a
+    (write_size, entry count, row count) tuple.'''
+    # Distribute history entries (tx numbers) over rows of up to
+    # max_row_entries each.  A fixed row length means future
+    # compactions will not need to update the first N - 1 rows.
+    full_hist = array.array('Q')
+    for hist in hist_list:
+        full_hist.extend(decode_txnums(hist))
+    nrows = (len(full_hist) + max_row_entries - 1) // max_row_entries
+
+    # Find what history needs to be written, and what keys need to
+    # be deleted.  Start by assuming all keys are to be deleted,
+    # and then remove those that are the same on-disk as when
+    # compacted.
+    write_size = 0
+    keys_to_delete.update(hist_map)
+    n = 0   # In case of no loops
+    for n, start in enumerate(range(0, len(full_hist), max_row_entries)):
+        chunk = encode_txnums(full_hist[start:start + max_row_entries])
+        key = hashX + pack_be_uint32(n)
+        if hist_map.get(key) == chunk:
+            keys_to_delete.remove(key)
+        else:
+            write_items.append((key, chunk))
+            write_size += len(chunk)
+
+    assert n + 1 == nrows
+    return write_size, len(full_hist), nrows
+
+
+def compact_rows(rows, max_row_entries):
+    '''Compact the history rows, a list of (key, row) pairs in key order
+    holding all the rows of their hashXs.  Run in worker processes by a
+    parallel compaction.  Return a (write_items, keys_to_delete,
+    write_size, max_rows) tuple.'''
+    write_items = []
+    keys_to_delete = set()
+    write_size = 0
+    max_rows = 0
+    for hashX, group in itertools.groupby(rows, key=lambda item: item[0][:-4]):
+        hist_map = dict(group)
+        size, _entries, nrows = compact_hashX(hashX, hist_map, list(hist_map.values()),
+                                              max_row_entries, write_items, keys_to_delete)
+        write_size += size
+        max_rows = max(max_rows, nrows)
+    return write_items, keys_to_delete, write_size, max_rows
+
+
 class History(object):
 
-    DB_VERSIONS = [0]
+    DB_VERSIONS = [0, 1, 2]
 
     def __init__(self):
         self.logger = util.class_logger(__name__, self.__class__.__name__)
         # For history compaction
         self.max_hist_row_entries = 12500
-        self.unflushed = defaultdict(bytearray)
-        self.unflushed_count = 0
+        # Unflushed history is held in columns.  unflushed_refs holds the
+        # index in unflushed_hashXs of the hashXs touched by each tx in
+        # turn, and unflushed_tx_ends the end of each tx's indices.  The
+        # first tx is unflushed_tx_num.  unflushed_index maps a hashX to
+        # its index.
+        self.unflushed_hashXs = []
+        self.unflushed_index = {}
+        self.unflushed_refs = array.array('I')
+        self.unflushed_tx_ends = array.array('I')
+        self.unflushed_tx_num = 0
         self.flush_count = 0
+        # Flush ids that have a journal on disk, and the flush count of
+        # the UTXO DB; journals up to it are no longer needed
+        self.journal_ids = []
+        self.utxo_flush_count = 0
         self.comp_flush_count = -1
         self.comp_cursor = -1
+        # The flush count when a compaction last completed
+        self.compacted_flush_count = 0
+        # If the current compaction keeps the flush count on completion
+        self.comp_keeps_flush_count = False
         self.db_version = max(self.DB_VERSIONS)
         self.upgrade_cursor = -1
         self.db = None
@@ -42,6 +215,10 @@ class History(object):
     def open_db(self, db_class, for_sync, utxo_flush_count, compacting):
         self.db = db_class('hist', for_sync)
         self.read_state()
+        self.journal_ids = [unpack_be_uint32_from(key, len(JOURNAL_PREFIX))[0]
+                            for key in self.db.iterator(prefix=JOURNAL_PREFIX,
+                                                        include_value=False)]
+        self.utxo_flush_count = utxo_flush_count
         self.clear_excess(utxo_flush_count)
         # An incomplete compaction needs to be cancelled otherwise
         # restarting it will corrupt the history
@@ -63,12 +240,18 @@ class History(object):
             self.flush_count = state['flush_count']
             self.comp_flush_count = state.get('comp_flush_count', -1)
             self.comp_cursor = state.get('comp_cursor', -1)
+            self.compacted_flush_count = state.get('compacted_flush_count', 0)
+            # Compactions by earlier versions used 4-byte prefixes and
+            # cannot be resumed
+            if state.get('comp_prefix_len') != 2:
+                self._cancel_compaction()
             self.db_version = state.get('db_version', 0)
             self.upgrade_cursor = state.get('upgrade_cursor', -1)
         else:
             self.flush_count = 0
             self.comp_flush_count = -1
             self.comp_cursor = -1
+            self.compacted_flush_count = 0
             self.db_version = max(self.DB_VERSIONS)
             self.upgrade_cursor = -1
 
@@ -88,21 +271,42 @@ class History(object):
         if self.flush_count <= utxo_flush_count:
             return
 
-        self.logger.info('DB shut down uncleanly.  Scanning for '
-                         'excess history flushes...')
-
-        keys = []
-        for key, _hist in self.db.iterator(prefix=b''):
-            flush_id, = unpack_be_uint32_from(key[-4:])
-            if flush_id > utxo_flush_count:
-                keys.append(key)
+        # Each flush journals the hashXs it wrote, so normally only the
+        # excess flushes' rows need deleting
+        excess_ids = range(utxo_flush_count + 1, self.flush_count + 1)
+        journals = self.db.multi_get([journal_key(flush_id) for flush_id in excess_ids])
+        if None not in journals:
+            self.logger.info(f'DB shut down uncleanly.  Removing {len(excess_ids):,d} '
+                             f'excess history flushes...')
+            keys = [journal_key(flush_id) for flush_id in excess_ids]
+            for flush_id, journal in zip(excess_ids, journals):
+                flush_idb = pack_be_uint32(flush_id)
+                keys.extend(hashX + flush_idb for hashX in util.chunks(journal, HASHX_LEN))
+        else:
+            self.logger.info('DB shut down uncleanly.  Scanning for '
+                             'excess history flushes...')
+            keys = []
+            for key in self.db.iterator(include_value=False, fill_cache=False):
+                flush_id, = unpack_be_uint32_from(key[-4:])
+                if flush_id > utxo_flush_count:
+                    keys.append(key)
 
         self.logger.info(f'deleting {len(keys):,d} history entries')
 
+        # Take the deleted entries off the hashXs' counts
+        row_keys = [key for key in keys if len(key) == ROW_KEY_LEN]
+        removed = defaultdict(int)
+        for key, row in zip(row_keys, self.db.multi_get(row_keys)):
+            if row is not None:
+                removed[key[:-4]] += count_txnums(row)
+
         self.flush_count = utxo_flush_count
+        self.journal_ids = [flush_id for flush_id in self.journal_ids
+                            if flush_id <= utxo_flush_count]
         with self.db.write_batch() as batch:
             for key in keys:
                 batch.delete(key)
+            self.write_counts(batch, {hashX: -count for hashX, count in removed.items()})
             self.write_state(batch)
 
         self.logger.info('deleted excess history entries')
@@ -113,6 +317,8 @@ class History(object):
             'flush_count': self.flush_count,
             'comp_flush_count': self.comp_flush_count,
             'comp_cursor': self.comp_cursor,
+            'comp_prefix_len': 2,
+            'compacted_flush_count': self.compacted_flush_count,
             'db_version': self.db_version,
             'upgrade_cursor': self.upgrade_cursor,
         }
@@ -120,38 +326,90 @@ class History(object):
         # look similar to other entries and aren't interfered with
         batch.put(b'state\0\0\0\0', repr(state).encode())
 
+    def write_counts(self, batch, deltas):
+        '''Add deltas, a map from hashX to a change in its number of history
+        entries, to the counts in the DB.'''
+        hashXs = sorted(deltas)
+        keys = [hashX + COUNT_SUFFIX for hashX in hashXs]
+        for hashX, key, value in zip(hashXs, keys, self.db.multi_get(keys)):
+            count = deltas[hashX] + (unpack_le_uint32(value)[0] if value else 0)
+            if count > 0:
+                batch.put(key, pack_le_uint32(count))
+            else:
+                batch.delete(key)
+
+    def get_count(self, hashX, *, snapshot=None):
+        '''Return the number of flushed history entries of a hashX.'''
+        value = (snapshot or self.db).get(hashX + COUNT_SUFFIX)
+        return unpack_le_uint32(value)[0] if value else 0
+
+    def write_journal(self, batch, hashXs):
+        '''Journal the hashXs of the current flush to the batch, and delete
+        the journals of flushes the UTXO DB has caught up with.'''
+        journal_ids = self.journal_ids
+        while journal_ids and journal_ids[0] <= self.utxo_flush_count:
+            batch.delete(journal_key(journal_ids.pop(0)))
+        batch.put(journal_key(self.flush_count), b''.join(hashXs))
+        journal_ids.append(self.flush_count)
+
     def add_unflushed(self, hashXs_by_tx, first_tx_num):
-        unflushed = self.unflushed
-        count = 0
-        for tx_num, hashXs in enumerate(hashXs_by_tx, start=first_tx_num):
-            tx_numb = pack_le_uint64(tx_num)[:5]
-            hashXs = set(hashXs)
-            for hashX in hashXs:
-                unflushed[hashX].extend(tx_numb)
-            count += len(hashXs)
-        self.unflushed_count += count
+        tx_ends = self.unflushed_tx_ends
+        if not tx_ends:
+            self.unflushed_tx_num = first_tx_num
+        assert first_tx_num == self.unflushed_tx_num + len(tx_ends)
+        unflushed_hashXs = self.unflushed_hashXs
+        index = self.unflushed_index
+        refs = self.unflushed_refs
+        for hashXs in hashXs_by_tx:
+            for hashX in set(hashXs):
+                ref = index.get(hashX)
+                if ref is None:
+                    ref = index[hashX] = len(unflushed_hashXs)
+                    unflushed_hashXs.append(hashX)
+                refs.append(ref)
+            tx_ends.append(len(refs))
 
     def unflushed_memsize(self):
-        return len(self.unflushed) * 180 + self.unflushed_count * 5
+        hashXs = self.unflushed_hashXs
+        return (sys.getsizeof(self.unflushed_index) + sys.getsizeof(hashXs)
+                + len(hashXs) * HASHX_SIZE
+                + self.unflushed_refs.buffer_info()[1] * self.unflushed_refs.itemsize
+                + self.unflushed_tx_ends.buffer_info()[1] * self.unflushed_tx_ends.itemsize)
 
     def assert_flushed(self):
-        assert not self.unflushed
+        assert not self.unflushed_tx_ends
 
-    def flush(self):
+    def flush(self, sync=True):
         start_time = time.monotonic()
-        self.flush_count += 1
+        # Compacted rows use flush ids up to comp_flush_count
+        self.flush_count = max(self.flush_count, self.comp_flush_count) + 1
         flush_id = pack_be_uint32(self.flush_count)
-        unflushed = self.unflushed
-
-        with self.db.write_batch() as batch:
-            for hashX in sorted(unflushed):
-                key = hashX + flush_id
-                batch.put(key, bytes(unflushed[hashX]))
+        unflushed_hashXs = self.unflushed_hashXs
+
+        # Group the tx numbers by hashX; they are already in order
+        histories = [[] for _ in unflushed_hashXs]
+        refs = self.unflushed_refs
+        start = 0
+        for tx_num, end in enumerate(self.unflushed_tx_ends, start=self.unflushed_tx_num):
+            for ref in refs[start:end]:
+                histories[ref].append(tx_num)
+            start = end
+        order = sorted(range(len(unflushed_hashXs)), key=unflushed_hashXs.__getitem__)
+        hashXs = [unflushed_hashXs[ref] for ref in order]
+
+        with self.db.write_batch(sync=sync) as batch:
+            for hashX, ref in zip(hashXs, order):
+                batch.put(hashX + flush_id, encode_txnums(histories[ref]))
+            self.write_counts(batch, {hashX: len(hist) for hashX, hist
+                                      in zip(unflushed_hashXs, histories)})
+            self.write_journal(batch, hashXs)
             self.write_state(batch)
 
-        count = len(unflushed)
-        unflushed.clear()
-        self.unflushed_count = 0
+        count = len(unflushed_hashXs)
+        self.unflushed_hashXs = []
+        self.unflushed_index = {}
+        self.unflushed_refs = array.array('I')
+        self.unflushed_tx_ends = array.array('I')
 
         if self.db.for_sync:
             elapsed = time.monotonic() - start_time
@@ -163,20 +421,23 @@ class History(object):
         self.flush_count += 1
         nremoves = 0
         bisect_left = bisect.bisect_left
-        chunks = util.chunks
+        removed = {}
 
         with self.db.write_batch() as batch:
             for hashX in sorted(hashXs):
                 deletes = []
                 puts = {}
+                removed[hashX] = 0
                 for key, hist in self.db.iterator(prefix=hashX, reverse=True):
-                    a = array.array('Q')
-                    a.frombytes(b''.join(item + bytes(3) for item in chunks(hist, 5)))
+                    if len(key) != ROW_KEY_LEN:
+                        continue
+                    a = decode_txnums(hist)
                     # Remove all history entries >= tx_count
                     idx = bisect_left(a, tx_count)
                     nremoves += len(a) - idx
+                    removed[hashX] -= len(a) - idx
                     if idx > 0:
-                        puts[key] = hist[:5 * idx]
+                        puts[key] = encode_txnums(a[:idx])
                         break
                     deletes.append(key)
 
@@ -184,24 +445,59 @@ class History(object):
                     batch.delete(key)
                 for key, value in puts.items():
                     batch.put(key, value)
+            self.write_counts(batch, removed)
+            # Backing up only rewrites rows of earlier flushes
+            self.write_journal(batch, [])
             self.write_state(batch)
 
         self.logger.info(f'backing up removed {nremoves:,d} history entries')
 
-    def get_txnums(self, hashX, limit=1000):
-        '''Generator that returns an unpruned, sorted list of tx_nums in the
+    def get_txnum_array(self, hashX, limit=1000, *, snapshot=None):
+        '''Return an unpruned, sorted array('Q') of the tx_nums in the
         history of a hashX.  Includes both spending and receiving
-        transactions.  By default yields at most 1000 entries.  Set
-        limit to None to get them all.  '''
+        transactions.  By default returns at most 1000 entries.  Set
+        limit to None to get them all.  If snapshot is given the
+        history is read from it rather than the live DB.'''
         limit = util.resolve_limit(limit)
-        chunks = util.chunks
-        for _key, hist in self.db.iterator(prefix=hashX):
-            for tx_numb in chunks(hist, 5):
-                if limit == 0:
-                    return
-                tx_num, = unpack_le_uint64(tx_numb + bytes(3))
-                yield tx_num
-                limit -= 1
+        tx_nums = array.array('Q')
+        if limit == 0:
+            return tx_nums
+        db = snapshot or self.db
+        for key, hist in db.iterator(prefix=hashX):
+            if len(key) != ROW_KEY_LEN:
+                continue
+            tx_nums.extend(decode_txnums(hist))
+            if 0 < limit <= len(tx_nums):
+                del tx_nums[limit:]
+                break
+        return tx_nums
+
+    def get_txnums(self, hashX, limit=1000, *, snapshot=None):
+        '''Generator that returns an unpruned, sorted list of tx_nums in the
+        history of a hashX, as for get_txnum_array().'''
+        yield from self.get_txnum_array(hashX, limit, snapshot=snapshot)
+
+    def get_txnum_tail(self, hashX, tx_num, *, snapshot=None):
+        '''Return a sorted array('Q') of the tx_nums in the history of a
+        hashX that are greater than tx_num, or the whole history if tx_num
+        is negative.  Rows are read newest first so only the tail of a
+        long history is decoded.'''
+        if tx_num < 0:
+            return self.get_txnum_array(hashX, None, snapshot=snapshot)
+        rows = []
+        db = snapshot or self.db
+        for key, hist in db.iterator(prefix=hashX, reverse=True):
+            if len(key) != ROW_KEY_LEN:
+                continue
+            row = decode_txnums(hist)
+            rows.append(row)
+            if row and row[0] <= tx_num:
+                break
+        tx_nums = array.array('Q')
+        for row in reversed(rows):
+            tx_nums.extend(row)
+        del tx_nums[:bisect.bisect_right(tx_nums, tx_num)]
+        return tx_nums
 
     #
     # History compaction
@@ -220,13 +516,38 @@ class History(object):
     #     are used, so a parallel history flush must first increment this
     #
     # When compaction is complete and the final flush takes place,
-    # flush_count is reset to comp_flush_count, and comp_flush_count to -1
+    # flush_count is reset to comp_flush_count, and comp_flush_count to -1.
+    # Online compactions keep the flush count instead, as history flushed
+    # whilst compacting has later flush ids.
+
+    def compaction_progress(self):
+        '''Return the percentage complete of the compaction in progress, or
+        None if there is none.'''
+        if self.comp_cursor == -1:
+            return None
+        return 100 * self.comp_cursor / COMP_CURSOR_END
+
+    def start_compaction(self, online=False):
+        '''Start a compaction unless one is in progress.  An online
+        compaction runs whilst history is being flushed.'''
+        if self.comp_cursor == -1:
+            self.comp_cursor = 0
+        self.comp_keeps_flush_count = online
+        self.comp_flush_count = max(self.comp_flush_count, 1)
 
     def _flush_compaction(self, cursor, write_items, keys_to_delete):
         '''Flush a single compaction pass as a batch.'''
         # Update compaction state
-        if cursor == (2**8)**4:  # 65536:
-            self.flush_count = self.comp_flush_count
+        if cursor == COMP_CURSOR_END:
+            if self.comp_keeps_flush_count:
+                self.flush_count = max(self.flush_count, self.comp_flush_count)
+            else:
+                self.flush_count = self.comp_flush_count
+                # Flush ids restart so the journals no longer apply
+                keys_to_delete.update(journal_key(flush_id)
+                                      for flush_id in self.journal_ids)
+                self.journal_ids.clear()
+            self.compacted_flush_count = self.flush_count
             self.comp_cursor = -1
             self.comp_flush_count = -1
         else:
@@ -245,37 +566,14 @@ class History(object):
                        write_items, keys_to_delete):
         '''Compres history for a hashX.  hist_list is an ordered list of
         the histories to be compressed.'''
-        # History entries (tx numbers) are 4 bytes each.  Distribute
-        # over rows of up to 50KB in size.  A fixed row size means
-        # future compactions will not need to update the first N - 1
-        # rows.
-        max_row_size = self.max_hist_row_entries * 5
-        full_hist = b''.join(hist_list)
-        nrows = (len(full_hist) + max_row_size - 1) // max_row_size
+        write_size, entries, nrows = compact_hashX(
+            hashX, hist_map, hist_list, self.max_hist_row_entries,
+            write_items, keys_to_delete)
         if nrows > 4:
             self.logger.info('hashX {} is large: {:,d} entries across '
                              '{:,d} rows'
-                             .format(hash_to_hex_str(hashX),
-                                     len(full_hist) // 5, nrows))
-
-        # Find what history needs to be written, and what keys need to
-        # be deleted.  Start by assuming all keys are to be deleted,
-        # and then remove those that are the same on-disk as when
-        # compacted.
-        write_size = 0
-        keys_to_delete.update(hist_map)
-        n = 0   # In case of no loops
-        for n, chunk in enumerate(util.chunks(full_hist, max_row_size)):
-            key = hashX + pack_be_uint32(n)
-            if hist_map.get(key) == chunk:
-                keys_to_delete.remove(key)
-            else:
-                write_items.append((key, chunk))
-                write_size += len(chunk)
-
-        assert n + 1 == nrows
-        self.comp_flush_count = max(self.comp_flush_count, n)
-
+                             .format(hash_to_hex_str(hashX), entries, nrows))
+        self.comp_flush_count = max(self.comp_flush_count, nrows - 1)
         return write_size
 
     def _compact_prefix(self, prefix, write_items, keys_to_delete):
@@ -285,11 +583,10 @@ class History(object):
         hist_map = {}
         hist_list = []
 
-        key_len = HASHX_LEN + 4
         write_size = 0
-        for key, hist in self.db.iterator(prefix=prefix):
+        for key, hist in self.db.iterator(prefix=prefix, fill_cache=False):
             # Ignore non-history entries
-            if len(key) != key_len:
+            if len(key) != ROW_KEY_LEN:
                 continue
             hashX = key[:-4]
             if hashX != prior_hashX and prior_hashX:
@@ -307,9 +604,9 @@ class History(object):
                                               write_items, keys_to_delete)
         return write_size
 
-    def _compact_history(self, limit):
+    def _compact_history(self, limit, max_prefixes=COMP_CURSOR_END):
         '''Inner loop of history compaction.  Loops until limit bytes have
-        been processed.
+        been processed, or max_prefixes prefixes compacted.
         '''
         keys_to_delete = set()
         write_items = []   # A list of (key, value) pairs
@@ -317,8 +614,9 @@ class History(object):
 
         # Loop over 2-byte prefixes
         cursor = self.comp_cursor
-        while write_size < limit and cursor < (2**8)**4:  # 65536:
-            prefix = pack_be_uint32(cursor)
+        end = min(cursor + max_prefixes, COMP_CURSOR_END)
+        while write_size < limit and cursor < end:
+            prefix = pack_be_uint16(cursor)
             write_size += self._compact_prefix(prefix, write_items,
                                                keys_to_delete)
             cursor += 1
@@ -326,13 +624,78 @@ class History(object):
         max_rows = self.comp_flush_count + 1
         self._flush_compaction(cursor, write_items, keys_to_delete)
 
-        self.logger.info('history compaction: wrote {:,d} rows ({:.1f} MB), '
-                         'removed {:,d} rows, largest: {:,d}, {:.1f}% complete'
-                         .format(len(write_items), write_size / 1000000,
-                                 len(keys_to_delete), max_rows,
-                                 100 * cursor / ((2**8)**4)))
+        if self.db.for_sync:
+            self.logger.info('history compaction: wrote {:,d} rows ({:.1f} MB), '
+                             'removed {:,d} rows, largest: {:,d}, {:.1f}% complete'
+                             .format(len(write_items), write_size / 1000000,
+                                     len(keys_to_delete), max_rows,
+                                     100 * cursor / COMP_CURSOR_END))
         return write_size
 
+    def _read_compaction_rows(self, snapshot, cursor, limit, max_prefixes):
+        '''Read the history rows of the prefixes from cursor for a
+        compaction step from a snapshot or the DB, until limit bytes have
+        been read or max_prefixes prefixes.  Return a (rows, cursor)
+        pair, cursor being the first prefix not read.
+
+        Prefixes with rows of flushes the UTXO DB has not caught up with
+        are skipped: compacted to lower flush ids, clear_excess() could
+        not remove those rows after a crash.  They are compacted next
+        time.'''
+        rows = []
+        read_size = 0
+        utxo_flush_count = self.utxo_flush_count
+        end = min(cursor + max_prefixes, COMP_CURSOR_END)
+        while read_size < limit and cursor < end:
+            prefix_rows = []
+            for key, hist in snapshot.iterator(prefix=pack_be_uint16(cursor),
+                                               fill_cache=False):
+                read_size += len(key) + len(hist)
+                # Ignore non-history entries
+                if len(key) != ROW_KEY_LEN:
+                    continue
+                if unpack_be_uint32_from(key, HASHX_LEN)[0] > utxo_flush_count:
+                    break
+                prefix_rows.append((key, hist))
+            else:
+                rows.extend(prefix_rows)
+            cursor += 1
+        return rows, cursor
+
+    def _compact_history_parallel(self, workers, limit, shard_size=64):
+        '''Run the compaction to completion with worker processes.
+
+        The prefix space is split into shards of up to shard_size
+        prefixes, a shard ending early once limit bytes of its rows are
+        read.  At most workers + 1 shards are held at once, bounding
+        memory whatever the size of the DB.  The rows of each shard are
+        read here, as LevelDB lets only one process open a DB, and
+        compacted by a worker; the results are flushed in prefix order
+        so comp_cursor only passes shards that are complete.  Workers
+        are spawned rather than forked so they do not inherit the open
+        DB.'''
+        pending = {}
+        read_cursor = self.comp_cursor
+        with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as executor:
+            while self.comp_cursor != -1:
+                # Keep every worker busy with a shard queued behind it
+                while len(pending) <= workers and read_cursor < COMP_CURSOR_END:
+                    rows, end = self._read_compaction_rows(self.db, read_cursor, limit,
+                                                           shard_size)
+                    future = executor.submit(compact_rows, rows, self.max_hist_row_entries)
+                    pending[read_cursor] = (end, future)
+                    read_cursor = end
+
+                end, future = pending.pop(self.comp_cursor)
+                write_items, keys_to_delete, write_size, max_rows = future.result()
+                self.comp_flush_count = max(self.comp_flush_count, max_rows - 1)
+                self._flush_compaction(end, write_items, keys_to_delete)
+                self.logger.info('history compaction: wrote {:,d} rows ({:.1f} MB), '
+                                 'removed {:,d} rows, largest: {:,d}, {:.1f}% complete'
+                                 .format(len(write_items), write_size / 1000000,
+                                         len(keys_to_delete), max_rows,
+                                         100 * end / COMP_CURSOR_END))
+
     def _cancel_compaction(self):
         if self.comp_cursor != -1:
             self.logger.warning('cancelling in-progress history compaction')
@@ -344,4 +707,47 @@ class History(object):
     #
 
     def upgrade_db(self):
-        pass
\ No newline at end of file
+        self.logger.info(f'history DB version: {self.db_version}')
+        self.logger.info('Upgrading your history DB; this can take some time...')
+
+        # Version 0 rows are delta encoded; all versions get entry counts
+        def upgrade_cursor(cursor):
+            count = 0
+            prefix = pack_be_uint16(cursor)
+            counts = defaultdict(int)
+            # The final state write is synced
+            with self.db.write_batch(sync=False) as batch:
+                batch_put = batch.put
+                for key, hist in self.db.iterator(prefix=prefix, fill_cache=False):
+                    # Ignore non-history entries
+                    if len(key) != ROW_KEY_LEN:
+                        continue
+                    count += 1
+                    if self.db_version == 0:
+                        tx_nums = unpack_txnums(hist)
+                        batch_put(key, encode_txnums(tx_nums))
+                        counts[key[:-4]] += len(tx_nums)
+                    else:
+                        counts[key[:-4]] += count_txnums(hist)
+                for hashX, hashX_count in counts.items():
+                    batch_put(hashX + COUNT_SUFFIX, pack_le_uint32(hashX_count))
+                self.upgrade_cursor = cursor
+                self.write_state(batch)
+            return count
+
+        last = time.monotonic()
+        count = 0
+
+        for cursor in range(self.upgrade_cursor + 1, COMP_CURSOR_END):
+            count += upgrade_cursor(cursor)
+            now = time.monotonic()
+            if now > last + 10:
+                last = now
+                self.logger.info(f'history DB: {count:,d} rows upgraded, '
+                                 f'{cursor * 100 / COMP_CURSOR_END:.1f}% complete')
+
+        self.db_version = max(self.DB_VERSIONS)
+        self.upgrade_cursor = -1
+        with self.db.write_batch() as batch:
+            self.write_state(batch)
+        self.logger.info('history DB upgraded successfully')
\ No newline at end of file
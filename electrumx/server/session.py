@@ -8,28 +8,29 @@
 '''Classes for local RPC server and remote client TCP/SSL servers.'''
 import asyncio
 import codecs
+import hashlib
 import itertools
 import json
-import math
 import os
 import ssl
 import time
 import re
+import sys
+from array import array
 from typing import Iterable, Dict, Optional, TYPE_CHECKING
-from collections import defaultdict
+from collections import defaultdict, deque
 from functools import partial
 from ipaddress import IPv4Address, IPv6Address
 
 import attr
 import pylru
-from aiorpcx import (Event, JSONRPCAutoDetect, JSONRPCConnection,
-                     ReplyAndDisconnect, Request, RPCError, RPCSession,
-                     handler_invocation, serve_rs, serve_ws, sleep,
+from aiorpcx import (Event, JSONRPCAutoDetect, JSONRPCConnection, JSONRPCLoose,
+                     JSONRPCv1, JSONRPCv2, Notification, ReplyAndDisconnect, Request,
+                     RPCError, RPCSession, handler_invocation, serve_rs, serve_ws, sleep,
                      NewlineFramer, TaskGroup)
 
 import electrumx
 
-from electrumx.lib.merkle import MerkleCache
 from electrumx.lib.text import sessions_lines
 from electrumx.lib import util
 from electrumx.lib.hash import (sha256, hash_to_hex_str, hex_str_to_hash, HASHX_LEN, Base58Error,
@@ -121,9 +122,114 @@ class SessionReferences:
     unknown = attr.ib()     # Strings
 
 
+class CompactHistory:
+    '''A confirmed history held as its concatenated tx hashes and an array
+    of heights.  Iterating yields (tx_hash, height) pairs.'''
+
+    __slots__ = ('tx_hashes', 'heights')
+
+    def __init__(self, history):
+        self.tx_hashes = b''.join(tx_hash for tx_hash, _height in history)
+        self.heights = array('I', (height for _tx_hash, height in history))
+
+    def __len__(self):
+        return len(self.heights)
+
+    def __iter__(self):
+        tx_hashes = self.tx_hashes
+        for n, height in enumerate(self.heights):
+            yield tx_hashes[n * 32: n * 32 + 32], height
+
+    def memsize(self):
+        return (sys.getsizeof(self) + sys.getsizeof(self.tx_hashes)
+                + sys.getsizeof(self.heights))
+
+
+HASH_SIZE = sys.getsizeof(bytes(32))
+
+
+def tx_hashes_memsize(tx_hashes):
+    return sys.getsizeof(tx_hashes) + len(tx_hashes) * HASH_SIZE
+
+
+def merkle_levels_memsize(levels):
+    return sum(sys.getsizeof(level) + len(level) * HASH_SIZE for level in levels)
+
+
+class MethodStats:
+    '''Histograms of the queue wait, handler, client thread pool and daemon
+    times, in microseconds, and response sizes, in bytes, of requests of
+    one method.'''
+
+    __slots__ = ('queue', 'handler', 'pool', 'daemon', 'size')
+
+    def __init__(self):
+        self.queue = util.Histogram()
+        self.handler = util.Histogram()
+        self.pool = util.Histogram()
+        self.daemon = util.Histogram()
+        self.size = util.Histogram()
+
+    def record(self, usage):
+        self.queue.record(usage.queue_time * 1_000_000)
+        if usage.handler_time is not None:
+            self.handler.record(usage.handler_time * 1_000_000)
+        self.pool.record(usage.pool_time * 1_000_000)
+        self.daemon.record(usage.daemon_time * 1_000_000)
+        self.size.record(usage.response_size)
+
+    def summary(self):
+        '''A one-line summary of the p50 and p99 of each histogram.'''
+        def ms(histogram):
+            return '/'.join('-' if value is None else f'{value / 1000:,.1f}'
+                            for value in (histogram.percentile(0.5),
+                                          histogram.percentile(0.99)))
+
+        size = '/'.join('-' if value is None else f'{value:,d}'
+                        for value in (self.size.percentile(0.5), self.size.percentile(0.99)))
+        return (f'{self.queue.count:,d} reqs p50/p99 handler {ms(self.handler)} ms '
+                f'queue {ms(self.queue)} ms pool {ms(self.pool)} ms '
+                f'daemon {ms(self.daemon)} ms size {size} bytes')
+
+
+def redact_params(args):
+    '''Describe request arguments without revealing them.  Numbers,
+    booleans and None are kept; other values are replaced by their type
+    and length, so addresses, script hashes and transactions do not
+    appear in the slow request log.'''
+    def redact(value):
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        try:
+            return f'<{type(value).__name__} len {len(value):,d}>'
+        except TypeError:
+            return f'<{type(value).__name__}>'
+
+    if isinstance(args, dict):
+        return {name: redact(value) for name, value in args.items()}
+    return [redact(value) for value in args]
+
+
+@attr.s(slots=True)
+class RetainedStatus:
+    # The sha256 state of the confirmed history, whose last entry is tx_num
+    hasher = attr.ib()
+    count = attr.ib()
+    tx_num = attr.ib()
+    tx_hash = attr.ib()
+
+
 class SessionManager:
     '''Holds global state about all sessions.'''
 
+    # Confirmed history length from which status hash states are retained
+    RETAINED_STATUS_MIN_COUNT = 100
+    # Bounds of the estimated memory use of caches, in bytes
+    HISTORY_CACHE_SIZE = 128_000_000
+    TX_HASHES_CACHE_SIZE = 64_000_000
+    MERKLE_CACHE_SIZE = 64_000_000
+    HEADER_CACHE_SIZE = 64_000_000
+
     def __init__(self, env, db, bp, daemon, mempool, shutdown_event):
         env.max_send = max(350000, env.max_send)
         self.env = env
@@ -141,28 +247,59 @@ class SessionManager:
         # Would use monotonic time, but aiorpcx sessions use Unix time:
         self.start_time = time.time()
         self._method_counts = defaultdict(int)
+        self._method_stats = defaultdict(MethodStats)
+        # Recent requests slower than SLOWLOG_THRESHOLD
+        self._slow_requests = deque(maxlen=env.slowlog_size)
         self._reorg_count = 0
-        self._history_cache = pylru.lrucache(300000)
-        self._history_lookups = 0
-        self._history_hits = 0
-        self._tx_hashes_cache = pylru.lrucache(300000)
-        self._tx_hashes_lookups = 0
-        self._tx_hashes_hits = 0
-        # Really a MerkleCache cache
-        self._merkle_cache = pylru.lrucache(300000)
-        self._merkle_lookups = 0
-        self._merkle_hits = 0
+        self._history_cache = util.LRUCache(self.HISTORY_CACHE_SIZE,
+                                            CompactHistory.memsize)
+        self._tx_hashes_cache = util.LRUCache(self.TX_HASHES_CACHE_SIZE, tx_hashes_memsize)
+        # Block height -> levels of its merkle tree
+        self._merkle_cache = util.LRUCache(self.MERKLE_CACHE_SIZE, merkle_levels_memsize)
+        # Immutable header chunks as hex by start height.  Never evicted, so
+        # clients syncing the whole chain do not evict each other's chunks;
+        # they take at most twice the size of the headers file.
+        self._header_chunks = {}
+        self._header_chunks_size = 0
+        # Header merkle proofs
+        self._header_cache = util.LRUCache(self.HEADER_CACHE_SIZE, util.deep_getsizeof)
+        # Address statuses shared by all sessions, invalidated per hashX by the
+        # touched sets passed to _notify_sessions.  Values are (status, cost,
+        # in_mempool) triples.
+        self._status_cache = pylru.lrucache(100000)
+        self._status_futures = {}
+        self._status_lookups = 0
+        self._status_hits = 0
+        self._retained_statuses = pylru.lrucache(20000)
         self.estimatefee_cache = pylru.lrucache(300000)
+        # Caches of asset DB lookups by kind, invalidated per key by the
+        # touched sets passed to _notify_sessions.  They hold DB results
+        # only; mempool data is overlaid by the caller.
+        self._asset_caches = {kind: pylru.lrucache(50000) for kind in (
+            'meta', 'frozen', 'verifier', 'associations', 'qualifier_tags',
+            'h160_tags', 'broadcasts')}
+        self._asset_cache_generation = 0
+        self._asset_lookups = 0
+        self._asset_hits = 0
+        # Reverse subscription indexes: kind->key->sessions
+        self._subscribers = {kind: {} for kind in (
+            'hashX', 'asset', 'qualifier_tags', 'h160_tags', 'broadcasts', 'frozen',
+            'verifier', 'associations')}
         self.notified_height = None
         self.hsub_results = None
+        # The headers notification of hsub_results encoded by JSON RPC protocol
+        self.hsub_messages = {}
+        # Notification messages encoded once for all sessions, by (protocol,
+        # method, args); cleared each notification cycle
+        self._notification_messages = {}
         self._sslc = None
         # Event triggered when electrumx is listening for incoming requests.
         self.server_listening = Event()
         self.session_event = Event()
 
         # Set up the RPC request handlers
-        cmds = ('add_peer daemon_url disconnect getinfo groups log peers '
-                'query reorg sessions stop'.split())
+        cmds = ('add_peer daemon_url dbstats disconnect getinfo groups log peers '
+                'query reorg sessions slowlog stop'.split())
         self.rpc_request_handlers = {cmd: getattr(self, 'rpc_' + cmd)
                                      for cmd in cmds}
 
@@ -277,6 +414,8 @@ class SessionManager:
             self._reorg_count += 1
             self._tx_hashes_cache.clear()
             self._merkle_cache.clear()
+            self._header_cache.clear()
+            self._retained_statuses.clear()
 
     async def _recalc_concurrency(self):
         '''Periodically recalculate session concurrency.'''
@@ -314,20 +453,30 @@ class SessionManager:
             return f'{lookups:,d} lookups {hits:,d} hits {size:,d}/{capacity:,d} entries ({usage_pct:.1f}%)'
         
         sessions = self.sessions
+        asset_entries = sum(len(cache) for cache in self._asset_caches.values())
         return {
+            'asset cache': (f'{self._asset_lookups:,d} lookups {self._asset_hits:,d} hits '
+                            f'{asset_entries:,d} entries'),
             'coin': self.env.coin.__name__,
             'daemon': self.daemon.logged_url(),
             'daemon height': self.daemon.cached_height(),
             'db height': self.db.state.height,
+            'db stats': self.db.storage_stats.summary() if self.db.storage_stats else None,
             'db_flush_count': self.db.history.flush_count,
             'groups': len(self.session_groups),
-            'history cache': cache_info(
-                self._history_cache, self._history_lookups, self._history_hits),
-            'merkle cache': cache_info(
-                self._merkle_cache, self._merkle_lookups, self._merkle_hits),
+            'header cache': self._header_cache.info(),
+            'header chunks': (f'{len(self._header_chunks):,d} chunks '
+                              f'{self._header_chunks_size / 1_000_000:,.1f} MB'),
+            'history compaction': self._compaction_info(),
+            'history cache': self._history_cache.info(),
+            'merkle cache': self._merkle_cache.info(),
             'pid': os.getpid(),
             'peers': self.peer_mgr.info(),
             'request counts': self._method_counts,
+            'request latency': {method: stats.summary()
+                                for method, stats in sorted(self._method_stats.items())},
+            'status cache': cache_info(
+                self._status_cache, self._status_lookups, self._status_hits),
             'request total': sum(self._method_counts.values()),
             'sessions': {
                 'count': len(sessions),
@@ -337,13 +486,39 @@ class SessionManager:
                 'pending requests': sum(s.unanswered_request_count() for s in sessions),
                 'subs': sum(s.sub_count() for s in sessions),
             },
-            'tx hashes cache': cache_info(
-                self._tx_hashes_cache, self._tx_hashes_lookups, self._tx_hashes_hits),
+            'tx hashes cache': self._tx_hashes_cache.info(),
             'txs sent': self.txs_sent,
             'uptime': util.formatted_time(time.time() - self.start_time),
             'version': electrumx.version,
         }
 
+    def record_request(self, session, method, args, usage):
+        '''Record the usage of a completed request of the session.'''
+        self._method_stats[method].record(usage)
+        elapsed = usage.queue_time + (usage.handler_time or 0)
+        if elapsed * 1000 >= self.env.slowlog_threshold:
+            self._slow_requests.append((
+                time.time(), session.session_id, method, redact_params(args),
+                elapsed, usage.queue_time, usage.handler_time, usage.pool_time,
+                usage.daemon_time, usage.response_size))
+
+    def _slowlog_data(self):
+        '''Returned to the RPC 'slowlog' call.'''
+        now = time.time()
+        return [(session_id, method, params, now - when,
+                 *(None if value is None else round(value * 1000, 1)
+                   for value in (elapsed, queue_time, handler_time, pool_time, daemon_time)),
+                 size)
+                for (when, session_id, method, params, elapsed, queue_time, handler_time,
+                     pool_time, daemon_time, size)
+                in sorted(self._slow_requests, key=lambda item: item[4], reverse=True)]
+
+    def _compaction_info(self):
+        progress = self.db.history.compaction_progress()
+        if progress is None:
+            return 'idle'
+        return f'{progress:.1f}% complete'
+
     def _session_data(self, for_log):
         '''Returned to the RPC 'sessions' call.'''
         now = time.time()
@@ -390,8 +565,25 @@ class SessionManager:
         height = min(height, self.db.state.height)
         raw = await self.raw_header(height)
         self.hsub_results = {'hex': raw.hex(), 'height': height}
+        notification = Notification('blockchain.headers.subscribe', (self.hsub_results, ))
+        self.hsub_messages = {protocol: protocol.notification_message(notification)
+                              for protocol in (JSONRPCv1, JSONRPCv2, JSONRPCLoose)}
         self.notified_height = height
 
+    def notification_message(self, protocol, method, args):
+        '''Return the encoded message of a notification.  Notifications with
+        hashable args are encoded once per notification cycle and the
+        message is shared by all sessions using the protocol.'''
+        key = (protocol, method, args)
+        try:
+            return self._notification_messages[key]
+        except KeyError:
+            message = protocol.notification_message(Notification(method, args))
+            self._notification_messages[key] = message
+            return message
+        except TypeError:
+            return protocol.notification_message(Notification(method, args))
+
     def _session_references(self, items, special_strings):
         '''Return a SessionReferences object.'''
         if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
@@ -435,6 +627,12 @@ class SessionManager:
         await self.peer_mgr.add_localRPC_peer(real_name)
         return "peer '{}' added".format(real_name)
 
+    async def rpc_dbstats(self):
+        '''Return read and write statistics by database and key prefix.'''
+        if not self.db.storage_stats:
+            raise RPCError(BAD_REQUEST, 'DB_STATS is disabled')
+        return self.db.storage_stats.rpc_data()
+
     async def rpc_disconnect(self, session_ids):
         '''Disconnect sesssions.
 
@@ -513,6 +711,10 @@ class SessionManager:
         '''Return summary information about the server process.'''
         return self._get_info()
 
+    async def rpc_slowlog(self):
+        '''Return the recent slow requests, slowest first.'''
+        return self._slowlog_data()
+
     async def rpc_groups(self):
         '''Return statistics about the session groups.'''
         return self._group_data()
@@ -602,6 +804,8 @@ class SessionManager:
             session_class.cost_hard_limit = self.env.cost_hard_limit
             session_class.cost_decay_per_sec = session_class.cost_hard_limit / 10000
             session_class.bw_cost_per_byte = 1.0 / self.env.bw_unit_cost
+            session_class.cpu_cost_per_sec = 1_000_000 / self.env.cpu_unit_cost
+            session_class.db_cost_per_byte = 1.0 / self.env.db_read_unit_cost
             session_class.cost_sleep = self.env.request_sleep / 1000
             session_class.initial_concurrent = self.env.initial_concurrent
             session_class.processing_timeout = self.env.request_timeout
@@ -611,6 +815,8 @@ class SessionManager:
             self.logger.info(f'session cost hard limit {self.env.cost_hard_limit:,d}')
             self.logger.info(f'session cost soft limit {self.env.cost_soft_limit:,d}')
             self.logger.info(f'bandwidth unit cost {self.env.bw_unit_cost:,d}')
+            self.logger.info(f'CPU unit cost {self.env.cpu_unit_cost:,d}us')
+            self.logger.info(f'DB read unit cost {self.env.db_read_unit_cost:,d}')
             self.logger.info(f'request sleep {self.env.request_sleep:,d}ms')
             self.logger.info(f'request timeout {self.env.request_timeout:,d}s')
             self.logger.info(f'initial concurrent {self.env.initial_concurrent:,d}')
@@ -662,27 +868,16 @@ class SessionManager:
         return sum((group.cost() - session.cost) * group.weight for group in groups)
 
     async def _merkle_branch(self, height, tx_hashes, tx_pos, tsc_format=False):
-        tx_hash_count = len(tx_hashes)
-        cost = tx_hash_count
-
-        if tx_hash_count >= 200:
-            self._merkle_lookups += 1
-            merkle_cache = self._merkle_cache.get(height)
-            if merkle_cache:
-                self._merkle_hits += 1
-                cost = 10 * math.sqrt(tx_hash_count)
-            else:
-                async def tx_hashes_func(start, count):
-                    return tx_hashes[start: start + count]
-
-                merkle_cache = MerkleCache(self.db.merkle, tx_hashes_func)
-                self._merkle_cache[height] = merkle_cache
-                await merkle_cache.initialize(len(tx_hashes))
-            branch, root = await merkle_cache.branch_and_root(tx_hash_count, tx_pos,
-                                                              tsc_format=tsc_format)
+        # The tree of a block is built once and all its branches taken from it
+        levels = self._merkle_cache.get(height)
+        if levels is None:
+            levels = self.db.merkle.levels(tx_hashes)
+            self._merkle_cache[height] = levels
+            cost = len(tx_hashes)
         else:
-            branch, root = self.db.merkle.branch_and_root(tx_hashes, tx_pos,
-                                                          tsc_format=tsc_format)
+            cost = len(levels)
+        branch, root = self.db.merkle.branch_and_root_from_levels(levels, tx_pos,
+                                                                  tsc_format=tsc_format)
 
         if tsc_format:
             def converter(_hash):
@@ -788,10 +983,8 @@ class SessionManager:
         tx_hashes is an ordered list of binary hashes, cost is an estimated cost of
         getting the hashes; cheaper if in-cache.  Raises RPCError.
         '''
-        self._tx_hashes_lookups += 1
         tx_hashes = self._tx_hashes_cache.get(height)
         if tx_hashes:
-            self._tx_hashes_hits += 1
             return tx_hashes, 0.1
 
         # Ensure the tx_hashes are fresh before placing in the cache
@@ -806,7 +999,7 @@ class SessionManager:
 
         self._tx_hashes_cache[height] = tx_hashes
 
-        return tx_hashes, 0.25 + len(tx_hashes) * 0.0001
+        return tx_hashes, 0.25
 
     def session_count(self):
         '''The number of connections that we've sent something to.'''
@@ -814,10 +1007,13 @@ class SessionManager:
 
     async def daemon_request(self, method, *args):
         '''Catch a DaemonError and convert it to an RPCError.'''
+        start = time.perf_counter()
         try:
             return await getattr(self.daemon, method)(*args)
         except DaemonError as e:
             raise RPCError(DAEMON_ERROR, f'daemon error: {e!r}') from None
+        finally:
+            util.add_request_usage(util.RequestUsage(daemon_time=time.perf_counter() - start))
 
     async def raw_header(self, height):
         '''Return the binary header at the given height.'''
@@ -827,33 +1023,247 @@ class SessionManager:
             raise RPCError(BAD_REQUEST, f'height {height:,d} '
                            'out of range') from None
 
+    def _is_immutable(self, height):
+        '''Return True if the header at height is below the reorg limit.'''
+        return height <= self.db.state.height - self.env.reorg_limit
+
+    async def headers_hex(self, start_height, count, chunk_size):
+        '''Return a (hex, count, cached) triple of up to count headers from
+        start_height as for DB.read_headers().  Chunks of chunk_size
+        headers starting at a multiple of it cannot change once below the
+        reorg limit, and are cached.  Reorgs do not clear them.'''
+        cacheable = (count == chunk_size and start_height % chunk_size == 0
+                     and self._is_immutable(start_height + count - 1))
+        if cacheable:
+            headers_hex = self._header_chunks.get(start_height)
+            if headers_hex is not None:
+                return headers_hex, count, True
+        headers, count = await self.db.read_headers(start_height, count)
+        headers_hex = headers.hex()
+        if cacheable and count == chunk_size and start_height not in self._header_chunks:
+            self._header_chunks[start_height] = headers_hex
+            self._header_chunks_size += len(headers_hex)
+        return headers_hex, count, False
+
+    async def header_merkle_proof(self, cp_height, height):
+        '''Return the merkle proof of the header at height to the header
+        merkle root at cp_height.  Proofs below the reorg limit are cached.'''
+        max_height = self.db.state.height
+        if not height <= cp_height <= max_height:
+            raise RPCError(BAD_REQUEST,
+                           f'require header height {height:,d} <= '
+                           f'cp_height {cp_height:,d} <= '
+                           f'chain height {max_height:,d}')
+        key = (cp_height, height)
+        proof = self._header_cache.get(key)
+        if proof is None:
+            branch, root = await self.db.header_branch_and_root(cp_height + 1, height)
+            proof = {
+                'branch': [hash_to_hex_str(elt) for elt in branch],
+                'root': hash_to_hex_str(root),
+            }
+            if self._is_immutable(cp_height):
+                self._header_cache[key] = proof
+        return proof
+
     async def broadcast_transaction(self, raw_tx):
-        hex_hash = await self.daemon.broadcast_transaction(raw_tx)
+        start = time.perf_counter()
+        try:
+            hex_hash = await self.daemon.broadcast_transaction(raw_tx)
+        finally:
+            util.add_request_usage(util.RequestUsage(daemon_time=time.perf_counter() - start))
         self.txs_sent += 1
         return hex_hash
 
     async def limited_history(self, hashX):
         '''Returns a pair (history, cost).
 
-        History is a sorted list of (tx_hash, height) tuples, or an RPCError.'''
+        History is a CompactHistory of the sorted (tx_hash, height) pairs.
+        Raises an RPCError if it is too large.'''
         # History DoS limit.  Each element of history is about 99 bytes when encoded
         # as JSON.
         limit = self.env.max_send // 99
         cost = 0.1
-        self._history_lookups += 1
+        history = self._history_cache.get(hashX)
+        if history is None:
+            # Oversized histories are rejected without being read
+            count, _, history = await self.db.history_after(hashX, -1, limit=limit)
+            cost += 0.1
+            if count >= limit:
+                raise RPCError(BAD_REQUEST, 'history too large', cost=cost)
+            history = CompactHistory(history)
+            self._history_cache[hashX] = history
+        return history, cost
+
+    async def _address_status(self, hashX):
+        '''Compute the status of hashX as a (status, cost, in_mempool) triple.
+
+        The status is the sha256 of the "tx_hash:height:" entries of the
+        history, confirmed first.  For long histories the hash state of the
+        confirmed part is retained, so later statuses only read and hash
+        the entries appended since.
+        '''
+        # History DoS limit as for limited_history()
+        limit = self.env.max_send // 99
+        reorg_count = self._reorg_count
+        retained = self._retained_statuses.get(hashX)
+        while True:
+            # Re-read the last retained entry to check it is still there
+            tx_num = retained.tx_num - 1 if retained else -1
+            count, tx_nums, history = await self.db.history_after(hashX, tx_num, limit=limit)
+            if retained is None:
+                break
+            if (reorg_count == self._reorg_count and history
+                    and tx_nums[0] == retained.tx_num and history[0][0] == retained.tx_hash
+                    and retained.count + len(history) - 1 == count):
+                del tx_nums[0], history[0]
+                break
+            # The chain reorganised; rebuild the status from scratch
+            self._retained_statuses.pop(hashX, None)
+            reorg_count = self._reorg_count
+            retained = None
+
+        cost = 0.2
+        if count >= limit:
+            raise RPCError(BAD_REQUEST, 'history too large', cost=cost)
+
+        # Note history is ordered and mempool unordered in electrum-server
+        # For mempool, height is -1 if it has unconfirmed inputs, otherwise 0
+        confirmed = ''.join(f'{hash_to_hex_str(tx_hash)}:'
+                            f'{height:d}:'
+                            for tx_hash, height in history).encode()
+        hasher = retained.hasher.copy() if retained else hashlib.sha256()
+        hasher.update(confirmed)
+        if (history and count >= self.RETAINED_STATUS_MIN_COUNT
+                and reorg_count == self._reorg_count):
+            self._retained_statuses[hashX] = RetainedStatus(
+                hasher.copy(), count, tx_nums[-1], history[-1][0])
+
+        mempool = await self.mempool.transaction_summaries(hashX)
+        unconfirmed = ''.join(f'{hash_to_hex_str(tx.hash)}:'
+                              f'{-tx.has_unconfirmed_inputs:d}:'
+                              for tx in mempool).encode()
+        hasher.update(unconfirmed)
+
+        # Add status hashing cost
+        cost += 0.1 + (len(confirmed) + len(unconfirmed)) * 0.00002
+
+        if count or mempool:
+            status = hasher.hexdigest()
+        else:
+            status = None
+
+        return status, cost, bool(mempool)
+
+    async def address_status(self, hashX):
+        '''Returns a (status, cost, in_mempool) triple for hashX.
+
+        The status is computed once and shared by all sessions until
+        _notify_sessions reports hashX touched; concurrent requests for the
+        same hashX wait on a single computation.
+        '''
+        self._status_lookups += 1
         try:
-            result = self._history_cache[hashX]
-            self._history_hits += 1
+            result = self._status_cache[hashX]
+            self._status_hits += 1
+            return result
         except KeyError:
-            result = await self.db.limited_history(hashX, limit=limit)
-            cost += 0.1 + len(result) * 0.001
-            if len(result) >= limit:
-                result = RPCError(BAD_REQUEST, 'history too large', cost=cost)
-            self._history_cache[hashX] = result
+            pass
 
+        while True:
+            future = self._status_futures.get(hashX)
+            if future is None:
+                break
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Retry if the computing task was cancelled, not us
+                if not future.cancelled():
+                    raise
+                continue
+            self._status_hits += 1
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        future = asyncio.get_running_loop().create_future()
+        self._status_futures[hashX] = future
+        try:
+            try:
+                result = await self._address_status(hashX)
+            except RPCError as e:
+                result = e
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            # Unless _notify_sessions invalidated the computation while it ran
+            current = self._status_futures.get(hashX) is future
+            if current:
+                del self._status_futures[hashX]
+
+        future.set_result(result)
         if isinstance(result, Exception):
             raise result
-        return result, cost
+        if current:
+            self._status_cache[hashX] = result
+        return result
+
+    def _invalidate_statuses(self, touched, height_changed):
+        '''Drop the cached statuses of touched hashXs.  On a new block also drop
+        those with mempool transactions, as their unconfirmed inputs may have
+        confirmed.'''
+        cache = self._status_cache
+        if height_changed:
+            self._status_futures.clear()
+            stale = [hashX for hashX, (_, _, in_mempool) in cache.items() if in_mempool]
+        else:
+            for hashX in set(self._status_futures).intersection(touched):
+                del self._status_futures[hashX]
+            stale = []
+        stale.extend(set(cache).intersection(touched))
+        for hashX in stale:
+            cache.pop(hashX, None)
+
+    async def asset_db_lookup(self, kind, key, lookup):
+        '''Return the result of awaiting lookup(), a DB query, caching it as
+        key in the cache of the given kind until _notify_sessions reports
+        key touched.  Callers must not modify the result.'''
+        cache = self._asset_caches[kind]
+        self._asset_lookups += 1
+        try:
+            result = cache[key]
+            self._asset_hits += 1
+            return result
+        except KeyError:
+            pass
+        generation = self._asset_cache_generation
+        result = await lookup()
+        # A notification while we awaited may have invalidated the result
+        if generation == self._asset_cache_generation:
+            cache[key] = result
+        return result
+
+    def _invalidate_asset_caches(self, assets, q, h, b, f, v, qv):
+        '''Drop the cached asset DB lookups of touched keys.'''
+        associations = {qualifier.split('/')[0] for qualifier in qv}
+        associations.update([f'#{qualifier}' for qualifier in associations
+                             if not qualifier.startswith('#')])
+        touched_by_kind = (
+            ('meta', assets),
+            ('qualifier_tags', q),
+            ('h160_tags', h),
+            ('broadcasts', b),
+            ('frozen', f),
+            ('verifier', v),
+            ('associations', associations),
+        )
+        for kind, keys in touched_by_kind:
+            if keys:
+                self._asset_cache_generation += 1
+                cache = self._asset_caches[kind]
+                for key in set(cache).intersection(keys):
+                    del cache[key]
 
     async def _notify_sessions(self, height, touched, assets, q, h, b, f, v, qv):
         '''Notify sessions about height changes and touched addresses.'''
@@ -864,11 +1274,55 @@ class SessionManager:
             cache = self._history_cache
             for hashX in set(cache).intersection(touched):
                 del cache[hashX]
+        self._invalidate_statuses(touched, height_changed)
+        self._invalidate_asset_caches(assets, q, h, b, f, v, qv)
+        self._notification_messages.clear()
+
+        if height_changed:
+            sessions = list(self.sessions)
+        else:
+            sessions = self._touched_subscribers((
+                ('hashX', touched),
+                ('asset', assets),
+                ('qualifier_tags', q),
+                ('h160_tags', h),
+                ('broadcasts', b),
+                ('frozen', f),
+                ('verifier', v),
+                ('associations', qv),
+            ))
 
         async with TaskGroup() as group:
-            for session in self.sessions:
+            for session in sessions:
                 await group.spawn(session.notify, touched, height_changed, assets, q, h, b, f, v, qv)
 
+    def _touched_subscribers(self, touched_by_kind):
+        '''Return the set of sessions subscribed to a touched key.'''
+        sessions = set()
+        for kind, keys in touched_by_kind:
+            subscribers = self._subscribers[kind]
+            if len(keys) > len(subscribers):
+                keys = [key for key in subscribers if key in keys]
+            for key in keys:
+                key_sessions = subscribers.get(key)
+                if key_sessions:
+                    sessions.update(key_sessions)
+        return sessions
+
+    def add_subscription(self, session, kind, key):
+        '''Record that session is subscribed to key of the given kind.'''
+        # A request can complete after its session disconnected
+        if session in self.sessions:
+            self._subscribers[kind].setdefault(key, set()).add(session)
+
+    def remove_subscription(self, session, kind, key):
+        subscribers = self._subscribers[kind]
+        sessions = subscribers.get(key)
+        if sessions:
+            sessions.discard(session)
+            if not sessions:
+                del subscribers[key]
+
     def _ip_addr_group_name(self, session):
         host = session.remote_address().host
         if isinstance(host, IPv4Address):
@@ -909,6 +1363,9 @@ class SessionManager:
         '''Remove a session from our sessions list if there.'''
         self.session_event.set()
         groups = self.sessions.pop(session)
+        for kind, keys in session.subscriptions().items():
+            for key in keys:
+                self.remove_subscription(session, kind, key)
         for group in groups:
             group.retained_cost += session.cost
             group.sessions.remove(session)
@@ -924,6 +1381,9 @@ class SessionBase(RPCSession):
     MAX_CHUNK_SIZE = 2016
     session_counter = itertools.count()
     log_new = False
+    # Cost of the measured client thread pool usage of requests
+    cpu_cost_per_sec = 1000.0
+    db_cost_per_byte = 0.0001
 
     def __init__(self, session_mgr, db: 'DB', mempool: 'MemPool', peer_mgr, kind, transport):
         connection = JSONRPCConnection(JSONRPCAutoDetect)
@@ -990,6 +1450,32 @@ class SessionBase(RPCSession):
     def sub_count(self):
         return 0
 
+    def subscriptions(self):
+        return {}
+
+    async def _throttled_request(self, request):
+        '''Measure the request, whose processing and response run in this task.'''
+        usage = util.RequestUsage()
+        usage.received = time.perf_counter()
+        token = util.request_usage.set(usage)
+        try:
+            await super()._throttled_request(request)
+        finally:
+            util.request_usage.reset(token)
+            if usage.queue_time is None:
+                # Timed out or failed before being handled
+                usage.queue_time = time.perf_counter() - usage.received
+            method = request.method
+            if not isinstance(request, Request) or method not in self.request_handlers:
+                method = 'invalid method'
+            self.session_mgr.record_request(self, method, request.args, usage)
+
+    async def _send_message(self, message):
+        usage = util.request_usage.get()
+        if usage is not None:
+            usage.response_size += len(message)
+        return await super()._send_message(message)
+
     async def handle_request(self, request):
         '''Handle an incoming request.  ElectrumX doesn't receive
         notifications from client sessions.
@@ -1001,7 +1487,20 @@ class SessionBase(RPCSession):
         method = 'invalid method' if handler is None else request.method
         self.session_mgr._method_counts[method] += 1
         coro = handler_invocation(handler, request)()
-        return await coro
+        usage = util.request_usage.get()
+        if usage is None:
+            return await coro
+        start = time.perf_counter()
+        usage.queue_time = start - usage.received
+        try:
+            return await coro
+        finally:
+            usage.handler_time = time.perf_counter() - start
+            # Charge the measured client thread pool usage of the request
+            cost = (usage.cpu_time * self.cpu_cost_per_sec
+                    + usage.db_bytes * self.db_cost_per_byte)
+            if cost:
+                self.bump_cost(cost)
 
 
 def check_asset(name):
@@ -1032,8 +1531,9 @@ class ElectrumX(SessionBase):
     '''A TCP server that handles incoming Electrum connections.'''
 
     PROTOCOL_MIN = (1, 4)
-    PROTOCOL_MAX = (1, 11)
+    PROTOCOL_MAX = (1, 12)
     PROTOCOL_BAD = ((1, 9),)
+    MAX_MERKLE_BATCH = 1000
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1104,8 +1604,22 @@ class ElectrumX(SessionBase):
     def sub_count(self):
         return len(self.hashX_subs)
 
+    def subscriptions(self):
+        '''Return a map from subscription kind to the keys subscribed to.'''
+        return {
+            'hashX': self.hashX_subs,
+            'asset': self.asset_subs,
+            'qualifier_tags': self.qualifier_tag_subs,
+            'h160_tags': self.h160_tag_subs,
+            'broadcasts': self.broadcast_subs,
+            'frozen': self.frozen_subs,
+            'verifier': self.validator_subs,
+            'associations': self.qualifier_validator_subs,
+        }
+
     def unsubscribe_hashX(self, hashX):
         self.mempool_statuses.pop(hashX, None)
+        self.session_mgr.remove_subscription(self, 'hashX', hashX)
         return self.hashX_subs.pop(hashX, None)
 
     async def notify(self, touched, height_changed, assets, q, h, b, f, v, qv):
@@ -1114,15 +1628,19 @@ class ElectrumX(SessionBase):
         '''
 
         if height_changed and self.subscribe_headers:
-            args = (await self.subscribe_headers_result(), )
-            await self.send_notification('blockchain.headers.subscribe', args)
+            message = self.session_mgr.hsub_messages.get(self.connection._protocol)
+            if message is None:
+                args = (await self.subscribe_headers_result(), )
+                await self.send_notification('blockchain.headers.subscribe', args)
+            else:
+                await self._send_message(message)
 
         touched_assets = assets.intersection(self.asset_subs)
         if touched_assets:
             method = 'blockchain.asset.subscribe'
             for asset in touched_assets:
                 status = await self.asset_status(asset)
-                await self.send_notification(method, (asset, status))
+                await self.send_shared_notification(method, (asset, status))
             es = '' if len(touched_assets) == 1 else 's'
             self.logger.info(f'notified of {len(touched_assets):,d} reissued asset{es}')
 
@@ -1131,7 +1649,7 @@ class ElectrumX(SessionBase):
             method = 'blockchain.tag.qualifier.subscribe'
             for qualifier in touched_qualifier_tags:
                 status = await self.tags_for_qualifier_status(qualifier)
-                await self.send_notification(method, (qualifier, status))
+                await self.send_shared_notification(method, (qualifier, status))
             es = '' if len(touched_qualifier_tags) == 1 else 's'
             self.logger.info(f'notified of {len(touched_qualifier_tags):,d} qualifier tagging{es}')
 
@@ -1141,7 +1659,7 @@ class ElectrumX(SessionBase):
             for h160 in touched_h160_tags:
                 h160_h = h160.hex()
                 status = await self.tags_for_h160_status(h160_h)
-                await self.send_notification(method, (h160_h, status))
+                await self.send_shared_notification(method, (h160_h, status))
             es = '' if len(touched_h160_tags) == 1 else 's'
             self.logger.info(f'notified of {len(touched_h160_tags):,d} h160 tagging{es}')
 
@@ -1150,7 +1668,7 @@ class ElectrumX(SessionBase):
             method = 'blockchain.asset.broadcasts.subscribe'
             for asset in touched_asset_broadcasts:
                 status = await self.broadcasts_status(asset)
-                await self.send_notification(method, (asset, status))
+                await self.send_shared_notification(method, (asset, status))
             es = '' if len(touched_asset_broadcasts) == 1 else 's'
             self.logger.info(f'notified of {len(touched_asset_broadcasts):,d} broadcast{es}')
 
@@ -1159,7 +1677,7 @@ class ElectrumX(SessionBase):
             method = 'blockchain.asset.is_frozen.subscribe'
             for asset in touched_asset_freezes:
                 result = await self.is_restricted_frozen(asset)
-                await self.send_notification(method, (asset, result))
+                await self.send_shared_notification(method, (asset, result))
             es = '' if len(touched_asset_freezes) == 1 else 's'
             self.logger.info(f'notified of {len(touched_asset_freezes):,d} freezes{es}')
 
@@ -1168,7 +1686,7 @@ class ElectrumX(SessionBase):
             method = 'blockchain.asset.verifier_string.subscribe'
             for asset in touched_asset_verifier_strings:
                 result = await self.get_restricted_string(asset)
-                await self.send_notification(method, (asset, result))
+                await self.send_shared_notification(method, (asset, result))
             es = '' if len(touched_asset_verifier_strings) == 1 else 's'
             self.logger.info(f'notified of {len(touched_asset_verifier_strings):,d} verifier change{es}')
 
@@ -1177,7 +1695,7 @@ class ElectrumX(SessionBase):
             method = 'blockchain.asset.restricted_associations.subscribe'
             for asset in touched_qualifiers_that_are_in_verifiers:
                 status = await self.qualifier_associations_status(asset)
-                await self.send_notification(method, (f'#{asset}', status))
+                await self.send_shared_notification(method, (f'#{asset}', status))
             es = '' if len(touched_qualifiers_that_are_in_verifiers) == 1 else 's'
             self.logger.info(f'notified of {len(touched_qualifiers_that_are_in_verifiers):,d} qualifier{es} in verifier strings')
 
@@ -1203,13 +1721,24 @@ class ElectrumX(SessionBase):
 
             method = 'blockchain.scripthash.subscribe'
             for alias, status in changed.items():
-                await self.send_notification(method, (alias, status))
+                await self.send_shared_notification(method, (alias, status))
 
             if changed:
                 es = '' if len(changed) == 1 else 'es'
                 self.logger.info(f'notified of {len(changed):,d} address{es}')
 
 
+    async def send_shared_notification(self, method, args):
+        '''As for send_notification, but the message is encoded once per
+        notification cycle for all sessions sending the same one.  Until
+        the session's JSON RPC protocol is detected it is sent as normal.'''
+        protocol = getattr(self.connection, '_protocol', JSONRPCAutoDetect)
+        if protocol is JSONRPCAutoDetect:
+            await self.send_notification(method, args)
+        else:
+            message = self.session_mgr.notification_message(protocol, method, args)
+            await self._send_message(message)
+
     async def subscribe_headers_result(self):
         '''The result of a header subscription or notification.'''
         return self.session_mgr.hsub_results
@@ -1310,27 +1839,10 @@ class ElectrumX(SessionBase):
 
         Status is a hex string, but must be None if there is no history.
         '''
-        # Note history is ordered and mempool unordered in electrum-server
-        # For mempool, height is -1 if it has unconfirmed inputs, otherwise 0
-        db_history, cost = await self.session_mgr.limited_history(hashX)
-        mempool = await self.mempool.transaction_summaries(hashX)
-
-        status = ''.join(f'{hash_to_hex_str(tx_hash)}:'
-                         f'{height:d}:'
-                         for tx_hash, height in db_history)
-        status += ''.join(f'{hash_to_hex_str(tx.hash)}:'
-                          f'{-tx.has_unconfirmed_inputs:d}:'
-                          for tx in mempool)
-
-        # Add status hashing cost
-        self.bump_cost(cost + 0.1 + len(status) * 0.00002)
-
-        if status:
-            status = sha256(status.encode()).hex()
-        else:
-            status = None
+        status, cost, in_mempool = await self.session_mgr.address_status(hashX)
+        self.bump_cost(cost)
 
-        if mempool:
+        if in_mempool:
             self.mempool_statuses[hashX] = status
         else:
             self.mempool_statuses.pop(hashX, None)
@@ -1364,8 +1876,9 @@ class ElectrumX(SessionBase):
 
         utxos = await self.db.all_utxos(hashX, asset)
         utxos = sorted(utxos)
-        utxos.extend(await self.mempool.unordered_UTXOs(hashX, asset))
-        self.bump_cost(1.0 + len(utxos) / 50)
+        mempool_utxos = await self.mempool.unordered_UTXOs(hashX, asset)
+        utxos.extend(mempool_utxos)
+        self.bump_cost(1.0 + len(mempool_utxos) / 50)
         spends = await self.mempool.potential_spends(hashX)
 
         return [{'tx_hash': hash_to_hex_str(utxo.tx_hash),
@@ -1378,26 +1891,31 @@ class ElectrumX(SessionBase):
         # Store the subscription only after address_status succeeds
         result = await self.address_status(hashX)
         self.hashX_subs[hashX] = alias
+        self.session_mgr.add_subscription(self, 'hashX', hashX)
         return result
 
     async def asset_subscribe(self, asset):
         check_asset(asset)
         result = await self.asset_status(asset)
         self.asset_subs.add(asset)
+        self.session_mgr.add_subscription(self, 'asset', asset)
         return result
 
     async def asset_unsubscribe(self, asset):
         check_asset(asset)
+        self.session_mgr.remove_subscription(self, 'asset', asset)
         return self.asset_subs.discard(asset) is not None
 
     async def subscribe_qualifier_tagging(self, qualifier):
         check_asset(qualifier)
         result = await self.tags_for_qualifier_status(qualifier)
         self.qualifier_tag_subs.add(qualifier)
+        self.session_mgr.add_subscription(self, 'qualifier_tags', qualifier)
         return result
 
     async def unsubscribe_qualifier_tagging(self, qualifier):
         check_asset(qualifier)
+        self.session_mgr.remove_subscription(self, 'qualifier_tags', qualifier)
         return self.qualifier_tag_subs.discard(qualifier) is not None
 
     async def subscribe_h160_tagged(self, h160):
@@ -1405,41 +1923,49 @@ class ElectrumX(SessionBase):
         h160_b = bytes.fromhex(h160)
         result = await self.tags_for_h160_status(h160)
         self.h160_tag_subs.add(h160_b)
+        self.session_mgr.add_subscription(self, 'h160_tags', h160_b)
         return result
 
     async def unsubscribe_h160_tagged(self, h160):
         check_h160(h160)
         h160_b = bytes.fromhex(h160)
+        self.session_mgr.remove_subscription(self, 'h160_tags', h160_b)
         return self.h160_tag_subs.discard(h160_b) is not None
 
     async def subscribe_broadcast(self, asset):
         check_asset(asset)
         result = await self.broadcasts_status(asset)
         self.broadcast_subs.add(asset)
+        self.session_mgr.add_subscription(self, 'broadcasts', asset)
         return result
     
     async def unsubscribe_broadcast(self, asset):
         check_asset(asset)
+        self.session_mgr.remove_subscription(self, 'broadcasts', asset)
         return self.broadcast_subs.discard(asset) is not None
 
     async def subscribe_asset_freeze(self, asset):
         check_asset(asset)
         result = await self.is_restricted_frozen(asset)
         self.frozen_subs.add(asset)
+        self.session_mgr.add_subscription(self, 'frozen', asset)
         return result
 
     async def unsubscribe_asset_freeze(self, asset):
         check_asset(asset)
+        self.session_mgr.remove_subscription(self, 'frozen', asset)
         return self.frozen_subs.discard(asset) is not None
 
     async def subscribe_restricted_verification_change(self, asset):
         check_asset(asset)
         result = await self.get_restricted_string(asset)
         self.validator_subs.add(asset)
+        self.session_mgr.add_subscription(self, 'verifier', asset)
         return result
     
     async def unsubscribe_restricted_verification_change(self, asset):
         check_asset(asset)
+        self.session_mgr.remove_subscription(self, 'verifier', asset)
         return self.validator_subs.discard(asset) is not None
 
     async def subscribe_qualifier_associated_restricted(self, asset):
@@ -1450,6 +1976,7 @@ class ElectrumX(SessionBase):
             ) from None
         result = await self.qualifier_associations_status(asset)
         self.qualifier_validator_subs.add(asset)
+        self.session_mgr.add_subscription(self, 'associations', asset)
         return result
 
     async def unsubscribe_qualifier_associated_restricted(self, asset):
@@ -1458,6 +1985,7 @@ class ElectrumX(SessionBase):
             raise RPCError(
                 BAD_REQUEST, f'{asset} is not a qualifier'
             ) from None
+        self.session_mgr.remove_subscription(self, 'associations', asset)
         return self.qualifier_validator_subs.discard(asset) is not None
 
     async def get_balance(self, hashX, asset):
@@ -1479,7 +2007,7 @@ class ElectrumX(SessionBase):
         for utxo in utxos:
             confirmed[utxo.name] += utxo.value
         unconfirmed: Dict[Optional[str], int] = await self.mempool.balance_delta(hashX, asset)
-        self.bump_cost(1.0 + len(utxos) / 50)
+        self.bump_cost(1.0)
         include_names = asset is True or (asset is not False and not isinstance(asset, str))
         if include_names:
             return {(k or 'rvn'): {'confirmed': confirmed[k], 'unconfirmed': unconfirmed[k]} for k in set(confirmed.keys()).union(unconfirmed.keys()).union(must_have_names)}
@@ -1540,20 +2068,6 @@ class ElectrumX(SessionBase):
         hashX = scripthash_to_hashX(scripthash)
         return self.unsubscribe_hashX(hashX) is not None
 
-    async def _merkle_proof(self, cp_height, height):
-        max_height = self.db.state.height
-        if not height <= cp_height <= max_height:
-            raise RPCError(BAD_REQUEST,
-                           f'require header height {height:,d} <= '
-                           f'cp_height {cp_height:,d} <= '
-                           f'chain height {max_height:,d}')
-        branch, root = await self.db.header_branch_and_root(cp_height + 1,
-                                                            height)
-        return {
-            'branch': [hash_to_hex_str(elt) for elt in branch],
-            'root': hash_to_hex_str(root),
-        }
-
     async def block_header(self, height, cp_height=0):
         '''Return a raw block header as a hexadecimal string, or as a
         dictionary with a merkle proof.'''
@@ -1564,7 +2078,7 @@ class ElectrumX(SessionBase):
         if cp_height == 0:
             return raw_header_hex
         result = {'header': raw_header_hex}
-        result.update(await self._merkle_proof(cp_height, height))
+        result.update(await self.session_mgr.header_merkle_proof(cp_height, height))
         return result
 
     async def block_headers(self, start_height, count, cp_height=0):
@@ -1581,12 +2095,15 @@ class ElectrumX(SessionBase):
 
         max_size = self.MAX_CHUNK_SIZE
         count = min(count, max_size)
-        headers, count = await self.db.read_headers(start_height, count)
-        result = {'hex': headers.hex(), 'count': count, 'max': max_size}
+        headers_hex, count, cached = await self.session_mgr.headers_hex(
+            start_height, count, max_size)
+        if cached:
+            cost = 1.0
+        result = {'hex': headers_hex, 'count': count, 'max': max_size}
         if count and cp_height:
             cost += 1.0
             last_height = start_height + count - 1
-            result.update(await self._merkle_proof(cp_height, last_height))
+            result.update(await self.session_mgr.header_merkle_proof(cp_height, last_height))
         self.bump_cost(cost)
         return result
 
@@ -1809,6 +2326,20 @@ class ElectrumX(SessionBase):
 
         return {"block_height": height, "merkle": branch, "pos": tx_pos}
 
+    async def transaction_merkle_batch(self, pairs):
+        '''Return the merkle branches to many confirmed transactions, as for
+        transaction_merkle().
+
+        pairs: a list of [tx_hash, height] pairs
+        '''
+        if not (isinstance(pairs, list)
+                and all(isinstance(pair, list) and len(pair) == 2 for pair in pairs)):
+            raise RPCError(BAD_REQUEST, 'expected a list of [tx_hash, height] pairs')
+        if len(pairs) > self.MAX_MERKLE_BATCH:
+            raise RPCError(BAD_REQUEST, f'at most {self.MAX_MERKLE_BATCH:,d} pairs '
+                           'can be requested')
+        return [await self.transaction_merkle(tx_hash, height) for tx_hash, height in pairs]
+
     async def transaction_tsc_merkle(self, tx_hash, height, txid_or_tx='txid',
                                      target_type='block_hash'):
         '''Return the TSC merkle proof in JSON format to a confirmed transaction given its hash.
@@ -1885,7 +2416,8 @@ class ElectrumX(SessionBase):
         if mempool_data and include_mempool:
             return mempool_data
         else:
-            saved_data = await self.db.lookup_asset_meta(name.encode('ascii'))
+            saved_data = await self.session_mgr.asset_db_lookup(
+                'meta', name, partial(self.db.lookup_asset_meta, name.encode('ascii')))
             mempool_data = await self.mempool.get_asset_reissues_if_any(name)
             if mempool_data and include_mempool:
                 asset_data = {
@@ -1926,7 +2458,10 @@ class ElectrumX(SessionBase):
 
     async def get_messages(self, name):
         check_asset(name)
-        b_items = await self.db.lookup_messages(name.encode('ascii'))
+        b_items = await self.session_mgr.asset_db_lookup(
+            'broadcasts', name, partial(self.db.lookup_messages, name.encode('ascii')))
+        # Copy as the cached result is shared
+        b_items = list(b_items)
         self.bump_cost(1.0 + len(b_items) / 10)
         m_items = await self.mempool.get_broadcasts(name.encode('ascii'))
         b_items.sort(key=lambda x: (x['height'], x['tx_hash']), reverse=True)
@@ -1956,7 +2491,11 @@ class ElectrumX(SessionBase):
 
     async def qualifications_for_h160(self, h160: str, include_mempool=True):
         check_h160(h160)
-        res = await self.db.qualifications_for_h160(bytes.fromhex(h160))
+        h160_b = bytes.fromhex(h160)
+        res = await self.session_mgr.asset_db_lookup(
+            'h160_tags', h160_b, partial(self.db.qualifications_for_h160, h160_b))
+        # Copy as the cached result is shared and the mempool is overlaid
+        res = dict(res)
         self.bump_cost(1.0 + len(res) / 10)
         if include_mempool:
             mem_res = await self.mempool.get_h160_tags(h160)
@@ -1982,7 +2521,10 @@ class ElectrumX(SessionBase):
 
     async def qualifications_for_qualifier(self, asset: str, include_mempool=True):
         check_asset(asset)
-        res = await self.db.qualifications_for_qualifier(asset.encode())
+        res = await self.session_mgr.asset_db_lookup(
+            'qualifier_tags', asset, partial(self.db.qualifications_for_qualifier, asset.encode()))
+        # Copy as the cached result is shared and the mempool is overlaid
+        res = dict(res)
         # This incurs 2 db lookups and is no longer contiguous
         self.bump_cost(2.0 + len(res))
         if include_mempool:
@@ -2016,7 +2558,8 @@ class ElectrumX(SessionBase):
             if mem_res:
                 return mem_res
         self.bump_cost(1.0)
-        return await self.db.is_restricted_frozen(asset.encode('ascii'))
+        return await self.session_mgr.asset_db_lookup(
+            'frozen', asset, partial(self.db.is_restricted_frozen, asset.encode('ascii')))
 
     async def get_restricted_string_history(self, asset: str, include_mempool=True):
         check_asset(asset)
@@ -2049,7 +2592,8 @@ class ElectrumX(SessionBase):
             if mem_res:
                 return mem_res
         self.bump_cost(1.0)
-        return await self.db.get_restricted_string(asset.encode('ascii'))
+        return await self.session_mgr.asset_db_lookup(
+            'verifier', asset, partial(self.db.get_restricted_string, asset.encode('ascii')))
 
     async def lookup_qualifier_associations_history(self, asset: str, include_mempool=True):
         check_asset(asset)
@@ -2080,7 +2624,11 @@ class ElectrumX(SessionBase):
                 BAD_REQUEST, f'{asset} is not a qualifier'
             ) from None
         first_chunk = asset.split('/')[0]
-        res = await self.db.lookup_qualifier_associations(first_chunk.encode())
+        res = await self.session_mgr.asset_db_lookup(
+            'associations', first_chunk,
+            partial(self.db.lookup_qualifier_associations, first_chunk.encode()))
+        # Copy as the cached result is shared and the mempool is overlaid
+        res = dict(res)
         self.bump_cost(1.0 + len(res) / 10)
         if include_mempool:
             for res_asset in list(res.keys()):
@@ -2185,6 +2733,9 @@ class ElectrumX(SessionBase):
             'blockchain.asset.restricted_associations_history': self.lookup_qualifier_associations_history,
         }
 
+        if ptuple >= (1, 12):
+            handlers['blockchain.transaction.get_merkle_batch'] = self.transaction_merkle_batch
+
         self.request_handlers = handlers
 
 class LocalRPC(SessionBase):
@@ -7,13 +7,28 @@
 
 '''Backend database abstraction.'''
 
+import heapq
 import os
-from functools import partial
+import tempfile
+import threading
+import time
+from collections import defaultdict, namedtuple
 from typing import Callable
 
 from electrumx.lib import util
 
 
+# Storage hints for the keys beginning with a given prefix byte.  Engines
+# that support column families keep each named family separately with
+# options tuned to how it is read; the others ignore them.  prefix_len
+# is the fixed length of the key prefix that lookups seek by;
+# block_size is for families read mostly by long scans; low_priority
+# families (undo information) are rarely read and should not compete for
+# cache with client-facing data.
+ColumnFamily = namedtuple('ColumnFamily', 'name prefix_len block_size low_priority',
+                          defaults=(0, 0, False))
+
+
 def db_class(name) -> Callable[[str, bool], 'Storage']:
     '''Returns a DB engine class.'''
     for db_class_ in util.subclasses(Storage):
@@ -23,12 +38,27 @@ def db_class(name) -> Callable[[str, bool], 'Storage']:
     raise RuntimeError('unrecognised DB engine "{}"'.format(name))
 
 
+def key_range(prefix, start, stop):
+    '''Return a (start, stop) pair bounding the keys that begin with
+    prefix and lie in [start, stop).  Either bound may be None, meaning
+    unbounded.'''
+    lo = prefix or None
+    hi = util.increment_byte_string(prefix)
+    if start is not None and (lo is None or start > lo):
+        lo = start
+    if stop is not None and (hi is None or stop < hi):
+        hi = stop
+    return lo, hi
+
+
 class Storage(object):
     '''Abstract base class of the DB backend abstraction.'''
 
-    def __init__(self, name, for_sync):
+    def __init__(self, name, for_sync, families=None):
         self.is_new = not os.path.exists(name)
         self.for_sync = for_sync or self.is_new
+        # A map from prefix byte to ColumnFamily
+        self.families = families or {}
         self.open(name, create=self.is_new)
 
     @classmethod
@@ -44,30 +74,351 @@ class Storage(object):
         '''Close an existing database.'''
         raise NotImplementedError
 
-    def get(self, key):
+    def get(self, key, default=None):
+        '''Return the value of key, or default if it is missing.'''
+        raise NotImplementedError
+
+    def multi_get(self, keys):
+        '''Return a list of the values of keys, in the same order.  The
+        value of a missing key is None.'''
         raise NotImplementedError
 
     def put(self, key, value):
         raise NotImplementedError
 
-    def write_batch(self):
+    def write_batch(self, sync=True):
         '''Return a context manager that provides `put` and `delete`.
 
         Changes should only be committed when the context manager
-        closes without an exception.
+        closes without an exception.  If `sync` is False the write is
+        not flushed to stable storage before returning; it survives a
+        process crash but not necessarily an OS crash or power loss.
         '''
         raise NotImplementedError
 
-    def iterator(self, prefix=b'', reverse=False):
+    def iterator(self, prefix=b'', reverse=False, *, start=None, stop=None,
+                 include_value=True, fill_cache=True):
         '''Return an iterator that yields (key, value) pairs from the
         database sorted by key.
 
         If `prefix` is set, only keys starting with `prefix` will be
-        included.  If `reverse` is True the items are returned in
-        reverse order.
+        included.  If `start` or `stop` are set only keys in the range
+        [start, stop) are included.  If `reverse` is True the items are
+        returned in reverse order.  If `include_value` is False only
+        the keys are yielded.  Set `fill_cache` to False for one-off
+        scans so they do not evict blocks that client queries rely on.
+        '''
+        raise NotImplementedError
+
+    def delete_range(self, start, stop, sync=True):
+        '''Delete all keys in the range [start, stop) in a single batch.
+        Returns the number of keys deleted.'''
+        count = 0
+        with self.write_batch(sync=sync) as batch:
+            for key in self.iterator(start=start, stop=stop,
+                                     include_value=False, fill_cache=False):
+                batch.delete(key)
+                count += 1
+        return count
+
+    def snapshot(self):
+        '''Return a consistent read-only view of the database as of now.
+
+        The view provides `get` and `iterator` with the same semantics
+        as the database; later writes are not visible through it.  It
+        must be released with `close`, and can be used as a context
+        manager.
         '''
         raise NotImplementedError
 
+    def instrument(self, name, stats):
+        '''Record the reads and writes of this database, called `name`,
+        in the StorageStats object `stats`.'''
+        get, multi_get, iterator = self.get, self.multi_get, self.iterator
+        write_batch, snapshot = self.write_batch, self.snapshot
+
+        self.get = stats.wrap_get(name, get)
+        self.multi_get = stats.wrap_multi_get(name, multi_get)
+        self.iterator = stats.wrap_iterator(name, iterator)
+
+        def instrumented_write_batch(sync=True):
+            return InstrumentedWriteBatch(write_batch(sync=sync), name, stats)
+
+        def instrumented_snapshot():
+            return InstrumentedSnapshot(snapshot(), name, stats)
+
+        self.write_batch = instrumented_write_batch
+        self.snapshot = instrumented_snapshot
+
+
+class OpCounter(object):
+    '''Counts of one kind of operation on one key prefix.  Latencies go
+    into power-of-two nanosecond buckets, which is cheap and good enough
+    for percentiles.'''
+
+    __slots__ = ('ops', 'keys', 'nbytes', 'buckets')
+
+    def __init__(self):
+        self.ops = 0
+        self.keys = 0
+        self.nbytes = 0
+        self.buckets = [0] * 64
+
+    def record(self, keys, nbytes, elapsed_ns=None):
+        self.ops += 1
+        self.keys += keys
+        self.nbytes += nbytes
+        if elapsed_ns is not None:
+            self.buckets[elapsed_ns.bit_length()] += 1
+
+    def percentile(self, fraction):
+        '''Return an upper bound in microseconds of the given latency
+        percentile, or None if no latencies were recorded.'''
+        count = sum(self.buckets)
+        if not count:
+            return None
+        target = count * fraction
+        running = 0
+        for n, bucket_count in enumerate(self.buckets):
+            running += bucket_count
+            if running >= target:
+                return (1 << n) / 1000
+        return None
+
+
+class ThreadBytes(threading.local):
+    '''The number of bytes the current thread has read from instrumented
+    databases.  Unlike the shared counters it is exact, so the reads of
+    one piece of work can be measured by its difference.'''
+
+    def __init__(self):
+        # Added to in place; setting an attribute of a thread-local
+        # object on every read is comparatively slow
+        self.counts = [0]
+
+    @property
+    def nbytes(self):
+        return self.counts[0]
+
+
+class ByteCounters(dict):
+    '''Maps the first byte of a key, as an int, to the OpCounter of its
+    one-byte prefix.  Indexing by int saves slicing each key.'''
+
+    def __init__(self, prefix_counters):
+        super().__init__()
+        self.prefix_counters = prefix_counters
+
+    def __missing__(self, byte):
+        counter = self[byte] = self.prefix_counters[bytes((byte, ))]
+        return counter
+
+
+class StorageStats(object):
+    '''Operation counters of instrumented databases, keyed by database
+    name, operation and one-byte key prefix.  Counters may undercount
+    slightly when threads race; they are statistics, not accounts.'''
+
+    # The latency of one in SAMPLE_MASK + 1 gets and scans is measured
+    SAMPLE_MASK = 15
+
+    def __init__(self):
+        # Map from (name, op) to a map from key prefix to OpCounter
+        self.counters = defaultdict(lambda: defaultdict(OpCounter))
+        # Map from (name, op) to a ByteCounters of the same counters
+        self.byte_counters = {}
+        self.thread_bytes = ThreadBytes()
+
+    def counter(self, name, op, key):
+        return self.counters[(name, op)][key[:1]]
+
+    def wrap_get(self, name, get):
+        now = time.perf_counter_ns
+        counters = self.byte_counters.get((name, 'get'))
+        if counters is None:
+            counters = self.byte_counters[(name, 'get')] = ByteCounters(
+                self.counters[(name, 'get')])
+        sample_mask = self.SAMPLE_MASK
+        thread_bytes = self.thread_bytes
+
+        def instrumented_get(key, default=None):
+            # Inlined OpCounter.record(); this is the hottest path.  Keys
+            # are never empty.
+            counter = counters[key[0]]
+            ops = counter.ops = counter.ops + 1
+            counter.keys += 1
+            if ops & sample_mask:
+                value = get(key, default)
+            else:
+                start = now()
+                value = get(key, default)
+                counter.buckets[(now() - start).bit_length()] += 1
+            if value is not None:
+                size = len(value)
+                counter.nbytes += size
+                thread_bytes.counts[0] += size
+            return value
+
+        return instrumented_get
+
+    def wrap_multi_get(self, name, multi_get):
+        now = time.perf_counter_ns
+        counters = self.counters[(name, 'get')]
+        thread_bytes = self.thread_bytes
+
+        def instrumented_multi_get(keys):
+            start = now()
+            values = multi_get(keys)
+            elapsed = now() - start
+            # Keys and bytes by prefix; each prefix counts the operation
+            by_prefix = defaultdict(lambda: [0, 0])
+            for key, value in zip(keys, values):
+                totals = by_prefix[key[:1]]
+                totals[0] += 1
+                if value is not None:
+                    totals[1] += len(value)
+            for prefix, (count, nbytes) in by_prefix.items():
+                counters[prefix].record(count, nbytes, elapsed)
+                thread_bytes.counts[0] += nbytes
+            return values
+
+        return instrumented_multi_get
+
+    def wrap_iterator(self, name, iterator):
+        counters = self.counters[(name, 'scan')]
+        sample_mask = self.SAMPLE_MASK
+
+        def instrumented_iterator(prefix=b'', *args, **kwargs):
+            counter = counters[(prefix or kwargs.get('start') or b'')[:1]]
+            timed = not (counter.ops + 1) & sample_mask
+            return self.iterate(iterator(prefix, *args, **kwargs), counter,
+                                kwargs.get('include_value', True), timed,
+                                self.thread_bytes)
+
+        return instrumented_iterator
+
+    @staticmethod
+    def iterate(iterator, counter, include_value, timed, thread_bytes):
+        '''Yield the items of iterator counting them.  If timed, record
+        the time spent in the iterator, not in the consumer.'''
+        now = time.perf_counter_ns
+        keys = nbytes = elapsed = 0
+        try:
+            while True:
+                if timed:
+                    start = now()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    if timed:
+                        elapsed += now() - start
+                keys += 1
+                if include_value:
+                    size = len(item[0]) + len(item[1])
+                else:
+                    size = len(item)
+                nbytes += size
+                thread_bytes.counts[0] += size
+                yield item
+        finally:
+            counter.record(keys, nbytes, elapsed if timed else None)
+
+    def items(self):
+        '''Return a sorted list of ((name, op, prefix), OpCounter) pairs.'''
+        return sorted((((name, op, prefix), counter)
+                       for (name, op), counters in list(self.counters.items())
+                       for prefix, counter in list(counters.items())),
+                      key=lambda item: item[0])
+
+    def summary(self):
+        '''Totals by database name, for getinfo.'''
+        totals = {}
+        for (name, op, _prefix), counter in self.items():
+            total = totals.setdefault(name, {'reads': 0, 'read MB': 0, 'writes': 0,
+                                             'written MB': 0})
+            if op == 'write':
+                total['writes'] += counter.keys
+                total['written MB'] += counter.nbytes
+            elif op != 'commit':
+                total['reads'] += counter.keys
+                total['read MB'] += counter.nbytes
+        for total in totals.values():
+            total['read MB'] = round(total['read MB'] / 1_000_000, 1)
+            total['written MB'] = round(total['written MB'] / 1_000_000, 1)
+        return totals
+
+    def rpc_data(self):
+        '''Returned to the RPC 'dbstats' call.'''
+        result = []
+        for (name, op, prefix), counter in self.items():
+            if prefix and 32 < prefix[0] < 127:
+                prefix = prefix.decode()
+            else:
+                prefix = prefix.hex()
+            result.append([name, op, prefix, counter.ops, counter.keys,
+                           counter.nbytes, counter.percentile(0.5),
+                           counter.percentile(0.99)])
+        return result
+
+
+class InstrumentedWriteBatch(object):
+    '''Wraps a write batch context manager to count its writes by key
+    prefix and time its commit.'''
+
+    def __init__(self, write_batch, name, stats):
+        self.write_batch = write_batch
+        self.name = name
+        self.stats = stats
+        self.batch = None
+        self.keys = defaultdict(int)
+        self.nbytes = defaultdict(int)
+
+    def __enter__(self):
+        self.batch = self.write_batch.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        start = time.perf_counter_ns()
+        result = self.write_batch.__exit__(exc_type, exc_val, exc_tb)
+        if not exc_val:
+            stats, name = self.stats, self.name
+            for prefix, keys in self.keys.items():
+                stats.counter(name, 'write', prefix).record(keys, self.nbytes[prefix])
+            stats.counter(name, 'commit', b'').record(
+                sum(self.keys.values()), sum(self.nbytes.values()),
+                time.perf_counter_ns() - start)
+        return result
+
+    def put(self, key, value):
+        self.batch.put(key, value)
+        prefix = key[:1]
+        self.keys[prefix] += 1
+        self.nbytes[prefix] += len(key) + len(value)
+
+    def delete(self, key):
+        self.batch.delete(key)
+        prefix = key[:1]
+        self.keys[prefix] += 1
+        self.nbytes[prefix] += len(key)
+
+
+class InstrumentedSnapshot(object):
+    '''Wraps a snapshot to record its reads.'''
+
+    def __init__(self, snapshot, name, stats):
+        self.snapshot = snapshot
+        self.get = stats.wrap_get(name, snapshot.get)
+        self.iterator = stats.wrap_iterator(name, snapshot.iterator)
+        self.close = snapshot.close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
 # pylint:disable=W0223
 
 
@@ -95,26 +446,240 @@ class LevelDB(Storage):
         self.close = self.db.close
         self.get = self.db.get
         self.put = self.db.put
-        self.iterator = self.db.iterator
-        self.write_batch = partial(self.db.write_batch, transaction=True,
-                                   sync=True)
+
+    def multi_get(self, keys):
+        get = self.db.get
+        return [get(key) for key in keys]
+
+    def iterator(self, prefix=b'', reverse=False, *, start=None, stop=None,
+                 include_value=True, fill_cache=True):
+        return leveldb_iterator(self.db, prefix, reverse, start, stop,
+                                include_value, fill_cache)
+
+    def write_batch(self, sync=True):
+        return self.db.write_batch(transaction=True, sync=sync)
+
+    def snapshot(self):
+        return LevelDBSnapshot(self.db.snapshot())
+
+
+def leveldb_iterator(source, prefix, reverse, start, stop, include_value,
+                     fill_cache):
+    '''Return a plyvel iterator over a DB or snapshot.  plyvel does not
+    accept a prefix together with start or stop, so convert all three
+    to a single key range.'''
+    start, stop = key_range(prefix, start, stop)
+    return source.iterator(start=start, stop=stop, reverse=reverse,
+                           include_value=include_value, fill_cache=fill_cache)
+
+
+class LevelDBSnapshot(object):
+    '''A read-only snapshot of a LevelDB database.'''
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.get = snapshot.get
+        self.close = snapshot.close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def iterator(self, prefix=b'', reverse=False, *, start=None, stop=None,
+                 include_value=True, fill_cache=True):
+        return leveldb_iterator(self.snapshot, prefix, reverse, start, stop,
+                                include_value, fill_cache)
+
+
+class LMDB(Storage):
+    '''LMDB database engine.
+
+    Reads go through the memory map, so there is no block cache to size
+    and readers in different threads do not contend.  A write batch is
+    applied as a single LMDB write transaction.
+    '''
+
+    # The maximum size of each database.  This reserves address space,
+    # not disk space, so it is set well beyond any realistic size.
+    MAP_SIZE = 1 << 40
+
+    @classmethod
+    def import_module(cls):
+        import lmdb    # pylint:disable=E0401
+        cls.module = lmdb
+
+    def open(self, name, create):
+        # Commits are not synced (MDB_NOSYNC); a write batch with sync
+        # set syncs the environment once committed, which makes it and
+        # every earlier commit durable.  Unsynced commits survive a
+        # process crash, but a system crash before the next sync can
+        # corrupt the database.  Readahead helps the sequential access of
+        # initial sync but wastes memory on random reads.
+        self.env = self.module.open(name, map_size=self.MAP_SIZE, create=create,
+                                    sync=False, readahead=self.for_sync,
+                                    max_readers=1024)
+
+    def close(self):
+        self.env.close()
+
+    def get(self, key, default=None):
+        with self.env.begin() as txn:
+            return txn.get(key, default)
+
+    def multi_get(self, keys):
+        with self.env.begin() as txn:
+            get = txn.get
+            return [get(key) for key in keys]
+
+    def put(self, key, value):
+        with self.write_batch() as batch:
+            batch.put(key, value)
+
+    def write_batch(self, sync=True):
+        return LMDBWriteBatch(self.env, sync)
+
+    def iterator(self, prefix=b'', reverse=False, *, start=None, stop=None,
+                 include_value=True, fill_cache=True):
+        return lmdb_iterator(self.env, None, prefix, reverse, start, stop,
+                             include_value)
+
+    def snapshot(self):
+        return LMDBSnapshot(self.env.begin())
+
+
+def lmdb_iterator(env, txn, prefix, reverse, start, stop, include_value):
+    '''Generator over the keys of an LMDB read transaction txn.  If txn
+    is None a read transaction of env is used, and ended when the
+    generator finishes or is closed.'''
+    start, stop = key_range(prefix, start, stop)
+    own_txn = txn is None
+    if own_txn:
+        txn = env.begin()
+    try:
+        with txn.cursor() as cursor:
+            if reverse:
+                if stop is None:
+                    found = cursor.last()
+                elif cursor.set_range(stop):
+                    found = cursor.prev()
+                else:
+                    found = cursor.last()
+                iterator = cursor.iterprev(values=include_value)
+            else:
+                found = cursor.first() if start is None else cursor.set_range(start)
+                iterator = cursor.iternext(values=include_value)
+            if not found:
+                return
+            for item in iterator:
+                key = item[0] if include_value else item
+                if reverse:
+                    if start is not None and key < start:
+                        return
+                elif stop is not None and key >= stop:
+                    return
+                yield item
+    finally:
+        if own_txn:
+            txn.abort()
+
+
+class LMDBWriteBatch(object):
+    '''A write batch for LMDB: a write transaction.'''
+
+    def __init__(self, env, sync):
+        self.env = env
+        self.sync = sync
+        self.txn = None
+
+    def __enter__(self):
+        self.txn = self.env.begin(write=True)
+        return self.txn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_val:
+            self.txn.abort()
+        else:
+            self.txn.commit()
+            if self.sync:
+                self.env.sync(True)
+        self.txn = None
+
+
+class LMDBSnapshot(object):
+    '''A read-only snapshot of an LMDB database: a read transaction.'''
+
+    def __init__(self, txn):
+        self.txn = txn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, key, default=None):
+        return self.txn.get(key, default)
+
+    def iterator(self, prefix=b'', reverse=False, *, start=None, stop=None,
+                 include_value=True, fill_cache=True):
+        return lmdb_iterator(None, self.txn, prefix, reverse, start, stop,
+                             include_value)
+
+    def close(self):
+        self.txn.abort()
 
 
 # pylint:disable=E1101
 
 
 class RocksDB(Storage):
-    '''RocksDB database engine.'''
+    '''RocksDB database engine.
+
+    If the python-rocksdb build supports column families, each
+    ColumnFamily in self.families is stored as a separate column family
+    and keys are routed to it by their first byte.  Keys keep their
+    prefix so iteration order is unchanged.  Families are only given
+    prefix extractors if the build's iterators can seek in total order.
+    '''
+
+    # Whether iterators accept the total_order_seek read option; None
+    # until probed
+    total_order_seek = None
 
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         self.db = None
-        super().__init__(*args)
+        # Map from prefix byte to column family handle
+        self.handles = {}
+        # Map from prefix byte to the length of its family's prefix extractor
+        self.prefix_lens = {}
+        self.logger = util.class_logger(__name__, self.__class__.__name__)
+        super().__init__(*args, **kwargs)
 
     @classmethod
     def import_module(cls):
         import rocksdb    # pylint:disable=E0401
         cls.module = rocksdb
 
+    @classmethod
+    def supports_total_order_seek(cls):
+        '''Return True if the build's iterators accept the total_order_seek
+        read option.  python-rocksdb 0.7.0 does not; it raises TypeError
+        for read options it does not know.  Probes a scratch database
+        once.'''
+        if cls.total_order_seek is None:
+            with tempfile.TemporaryDirectory() as path:
+                db = cls.module.DB(os.path.join(path, 'probe'),
+                                   cls.module.Options(create_if_missing=True))
+                try:
+                    db.iterkeys(total_order_seek=True)
+                    cls.total_order_seek = True
+                except TypeError:
+                    cls.total_order_seek = False
+                del db
+        return cls.total_order_seek
+
     def open(self, name, create):
         mof = 512 if self.for_sync else 128
         # Use snappy compression (the default)
@@ -122,63 +687,281 @@ class RocksDB(Storage):
                                       use_fsync=True,
                                       target_file_size_base=33554432,
                                       max_open_files=mof)
-        self.db = self.module.DB(name, options)
-        self.get = self.db.get
-        self.put = self.db.put
+        if self.families and not hasattr(self.module, 'ColumnFamilyOptions'):
+            self.logger.warning(
+                'python-rocksdb lacks column family support; '
+                f'storing all of {name} in one column family')
+            self.families = {}
+        if (any(family.prefix_len for family in self.families.values())
+                and not self.supports_total_order_seek()):
+            # Scans crossing extracted prefixes could skip keys
+            self.logger.warning('python-rocksdb lacks total order seeks; '
+                                f'not using prefix extractors for {name}')
+            self.families = {prefix: family._replace(prefix_len=0)
+                             for prefix, family in self.families.items()}
+        if self.families:
+            options.create_missing_column_families = True
+            names = {family.name: family for family in self.families.values()}
+            column_families = {cf_name.encode(): self._family_options(family)
+                               for cf_name, family in names.items()}
+            self.db = self.module.DB(name, options, column_families=column_families)
+            handles = {cf_name: self.db.get_column_family(cf_name.encode())
+                       for cf_name in names}
+            self.handles = {prefix[0]: handles[family.name]
+                            for prefix, family in self.families.items()}
+            self.prefix_lens = {prefix[0]: family.prefix_len
+                                for prefix, family in self.families.items()
+                                if family.prefix_len and not family.low_priority}
+            if not create:
+                self._migrate_to_families(name)
+        else:
+            self.db = self.module.DB(name, options)
+
+    def _family_options(self, family):
+        '''Return the ColumnFamilyOptions for a ColumnFamily.'''
+        rocksdb = self.module
+        options = rocksdb.ColumnFamilyOptions(target_file_size_base=33554432)
+        if family.low_priority:
+            # Rarely read: no filter, a small private cache, and denser
+            # compression
+            options.compression = rocksdb.CompressionType.zlib_compression
+            options.write_buffer_size = 16 * 1024 * 1024
+            options.table_factory = rocksdb.BlockBasedTableFactory(
+                block_cache=rocksdb.LRUCache(8 * 1024 * 1024))
+        elif family.prefix_len:
+            # Looked up by a fixed length prefix; a prefix bloom filter
+            # lets a miss avoid reading data blocks.  Scans with a shorter
+            # prefix must seek in total order; see rocksdb_iterator()
+            options.prefix_extractor = FixedPrefix(family.prefix_len)
+            options.table_factory = rocksdb.BlockBasedTableFactory(
+                filter_policy=rocksdb.BloomFilterPolicy(10),
+                whole_key_filtering=False)
+        elif family.block_size:
+            options.table_factory = rocksdb.BlockBasedTableFactory(
+                filter_policy=rocksdb.BloomFilterPolicy(10),
+                block_size=family.block_size)
+        return options
+
+    def _migrate_to_families(self, name):
+        '''Move keys written by the single column family layout into their
+        column families.  Each batch moves keys atomically, so this is
+        safe to interrupt and resume.'''
+        for prefix, handle in self.handles.items():
+            prefix = bytes([prefix])
+            count = 0
+            while True:
+                items = []
+                for item in RocksDBIterator(self.db, prefix, False, fill_cache=False):
+                    items.append(item)
+                    if len(items) == 100_000:
+                        break
+                if not items:
+                    break
+                with RocksDBWriteBatch(self.db, True) as batch:
+                    for key, value in items:
+                        batch.put((handle, key), value)
+                        batch.delete(key)
+                count += len(items)
+            if count:
+                self.logger.info(f'moved {count:,d} {prefix} entries of {name} to '
+                            f'column family {self.families[prefix].name}')
 
     def close(self):
         # PyRocksDB doesn't provide a close method; hopefully this is enough
-        self.db = self.get = self.put = None
+        self.db = None
+        self.handles = {}
+        self.prefix_lens = {}
         import gc
         gc.collect()
 
-    def write_batch(self):
-        return RocksDBWriteBatch(self.db)
+    def _key(self, key):
+        handle = self.handles.get(key[0]) if key else None
+        return key if handle is None else (handle, key)
+
+    def get(self, key, default=None):
+        value = self.db.get(self._key(key))
+        return default if value is None else value
+
+    def put(self, key, value):
+        self.db.put(self._key(key), value)
+
+    def multi_get(self, keys):
+        db_keys = [self._key(key) for key in keys]
+        values = self.db.multi_get(db_keys)
+        return [values[key] for key in db_keys]
+
+    def write_batch(self, sync=True):
+        return RocksDBWriteBatch(self.db, sync, self._key)
+
+    def iterator(self, prefix=b'', reverse=False, *, start=None, stop=None,
+                 include_value=True, fill_cache=True):
+        return rocksdb_iterator(self.db, self.handles, self.prefix_lens, prefix, reverse,
+                                start, stop, include_value, fill_cache=fill_cache)
+
+    def snapshot(self):
+        return RocksDBSnapshot(self.db, self.handles, self.prefix_lens, self._key)
+
+
+class FixedPrefix(object):
+    '''A RocksDB prefix extractor taking the first `length` bytes.'''
 
-    def iterator(self, prefix=b'', reverse=False):
-        return RocksDBIterator(self.db, prefix, reverse)
+    def __init__(self, length):
+        self.length = length
+
+    def name(self):
+        return f'fixed{self.length}'.encode()
+
+    def transform(self, src):
+        return (0, self.length)
+
+    def in_domain(self, src):
+        return len(src) >= self.length
+
+    def in_range(self, dst):
+        return len(dst) == self.length
+
+
+def rocksdb_iterator(db, handles, prefix_lens, prefix, reverse, start, stop, include_value,
+                     **read_options):
+    '''Return an iterator over a RocksDB database with column families
+    in handles.  A scan not confined to one family merges them all.
+
+    prefix_lens maps prefix bytes to the length of their family's prefix
+    extractor.  RocksDB results are undefined for scans crossing
+    extracted prefixes unless they seek in total order.'''
+    lo, hi = key_range(prefix, start, stop)
+    next_byte = util.increment_byte_string(lo[:1]) if lo else b''
+    if lo and (next_byte is None or (hi is not None and hi <= next_byte)):
+        # Every key in range has the same first byte
+        families = [(handles.get(lo[0]), lo[0])]
+    else:
+        families = [(None, None)]
+        for byte, handle in handles.items():
+            if not any(handle is family for family, _ in families):
+                families.append((handle, byte))
+
+    def family_read_options(byte):
+        if len(prefix) < prefix_lens.get(byte, 0):
+            return dict(read_options, total_order_seek=True)
+        return read_options
+
+    iterators = [RocksDBIterator(db, prefix, reverse, start, stop, include_value,
+                                 family=family, **family_read_options(byte))
+                 for family, byte in families]
+    if len(iterators) == 1:
+        return iterators[0]
+    if include_value:
+        return heapq.merge(*iterators, key=lambda item: item[0], reverse=reverse)
+    return heapq.merge(*iterators, reverse=reverse)
 
 
 class RocksDBWriteBatch(object):
     '''A write batch for RocksDB.'''
 
-    def __init__(self, db):
+    def __init__(self, db, sync, route=None):
         self.batch = RocksDB.module.WriteBatch()
         self.db = db
+        self.sync = sync
+        self.route = route
 
     def __enter__(self):
-        return self.batch
+        return self if self.route else self.batch
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if not exc_val:
-            self.db.write(self.batch)
+            self.db.write(self.batch, sync=self.sync)
 
+    def put(self, key, value):
+        self.batch.put(self.route(key), value)
 
-class RocksDBIterator(object):
-    '''An iterator for RocksDB.'''
+    def delete(self, key):
+        self.batch.delete(self.route(key))
+
+
+class RocksDBSnapshot(object):
+    '''A read-only snapshot of a RocksDB database.'''
 
-    def __init__(self, db, prefix, reverse):
-        self.prefix = prefix
+    def __init__(self, db, handles, prefix_lens, route):
+        self.db = db
+        self.handles = handles
+        self.prefix_lens = prefix_lens
+        self.route = route
+        self.snapshot = db.snapshot()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, key, default=None):
+        value = self.db.get(self.route(key), snapshot=self.snapshot)
+        return default if value is None else value
+
+    def iterator(self, prefix=b'', reverse=False, *, start=None, stop=None,
+                 include_value=True, fill_cache=True):
+        return rocksdb_iterator(self.db, self.handles, self.prefix_lens, prefix, reverse,
+                                start, stop, include_value, fill_cache=fill_cache,
+                                snapshot=self.snapshot)
+
+    def close(self):
+        # The snapshot is released when the last reference goes
+        self.db = self.snapshot = None
+
+
+class RocksDBIterator(object):
+    '''An iterator for RocksDB over the default column family, or the
+    one given by `family`.'''
+
+    def __init__(self, db, prefix, reverse, start=None, stop=None,
+                 include_value=True, family=None, **read_options):
+        self.start, self.stop = key_range(prefix, start, stop)
+        self.include_value = include_value
+        self.reverse = reverse
+        self.family = family
+        args = () if family is None else (family, )
+        if include_value:
+            iterator = db.iteritems(*args, **read_options)
+        else:
+            iterator = db.iterkeys(*args, **read_options)
         if reverse:
-            self.iterator = reversed(db.iteritems())
-            nxt_prefix = util.increment_byte_string(prefix)
-            if nxt_prefix:
-                self.iterator.seek(nxt_prefix)
+            self.iterator = reversed(iterator)
+            if self.stop is None:
+                self.iterator.seek_to_last()
+            else:
+                # Seeking positions on the first key >= stop; skip it
+                self.iterator.seek(self.stop)
                 try:
                     next(self.iterator)
                 except StopIteration:
-                    self.iterator.seek(nxt_prefix)
-            else:
-                self.iterator.seek_to_last()
+                    self.iterator.seek_to_last()
         else:
-            self.iterator = db.iteritems()
-            self.iterator.seek(prefix)
+            self.iterator = iterator
+            if self.start is None:
+                self.iterator.seek_to_first()
+            else:
+                self.iterator.seek(self.start)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        k, v = next(self.iterator)
-        if not k.startswith(self.prefix):
-            raise StopIteration
-        return k, v
+        while True:
+            item = next(self.iterator)
+            if self.include_value:
+                key, value = item
+                if self.family is not None:
+                    # Column family keys are (handle, key) pairs
+                    key = key[1]
+                    item = (key, value)
+            else:
+                key = item if self.family is None else item[1]
+                item = key
+            if self.reverse:
+                if self.stop is not None and key >= self.stop:
+                    continue
+                if self.start is not None and key < self.start:
+                    raise StopIteration
+            elif self.stop is not None and key >= self.stop:
+                raise StopIteration
+            return item
@@ -10,10 +10,13 @@ with open('requirements.txt', 'r') as f:
 setuptools.setup(
     name='electrumX-meowcoin',
     version=version,
-    scripts=['electrumx_server', 'electrumx_rpc', 'electrumx_compact_history'],
+    scripts=['electrumx_server', 'electrumx_rpc', 'electrumx_compact_history',
+             'electrumx_convert_db'],
     python_requires='>=3.8',
     install_requires=requirements,
     extras_require={
+        'lmdb': ['lmdb>=1.0'],
+        'numpy': ['numpy>=1.17'],
         'rocksdb': ['python-rocksdb>=0.6.9'],
         'uvloop': ['uvloop>=0.17'],
     },
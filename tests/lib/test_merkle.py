@@ -122,6 +122,23 @@ def test_branch_and_root_from_level():
                 assert branch == branch2
 
 
+def test_branch_and_root_from_levels():
+    for n in range(len(hashes)):
+        part = hashes[:n + 1]
+        levels = merkle.levels(part)
+        assert levels[0] == part and levels[-1] == [roots[n]]
+        for index in range(len(part)):
+            for tsc_format in (False, True):
+                assert (merkle.branch_and_root_from_levels(levels, index, tsc_format)
+                        == merkle.branch_and_root(part, index, tsc_format=tsc_format))
+    with pytest.raises(ValueError):
+        merkle.levels([])
+    with pytest.raises(ValueError):
+        merkle.branch_and_root_from_levels(levels, len(hashes))
+    with pytest.raises(TypeError):
+        merkle.branch_and_root_from_levels(levels, 0.0)
+
+
 def test_branch_and_root_from_level_bad():
     with pytest.raises(TypeError):
         merkle.branch_and_root_from_level(hashes[0], hashes, 0, 0)
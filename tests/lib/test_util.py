@@ -80,6 +80,40 @@ def test_int_to_bytes():
     assert util.int_to_bytes(456789) == b'\x06\xf8U'
 
 
+def test_LRUCache():
+    cache = util.LRUCache(10, len)
+    cache['a'] = 'xxxx'
+    cache['b'] = 'yyyy'
+    assert cache.get('a') == 'xxxx'
+    # Evicts the least recently used
+    cache['c'] = 'zzzz'
+    assert list(cache) == ['a', 'c'] and cache.size == 8
+    assert cache.get('b') is None
+    assert (cache.lookups, cache.hits, cache.evictions) == (2, 1, 1)
+    # Replacing a value adjusts the size
+    cache['a'] = 'x'
+    assert cache.size == 5
+    # Values over the bound are not cached
+    cache['d'] = 'w' * 11
+    assert 'd' not in cache and len(cache) == 2
+    del cache['a']
+    assert cache.pop('c') == 'zzzz' and cache.size == 0
+    assert cache.info().startswith('2 lookups 1 hits 1 misses 1 evictions 0 entries')
+
+
+def test_Histogram():
+    histogram = util.Histogram()
+    assert histogram.percentile(0.5) is None
+    for value in [0, 1, 3, 5, 7, 100, 1000, 1000.7, 2**70]:
+        histogram.record(value)
+    assert histogram.count == 9
+    # Upper bounds of the power-of-two buckets
+    assert histogram.percentile(0.1) == 1
+    assert histogram.percentile(0.5) == 8
+    assert histogram.percentile(0.8) == 1024
+    assert histogram.percentile(1.0) == 2**63
+
+
 def test_LogicalFile(tmpdir):
     prefix = os.path.join(tmpdir, 'log')
     L = util.LogicalFile(prefix, 2, 6)
@@ -107,6 +141,10 @@ def test_LogicalFile(tmpdir):
     L.write(0, b'957' * 6)
     assert L.read(0, -1) == b'957' * 6
 
+    L.write(0, b'0123456789abcdefgh')
+    assert L.read_many([0, 2, 4, 7, 16, 17, 30], 2) == [
+        b'01', b'23', b'45', b'78', b'gh', b'h', b'']
+
 def test_open_fns(tmpdir):
     tmpfile = os.path.join(tmpdir, 'file1')
     with pytest.raises(FileNotFoundError):
@@ -5,10 +5,15 @@ import asyncio
 import random
 from os import environ, urandom
 
+import pytest
+
 from electrumx.lib.hash import HASHX_LEN
-from electrumx.lib.util import pack_be_uint16, pack_le_uint64
+from electrumx.lib.util import pack_be_uint16, pack_be_uint32, pack_le_uint64
 from electrumx.server.db import DB
 from electrumx.server.env import Env
+from electrumx.server.history import (
+    COMP_CURSOR_END, ROW_KEY_LEN, compact_rows, encode_txnums,
+)
 
 
 def create_histories(history, hashX_count=100):
@@ -17,15 +22,13 @@ def create_histories(history, hashX_count=100):
     hashXs = [urandom(HASHX_LEN) for n in range(hashX_count)]
     mk_array = lambda : array.array('Q')
     histories = {hashX : mk_array() for hashX in hashXs}
-    unflushed = history.unflushed
     tx_num = 0
     while hashXs:
-        tx_numb = pack_le_uint64(tx_num)[:5]
         hash_indexes = set(random.randrange(len(hashXs))
                            for n in range(1 + random.randrange(4)))
         for index in hash_indexes:
             histories[hashXs[index]].append(tx_num)
-            unflushed[hashXs[index]].extend(tx_numb)
+        history.add_unflushed([[hashXs[index] for index in hash_indexes]], tx_num)
 
         tx_num += 1
         # Occasionally flush and drop a random hashX if non-empty
@@ -132,3 +135,171 @@ def test_compaction(tmpdir):
     print('Temp dir: {}'.format(db_dir))
     loop = asyncio.get_event_loop()
     loop.run_until_complete(run_test(db_dir))
+
+
+@pytest.fixture
+def db(tmpdir, monkeypatch):
+    for name, value in (('COIN', 'Ravencoin'), ('DAEMON_URL', ''),
+                        ('DB_DIRECTORY', str(tmpdir))):
+        monkeypatch.setenv(name, value)
+    monkeypatch.chdir(str(tmpdir))
+    db = DB(Env())
+    asyncio.run(db.open_for_serving())
+    yield db
+    db.utxo_db.close()
+    db.asset_db.close()
+    db.suid_db.close()
+    db.history.close_db()
+
+
+def history_rows(history):
+    return [(key, hist) for key, hist in history.db.iterator()
+            if len(key) == ROW_KEY_LEN]
+
+
+def compact_online(db):
+    history = db.history
+    history.start_compaction(online=True)
+    while history.comp_cursor != -1:
+        db.compact_history_step(max_prefixes=4096)
+
+
+def test_compact_history_online(db):
+    history = db.history
+    history.max_hist_row_entries = 4
+    histories = create_histories(history)
+    history.utxo_flush_count = history.flush_count
+    compact_online(db)
+    check_written(history, histories)
+    assert history.compacted_flush_count == history.flush_count
+    # Every hashX's rows have flush ids from 0
+    for hashX, hist in histories.items():
+        nrows = (len(hist) + 3) // 4
+        assert [key[-4:] for key, _ in history_rows(history) if key[:-4] == hashX] == [
+            pack_be_uint32(n) for n in range(nrows)]
+
+
+def test_compact_history_online_excess(db):
+    history = db.history
+    histories = create_histories(history)
+    history.utxo_flush_count = history.flush_count
+    # A history flush the UTXO DB has not caught up with
+    hashX = next(iter(histories))
+    history.add_unflushed([[hashX]], max(max(hist) for hist in histories.values()) + 1)
+    history.flush()
+    excess_key = hashX + pack_be_uint32(history.flush_count)
+    prefix_rows = list(history.db.iterator(prefix=hashX[:2]))
+    compact_online(db)
+
+    # The prefix was skipped, so clear_excess() removes the excess flush
+    assert list(history.db.iterator(prefix=hashX[:2])) == prefix_rows
+    assert history.db.get(excess_key) is not None
+    history.clear_excess(history.utxo_flush_count)
+    assert history.db.get(excess_key) is None
+    check_written(history, histories)
+
+
+def test_compact_history_step_flush(db):
+    history = db.history
+    histories = create_histories(history)
+    history.utxo_flush_count = history.flush_count
+    history.start_compaction(online=True)
+    rows = history_rows(history)
+
+    # A flush between reading the rows and writing them discards the step
+    read_compaction_rows = history._read_compaction_rows
+    hashX = next(iter(histories))
+    tx_num = max(max(hist) for hist in histories.values()) + 1
+
+    def read_and_flush(*args):
+        result = read_compaction_rows(*args)
+        history.add_unflushed([[hashX]], tx_num)
+        history.flush()
+        return result
+
+    history._read_compaction_rows = read_and_flush
+    db.compact_history_step(max_prefixes=COMP_CURSOR_END)
+    del history._read_compaction_rows
+    assert history.comp_cursor == 0
+    assert history_rows(history) == sorted(rows + [
+        (hashX + pack_be_uint32(history.flush_count), encode_txnums([tx_num]))])
+
+    history.utxo_flush_count = history.flush_count
+    histories[hashX].append(tx_num)
+    compact_online(db)
+    check_written(history, histories)
+
+
+def test_cancel_compaction_on_restart(db):
+    history = db.history
+    histories = create_histories(history)
+    history.utxo_flush_count = history.flush_count
+    db.state.flush_count = history.flush_count
+    db.write_utxo_state(db.utxo_db)
+    history.start_compaction(online=True)
+    db.compact_history_step(max_prefixes=COMP_CURSOR_END // 2)
+    assert history.comp_cursor == COMP_CURSOR_END // 2
+
+    asyncio.run(db.open_for_serving())
+    history = db.history
+    assert history.comp_cursor == -1
+    assert history.comp_flush_count == -1
+    check_written(history, histories)
+    compact_online(db)
+    check_written(history, histories)
+
+
+def test_compact_rows():
+    hashXs = sorted(urandom(HASHX_LEN) for n in range(3))
+    tx_nums = [list(range(n, 30, n + 1)) for n in range(3)]
+    rows = []
+    for hashX, hist in zip(hashXs, tx_nums):
+        # Each hashX's history over several flushes
+        for flush_id, start in enumerate(range(0, len(hist), 4), start=5):
+            rows.append((hashX + pack_be_uint32(flush_id), encode_txnums(hist[start:start + 4])))
+
+    write_items, keys_to_delete, write_size, max_rows = compact_rows(rows, 10)
+    assert keys_to_delete == {key for key, _ in rows}
+    assert write_items == [(hashX + pack_be_uint32(n), encode_txnums(hist[start:start + 10]))
+                           for hashX, hist in zip(hashXs, tx_nums)
+                           for n, start in enumerate(range(0, len(hist), 10))]
+    assert write_size == sum(len(row) for _, row in write_items)
+    assert max_rows == 3
+
+    # Compacting the result again is null
+    assert compact_rows(write_items, 10) == ([], set(), 0, 3)
+
+
+def test_compact_history_parallel(db):
+    history = db.history
+    history.max_hist_row_entries = 4
+    histories = create_histories(history)
+    history.utxo_flush_count = history.flush_count
+    history.start_compaction()
+
+    # Shards end early once their rows exceed the byte limit
+    read_sizes = []
+    read_compaction_rows = history._read_compaction_rows
+
+    def recording_read(*args):
+        rows, cursor = read_compaction_rows(*args)
+        # The size before the last prefix read
+        last = pack_be_uint16(cursor - 1)
+        read_sizes.append(sum(len(key) + len(hist) for key, hist in rows
+                              if not key.startswith(last)))
+        return rows, cursor
+
+    history._read_compaction_rows = recording_read
+    history._compact_history_parallel(2, 2000, shard_size=8192)
+    del history._read_compaction_rows
+    assert history.comp_cursor == -1
+    assert len(read_sizes) > 1
+    assert max(read_sizes) < 2000
+    check_written(history, histories)
+    rows = history_rows(history)
+
+    # Compacting serially finds nothing more to do
+    history.start_compaction()
+    while history.comp_cursor != -1:
+        history._compact_history(1_000_000)
+    assert history_rows(history) == rows
@@ -0,0 +1,327 @@
+# Tests of server/db.py
+
+import asyncio
+import logging
+import os
+from array import array
+from types import SimpleNamespace
+
+import pytest
+
+from electrumx.lib.util import RequestUsage, add_request_usage, request_usage
+from electrumx.server.db import DB, ReadBatcher, ReadView
+from electrumx.server.env import Env
+
+
+def test_read_batcher():
+    batches = []
+
+    async def read_batch(keys):
+        batches.append(keys)
+        await asyncio.sleep(0.01)
+        if 'fail' in keys:
+            raise OSError('read failed')
+        return [(ValueError('bad key') if key == 'bad' else key * 2, RequestUsage())
+                for key in keys]
+
+    async def run():
+        batcher = ReadBatcher(read_batch)
+        results = await asyncio.gather(*(batcher.read(n) for n in range(5)))
+        assert results == [0, 2, 4, 6, 8]
+        assert batches == [[0, 1, 2, 3, 4]]
+        # Reads made whilst a batch is read form the next batch
+        first = asyncio.ensure_future(batcher.read(10))
+        await asyncio.sleep(0.001)
+        results = await asyncio.gather(batcher.read(20), batcher.read(30))
+        assert await first == 20 and results == [40, 60]
+        assert batches[1:] == [[10], [20, 30]]
+        # A bad key fails only its own read
+        results = await asyncio.gather(batcher.read(1), batcher.read('bad'),
+                                       batcher.read(2), return_exceptions=True)
+        assert results[0] == 2 and results[2] == 4
+        assert isinstance(results[1], ValueError)
+        results = await asyncio.gather(batcher.read('bad'), batcher.read(3),
+                                       return_exceptions=True)
+        assert isinstance(results[0], ValueError) and results[1] == 6
+        # Errors of the batch read are raised in every read of the batch
+        results = await asyncio.gather(batcher.read('fail'), batcher.read(1),
+                                       return_exceptions=True)
+        assert all(isinstance(result, OSError) for result in results)
+
+    asyncio.run(run())
+
+
+def test_read_batcher_usage():
+    async def read_batch(keys):
+        # Stands in for the measured usage of run_in_thread_client: each
+        # key's own usage, and the rest that is shared
+        usages = [RequestUsage(0.001 * key, 100 * key) for key in keys]
+        add_request_usage(RequestUsage(0.004 + sum(usage.cpu_time for usage in usages),
+                                       400 + sum(usage.db_bytes for usage in usages)))
+        return list(zip(keys, usages))
+
+    async def read(batcher, key):
+        usage = RequestUsage()
+        request_usage.set(usage)
+        await batcher.read(key)
+        return usage
+
+    async def run():
+        batcher = ReadBatcher(read_batch)
+        usages = await asyncio.gather(*(read(batcher, n) for n in range(4)))
+        assert [usage.db_bytes for usage in usages] == [100, 200, 300, 400]
+        assert [usage.cpu_time for usage in usages] == pytest.approx([
+            0.001, 0.002, 0.003, 0.004])
+        # Reads outside a request are not measured
+        assert await batcher.read(5) == 5
+
+    asyncio.run(run())
+
+
+class HashesFile:
+
+    def __init__(self, tx_hashes):
+        self.data = b''.join(tx_hashes)
+
+    def read_many(self, offsets, size):
+        return [self.data[offset: offset + size] for offset in offsets]
+
+
+def fake_db(tx_counts, tx_hashes):
+    def snapshot():
+        return SimpleNamespace(close=lambda: None)
+
+    db = SimpleNamespace(
+        state=SimpleNamespace(height=len(tx_counts) - 1, tx_count=tx_counts[-1]),
+        reorg_generation=0, tx_counts=array('Q', tx_counts),
+        hashes_file=HashesFile(tx_hashes), utxo_db=SimpleNamespace(snapshot=snapshot),
+        history=SimpleNamespace(db=SimpleNamespace(snapshot=snapshot)),
+        logger=logging.getLogger('test'), READ_ATTEMPTS=DB.READ_ATTEMPTS)
+    db.read_view = lambda: ReadView(db)
+    return db
+
+
+def test_read_view_tx_hashes():
+    tx_hashes = [bytes([n]) * 32 for n in range(6)]
+    db = fake_db([1, 3, 6], tx_hashes)
+    with db.read_view() as view:
+        assert view.fs_tx_hash(4) == (tx_hashes[4], 2)
+        # Transactions after the view's tx count are not on disk for it
+        db.tx_counts.append(8)
+        db.hashes_file = HashesFile(tx_hashes + [bytes(32)] * 2)
+        assert view.fs_tx_hashes([0, 2, 5, 7]) == [
+            (tx_hashes[0], 0), (tx_hashes[2], 1), (tx_hashes[5], 2), (None, 3)]
+        assert view.fs_tx_hashes_many([[5], [0, 5]]) == [
+            [(tx_hashes[5], 2)], [(tx_hashes[0], 0), (tx_hashes[5], 2)]]
+
+
+def test_read_view_reorg():
+    tx_hashes = [bytes([n]) * 32 for n in range(6)]
+    db = fake_db([1, 3, 6], tx_hashes)
+    view = db.read_view()
+    # A reorg replaces the last block, changing the hashes of its tx numbers
+    db.reorg_generation += 1
+    db.tx_counts[2] = 5
+    db.hashes_file = HashesFile(tx_hashes[:3] + [bytes(32)] * 2)
+    with pytest.raises(ReadView.StaleError):
+        view.fs_tx_hash(4)
+
+    # read_consistent() retries with a new view
+    views = []
+
+    def read(view):
+        views.append(view)
+        if len(views) == 1:
+            db.reorg_generation += 1
+        return view.fs_tx_hash(4)
+
+    assert DB.read_consistent(db, read) == (bytes(32), 2)
+    assert len(views) == 2
+
+    # It gives up if every view is made stale
+    def stale_read(view):
+        views.append(view)
+        db.reorg_generation += 1
+        return view.fs_tx_hash(4)
+
+    views.clear()
+    with pytest.raises(ReadView.StaleError):
+        DB.read_consistent(db, stale_read)
+    assert len(views) == DB.READ_ATTEMPTS
+
+
+@pytest.fixture
+def db(tmpdir, monkeypatch):
+    for name, value in (('COIN', 'Ravencoin'), ('DAEMON_URL', ''),
+                        ('DB_DIRECTORY', str(tmpdir))):
+        monkeypatch.setenv(name, value)
+    monkeypatch.chdir(str(tmpdir))
+    db = DB(Env())
+    asyncio.run(db.open_for_serving())
+    yield db
+    db.utxo_db.close()
+    db.asset_db.close()
+    db.suid_db.close()
+    db.history.close_db()
+
+
+def utxo_flush(db, adds=(), deletes=()):
+    '''Flush UTXO adds, given as (tx_hash, hashX) pairs, and deletes.'''
+    utxo_adds = {}
+    for tx_hash, hashX in adds:
+        utxo_adds[tx_hash + bytes(4)] = hashX + bytes(5) + bytes(8) + bytes(4)
+    flush_data = SimpleNamespace(
+        state=db.state.copy(), utxo_adds=utxo_adds, utxo_deletes=list(deletes),
+        utxo_undo_infos=[])
+    flush_data.state.utxo_count += len(adds) - len(deletes) // 2
+    db.flush_utxo_db(flush_data)
+
+
+def utxo_keys(db, first):
+    return list(db.utxo_db.iterator(prefix=b'u' + bytes((first, )), include_value=False))
+
+
+def random_utxos(count):
+    return [(os.urandom(32), bytes((n % 4, )) + os.urandom(10)) for n in range(count)]
+
+
+def test_recount_utxos(db):
+    utxo_flush(db, random_utxos(40))
+    # The DB of an older version has no UTXO count
+    db.utxo_recount = {}
+    db.write_utxo_state(db.utxo_db)
+    asyncio.run(db.open_for_serving())
+    assert db.utxo_recount == {}
+
+    asyncio.run(db.recount_utxos())
+    assert len(db.utxo_recount) == 256
+    assert db.utxo_recount[0] == len(utxo_keys(db, 0)) == 10
+    assert sum(db.utxo_recount.values()) == 40
+
+    # The next flush sets the count
+    utxo_flush(db)
+    assert db.utxo_recount is None
+    assert db.state.utxo_count == 40
+    asyncio.run(db.open_for_serving())
+    assert db.utxo_recount is None
+    assert db.state.utxo_count == 40
+
+
+def test_update_utxo_recount(db):
+    utxo_flush(db, random_utxos(40))
+    db.utxo_recount = {0: 10, 1: 10}
+    # Range 2 is being counted in a snapshot taken before this flush
+    db.utxo_recounting[2] = 0
+    adds = random_utxos(8)
+    deletes = utxo_keys(db, 0)[:3] + utxo_keys(db, 2)[:1] + utxo_keys(db, 3)[:1]
+    utxo_flush(db, adds, deletes)
+    assert db.utxo_recount == {0: 9, 1: 12}
+    assert db.utxo_recounting == {2: 1}
+
+
+def test_recount_utxos_resumes(db):
+    utxo_flush(db, random_utxos(40))
+    db.utxo_recount = {}
+    db.write_utxo_state(db.utxo_db)
+    asyncio.run(db.open_for_serving())
+
+    # Interrupted after counting the first two ranges
+    snapshots = []
+    db_snapshot = db.utxo_db.snapshot
+
+    def snapshot():
+        if len(snapshots) == 2:
+            raise RuntimeError('shutting down')
+        snapshots.append(db_snapshot())
+        return snapshots[-1]
+
+    db.utxo_db.snapshot = snapshot
+    with pytest.raises(RuntimeError):
+        asyncio.run(db.recount_utxos())
+    del db.utxo_db.snapshot
+    done = dict(db.utxo_recount)
+    assert len(done) == 2
+
+    # A flush stores the ranges counted and keeps them current
+    utxo_flush(db, random_utxos(4))
+    asyncio.run(db.open_for_serving())
+    assert db.state.utxo_count == -1
+    assert db.utxo_recount == {first: count + (first < 4) for first, count in done.items()}
+
+    asyncio.run(db.recount_utxos())
+    utxo_flush(db)
+    assert db.utxo_recount is None
+    assert db.state.utxo_count == 44
+
+
+def test_read_batch_key_error(db, monkeypatch):
+    get_txnum_array = db.history.get_txnum_array
+    bad = bytes(11)
+
+    def failing_get_txnum_array(hashX, *args, **kwargs):
+        if hashX == bad:
+            raise ValueError('bad key')
+        return get_txnum_array(hashX, *args, **kwargs)
+
+    monkeypatch.setattr(db.history, 'get_txnum_array', failing_get_txnum_array)
+
+    async def read():
+        return await asyncio.gather(*(db.limited_history(hashX) for hashX in
+                                      (bytes([1]) * 11, bad, bytes([2]) * 11)),
+                                    return_exceptions=True)
+
+    # Only the read of the failing key fails
+    results = asyncio.run(read())
+    assert results[0] == [] and results[2] == []
+    assert isinstance(results[1], ValueError)
+
+
+def test_read_batch_usage_by_key(db):
+    expensive, cheap = bytes([1]) * 11, bytes([2]) * 11
+    with db.utxo_db.write_batch() as batch:
+        for tx_idx in range(200):
+            batch.put(b'u' + expensive + bytes(4) + tx_idx.to_bytes(4, 'little') + bytes(5),
+                      (1000).to_bytes(8, 'little'))
+
+    async def read(hashX):
+        usage = RequestUsage()
+        request_usage.set(usage)
+        await db.all_utxos(hashX, True)
+        return usage
+
+    async def run():
+        return await asyncio.gather(read(expensive), read(cheap))
+
+    # Reads of one batch are each charged what they read
+    expensive_usage, cheap_usage = asyncio.run(run())
+    assert expensive_usage.db_bytes == 200 * 33
+    assert cheap_usage.db_bytes == 0
+    assert cheap_usage.cpu_time < expensive_usage.cpu_time
+    assert cheap_usage.pool_time == expensive_usage.pool_time
+
+
+def test_read_view_backup_flush(db, monkeypatch):
+    state = db.state.copy()
+    state.height, state.tx_count = 1, 10
+    db.state = state.copy()
+    flush_data = SimpleNamespace(state=state, headers=[], block_tx_hashes=[])
+    flush_data.state.height, flush_data.state.tx_count = 0, 4
+
+    def flush_utxo_db(flush_data):
+        db.state = flush_data.state.copy()
+
+    monkeypatch.setattr(db, 'flush_utxo_db', flush_utxo_db)
+    monkeypatch.setattr(db, 'flush_asset_db', lambda flush_data: None)
+    monkeypatch.setattr(db, 'flush_suid_db', lambda flush_data: None)
+
+    # A view made during the reorg but before its backup flush has the tx
+    # count of the old chain, whose hashes the next flush overwrites
+    db.reorg_generation += 1
+    with db.read_view() as view:
+        assert view.tx_count == 10
+        db.flush_backup(flush_data, set())
+        with pytest.raises(ReadView.StaleError):
+            view.check_current()
+    with db.read_view() as view:
+        assert view.tx_count == 4
+        view.check_current()
@@ -16,7 +16,7 @@ BASE_DB_DIR = '/some/dir'
 base_environ = {
     'DB_DIRECTORY': BASE_DB_DIR,
     'DAEMON_URL': BASE_DAEMON_URL,
-    'COIN': 'BitcoinSV',
+    'COIN': 'Meowcoin',
 }
 
 
@@ -89,13 +89,13 @@ def test_COIN_NET():
     '''Test COIN and NET defaults and redirection.'''
     setup_base_env()
     e = Env()
-    assert e.coin == lib_coins.BitcoinSV
+    assert e.coin == lib_coins.Meowcoin
     os.environ['NET'] = 'testnet'
     e = Env()
-    assert e.coin == lib_coins.BitcoinSVTestnet
+    assert e.coin == lib_coins.MeowcoinTestnet
     os.environ['NET'] = ' testnet '
     e = Env()
-    assert e.coin == lib_coins.BitcoinSVTestnet
+    assert e.coin == lib_coins.MeowcoinTestnet
 
 
 def test_CACHE_MB():
@@ -227,15 +227,15 @@ def test_REPORT_SERVICES_localhost():
 
 def test_REORG_LIMIT():
     assert_integer('REORG_LIMIT', 'reorg_limit',
-                   lib_coins.BitcoinSV.REORG_LIMIT)
+                   lib_coins.Meowcoin.REORG_LIMIT)
 
 
 def test_COST_HARD_LIMIT():
-    assert_integer('COST_HARD_LIMIT', 'cost_hard_limit', 10000)
+    assert_integer('COST_HARD_LIMIT', 'cost_hard_limit', 100000)
 
 
 def test_COST_SOFT_LIMIT():
-    assert_integer('COST_SOFT_LIMIT', 'cost_soft_limit', 1000)
+    assert_integer('COST_SOFT_LIMIT', 'cost_soft_limit', 10000)
 
 
 def test_INITIAL_CONCURRENT():
@@ -247,7 +247,15 @@ def test_REQUEST_SLEEP():
 
 
 def test_BANDWIDTH_UNIT_COST():
-    assert_integer('BANDWIDTH_UNIT_COST', 'bw_unit_cost', 5000)
+    assert_integer('BANDWIDTH_UNIT_COST', 'bw_unit_cost', 500)
+
+
+def test_CPU_UNIT_COST():
+    assert_integer('CPU_UNIT_COST', 'cpu_unit_cost', 1000)
+
+
+def test_DB_READ_UNIT_COST():
+    assert_integer('DB_READ_UNIT_COST', 'db_read_unit_cost', 10000)
 
 
 def test_DONATION_ADDRESS():
@@ -259,7 +267,7 @@ def test_DB_ENGINE():
 
 
 def test_MAX_SEND():
-    assert_integer('MAX_SEND', 'max_send', 1000000)
+    assert_integer('MAX_SEND', 'max_send', lib_coins.Meowcoin.DEFAULT_MAX_SEND)
 
 
 def test_LOG_LEVEL():
@@ -287,6 +295,19 @@ def test_SESSION_TIMEOUT():
     assert_integer('SESSION_TIMEOUT', 'session_timeout', 600)
 
 
+def test_SLOWLOG_THRESHOLD():
+    assert_integer('SLOWLOG_THRESHOLD', 'slowlog_threshold', 1000)
+
+
+def test_SLOWLOG_SIZE():
+    assert_integer('SLOWLOG_SIZE', 'slowlog_size', 100)
+    os.environ['SLOWLOG_SIZE'] = '-1'
+    with pytest.raises(Env.Error):
+        Env()
+    os.environ['SLOWLOG_SIZE'] = '0'
+    assert Env().slowlog_size == 0
+
+
 def test_BANNER_FILE():
     e = Env()
     assert e.banner_file is None
@@ -361,5 +382,5 @@ def test_ban_versions():
 
 
 def test_coin_class_provided():
-    e = Env(lib_coins.BitcoinSV)
-    assert e.coin == lib_coins.BitcoinSV
+    e = Env(lib_coins.Meowcoin)
+    assert e.coin == lib_coins.Meowcoin
@@ -0,0 +1,162 @@
+# Tests of server/history.py
+
+import os
+import random
+from os import urandom
+
+import pytest
+
+from electrumx.lib.hash import HASHX_LEN
+from electrumx.lib.util import pack_be_uint32, pack_le_uint64
+from electrumx.server import history as history_module
+from electrumx.server.history import (
+    History, count_txnums, decode_txnums, encode_txnums, journal_key, unpack_txnums,
+)
+from electrumx.server.storage import db_class
+
+
+@pytest.fixture
+def db_dir(tmpdir):
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    yield str(tmpdir)
+    os.chdir(cwd)
+
+
+def open_history(utxo_flush_count):
+    history = History()
+    history.open_db(db_class('leveldb'), False, utxo_flush_count, False)
+    return history
+
+
+def add_flush(history, hashXs, tx_num):
+    history.add_unflushed([hashXs], tx_num)
+    history.flush()
+
+
+def test_clear_excess(db_dir):
+    hashXs = [urandom(HASHX_LEN) for _ in range(4)]
+    history = open_history(0)
+    add_flush(history, hashXs[:2], 0)
+    add_flush(history, hashXs[1:3], 1)
+    # The UTXO DB catches up with flush 2; later flushes are excess
+    history.utxo_flush_count = 2
+    add_flush(history, hashXs[2:], 2)
+    add_flush(history, hashXs, 3)
+    assert history.journal_ids == [3, 4]
+    history.close_db()
+
+    history = open_history(2)
+    assert history.flush_count == 2
+    assert history.journal_ids == []
+    assert list(history.get_txnums(hashXs[0])) == [0]
+    assert list(history.get_txnums(hashXs[1])) == [0, 1]
+    assert list(history.get_txnums(hashXs[2])) == [1]
+    assert list(history.get_txnums(hashXs[3])) == []
+    assert [history.get_count(hashX) for hashX in hashXs] == [1, 2, 1, 0]
+    assert history.db.get(journal_key(4)) is None
+    history.close_db()
+
+
+def test_clear_excess_without_journal(db_dir):
+    hashXs = [urandom(HASHX_LEN) for _ in range(2)]
+    history = open_history(0)
+    add_flush(history, hashXs, 0)
+    add_flush(history, hashXs, 1)
+    # As written by earlier versions
+    with history.db.write_batch() as batch:
+        batch.delete(journal_key(2))
+    history.close_db()
+
+    history = open_history(1)
+    assert history.flush_count == 1
+    assert list(history.get_txnums(hashXs[0])) == [0]
+    assert history.get_count(hashXs[0]) == 1
+    history.close_db()
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_txnums_codec(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(history_module, 'numpy', None)
+    for count in (0, 1, 10, 1000):
+        tx_nums = sorted(random.sample(range(2**39), count))
+        row = encode_txnums(tx_nums)
+        assert list(decode_txnums(row)) == tx_nums
+        raw = b''.join(pack_le_uint64(tx_num)[:5] for tx_num in tx_nums)
+        assert list(unpack_txnums(raw)) == tx_nums
+        assert count_txnums(row) == count
+    assert encode_txnums([1, 2, 300]) == bytes([1, 1, 0xaa, 0x02])
+
+
+def test_backup(db_dir):
+    hashX = urandom(HASHX_LEN)
+    history = open_history(0)
+    add_flush(history, [hashX], 5)
+    add_flush(history, [hashX], 300)
+    add_flush(history, [hashX], 301)
+    assert history.get_count(hashX) == 3
+    history.backup([hashX], 301)
+    assert list(history.get_txnums(hashX)) == [5, 300]
+    assert history.get_count(hashX) == 2
+    history.backup([hashX], 6)
+    assert list(history.get_txnums(hashX)) == [5]
+    assert history.get_count(hashX) == 1
+    history.backup([hashX], 0)
+    assert list(history.get_txnums(hashX)) == []
+    assert history.get_count(hashX) == 0
+    history.close_db()
+
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_upgrade(db_dir, version):
+    hashXs = [urandom(HASHX_LEN) for _ in range(3)]
+    db = db_class('leveldb')('hist', True)
+    with db.write_batch() as batch:
+        for n, hashX in enumerate(hashXs):
+            tx_nums = range(n, 100 * (n + 1), n + 1)
+            if version == 0:
+                row = b''.join(pack_le_uint64(tx_num)[:5] for tx_num in tx_nums)
+            else:
+                row = encode_txnums(tx_nums)
+            batch.put(hashX + pack_be_uint32(1), row)
+        state = {'flush_count': 1, 'db_version': version}
+        batch.put(b'state\0\0\0\0', repr(state).encode())
+    db.close()
+
+    history = open_history(1)
+    assert history.db_version == 2
+    for n, hashX in enumerate(hashXs):
+        tx_nums = list(range(n, 100 * (n + 1), n + 1))
+        assert list(history.get_txnums(hashX, None)) == tx_nums
+        assert history.get_count(hashX) == len(tx_nums)
+    history.close_db()
+
+
+def test_unflushed(db_dir):
+    hashXs = [urandom(HASHX_LEN) for _ in range(3)]
+    history = open_history(0)
+    empty_size = history.unflushed_memsize()
+    # Duplicate hashXs in a tx are recorded once
+    history.add_unflushed([hashXs[:2], [hashXs[1], hashXs[1]], [], hashXs], 10)
+    assert history.unflushed_memsize() > empty_size
+    history.flush()
+    history.assert_flushed()
+    assert [list(history.get_txnums(hashX)) for hashX in hashXs] == [
+        [10, 13], [10, 11, 13], [13]]
+    assert [history.get_count(hashX) for hashX in hashXs] == [2, 3, 1]
+    history.close_db()
+
+
+def test_get_txnum_tail(db_dir):
+    hashX = urandom(HASHX_LEN)
+    history = open_history(0)
+    for tx_num in (3, 8, 20, 21, 40):
+        add_flush(history, [hashX], tx_num)
+    assert list(history.get_txnum_tail(hashX, -1)) == [3, 8, 20, 21, 40]
+    assert list(history.get_txnum_tail(hashX, 3)) == [8, 20, 21, 40]
+    assert list(history.get_txnum_tail(hashX, 20)) == [21, 40]
+    assert list(history.get_txnum_tail(hashX, 30)) == [40]
+    assert list(history.get_txnum_tail(hashX, 40)) == []
+    assert list(history.get_txnum_tail(urandom(HASHX_LEN), 0)) == []
+    history.close_db()
@@ -0,0 +1,423 @@
+# Tests of the shared state of sessions in server/session.py
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiorpcx import (Event, JSONRPCAutoDetect, JSONRPCLoose, JSONRPCv2, NetAddress,
+                     Notification, RPCError, SessionKind)
+
+from electrumx.lib.hash import hash_to_hex_str, sha256
+from electrumx.server.env import Env
+from electrumx.server.mempool import MemPoolTxSummary
+from electrumx.server.session import ElectrumX, SessionManager, scripthash_to_hashX
+
+
+class FakeDB:
+    '''Confirmed histories as lists of (tx_num, tx_hash, height) triples.'''
+
+    def __init__(self):
+        self.histories = {}
+        self.reads = []
+        self.state = SimpleNamespace(height=99)
+
+    async def read_headers(self, start_height, count):
+        self.reads.append(('headers', start_height, count))
+        count = max(0, min(count, self.state.height + 1 - start_height))
+        headers = b''.join(bytes([height % 256]) * 80
+                           for height in range(start_height, start_height + count))
+        return headers, count
+
+    async def header_branch_and_root(self, length, height):
+        self.reads.append(('proof', length, height))
+        return [bytes([height % 256]) * 32], bytes([length % 256]) * 32
+
+    def add_txs(self, hashX, count, height=1):
+        history = self.histories.setdefault(hashX, [])
+        for _ in range(count):
+            tx_num = len(history) + 100
+            history.append((tx_num, bytes([tx_num % 256, len(hashX)]) * 16, height))
+
+    async def history_after(self, hashX, tx_num, *, limit=1000):
+        self.reads.append((hashX, tx_num))
+        # As a read in the client thread pool
+        await asyncio.sleep(0)
+        history = self.histories.get(hashX, [])
+        after = [item for item in history if item[0] > tx_num]
+        return (len(history), [item[0] for item in after],
+                [(tx_hash, height) for _, tx_hash, height in after])
+
+
+class FakeMemPool:
+
+    def __init__(self):
+        self.txs = {}
+
+    async def transaction_summaries(self, hashX):
+        return self.txs.get(hashX, [])
+
+
+def expected_status(db, mempool, hashX):
+    status = ''.join(f'{hash_to_hex_str(tx_hash)}:{height:d}:'
+                     for _, tx_hash, height in db.histories.get(hashX, []))
+    status += ''.join(f'{hash_to_hex_str(tx.hash)}:{-tx.has_unconfirmed_inputs:d}:'
+                      for tx in mempool.txs.get(hashX, []))
+    return sha256(status.encode()).hex() if status else None
+
+
+@pytest.fixture
+def session_mgr(monkeypatch):
+    for name, value in (('COIN', 'Ravencoin'), ('DAEMON_URL', ''),
+                        ('DB_DIRECTORY', '/')):
+        monkeypatch.setenv(name, value)
+    mgr = SessionManager(Env(), FakeDB(), None, None, FakeMemPool(), Event())
+
+    async def refresh_hsub_results(height):
+        mgr.notified_height = height
+
+    mgr._refresh_hsub_results = refresh_hsub_results
+    mgr.notified_height = 10
+    return mgr
+
+
+def notify(mgr, height, touched):
+    empty = set()
+    asyncio.run(mgr._notify_sessions(height, touched, empty, empty, empty, empty,
+                                     empty, empty, empty))
+
+
+def address_status(mgr, hashX):
+    status, _cost, _in_mempool = asyncio.run(mgr.address_status(hashX))
+    return status
+
+
+def test_status_cache(session_mgr):
+    db, mempool = session_mgr.db, session_mgr.mempool
+    hashX, other = bytes(11), bytes([1]) * 11
+    db.add_txs(hashX, 3)
+    db.add_txs(other, 2)
+    assert address_status(session_mgr, hashX) == expected_status(db, mempool, hashX)
+    assert address_status(session_mgr, other) == expected_status(db, mempool, other)
+    assert address_status(session_mgr, bytes([2]) * 11) is None
+    assert len(db.reads) == 3
+
+    # Cached until touched
+    assert address_status(session_mgr, hashX) == expected_status(db, mempool, hashX)
+    assert len(db.reads) == 3
+    db.add_txs(hashX, 1)
+    notify(session_mgr, 10, {hashX})
+    assert address_status(session_mgr, hashX) == expected_status(db, mempool, hashX)
+    assert address_status(session_mgr, other) == expected_status(db, mempool, other)
+    assert len(db.reads) == 4
+
+
+def test_status_cache_mempool(session_mgr):
+    db, mempool = session_mgr.db, session_mgr.mempool
+    hashX, other = bytes(11), bytes([1]) * 11
+    db.add_txs(hashX, 1)
+    db.add_txs(other, 1)
+    mempool.txs[hashX] = [MemPoolTxSummary(bytes([7]) * 32, 1000, True)]
+    assert address_status(session_mgr, hashX) == expected_status(db, mempool, hashX)
+    assert address_status(session_mgr, other) == expected_status(db, mempool, other)
+    assert len(db.reads) == 2
+
+    # A mempool notification leaves untouched statuses cached
+    mempool.txs[hashX] = [MemPoolTxSummary(bytes([7]) * 32, 1000, False)]
+    notify(session_mgr, 10, {bytes([2]) * 11})
+    assert address_status(session_mgr, hashX) != expected_status(db, mempool, hashX)
+    assert len(db.reads) == 2
+
+    # A new block drops the statuses with mempool transactions, whose
+    # unconfirmed inputs may have confirmed
+    notify(session_mgr, 11, set())
+    assert address_status(session_mgr, hashX) == expected_status(db, mempool, hashX)
+    assert address_status(session_mgr, other) == expected_status(db, mempool, other)
+    assert len(db.reads) == 3
+
+
+def test_status_cache_concurrent(session_mgr):
+    db, mempool = session_mgr.db, session_mgr.mempool
+    hashX = bytes(11)
+    db.add_txs(hashX, 2)
+
+    async def statuses():
+        return await asyncio.gather(*(session_mgr.address_status(hashX) for _ in range(5)))
+
+    results = asyncio.run(statuses())
+    assert len(db.reads) == 1
+    assert {status for status, _, _ in results} == {expected_status(db, mempool, hashX)}
+
+    # A status touched whilst being computed is not cached
+    async def touched_during_computation():
+        task = asyncio.ensure_future(session_mgr.address_status(hashX))
+        await asyncio.sleep(0)
+        session_mgr._invalidate_statuses({hashX}, False)
+        return await task
+
+    notify(session_mgr, 10, {hashX})
+    asyncio.run(touched_during_computation())
+    assert hashX not in session_mgr._status_cache
+
+
+def test_retained_status(session_mgr):
+    db, mempool = session_mgr.db, session_mgr.mempool
+    session_mgr.RETAINED_STATUS_MIN_COUNT = 4
+    hashX, short = bytes(11), bytes([1]) * 11
+    db.add_txs(hashX, 5)
+    db.add_txs(short, 3)
+    assert address_status(session_mgr, hashX) == expected_status(db, mempool, hashX)
+    assert address_status(session_mgr, short) == expected_status(db, mempool, short)
+    assert set(session_mgr._retained_statuses) == {hashX}
+
+    # Only the entries from the last one retained are read
+    db.add_txs(hashX, 2)
+    db.add_txs(short, 1)
+    mempool.txs[hashX] = [MemPoolTxSummary(bytes([7]) * 32, 1000, True)]
+    notify(session_mgr, 11, {hashX, short})
+    assert address_status(session_mgr, hashX) == expected_status(db, mempool, hashX)
+    assert address_status(session_mgr, short) == expected_status(db, mempool, short)
+    assert db.reads[2:] == [(hashX, 103), (short, -1)]
+    assert set(session_mgr._retained_statuses) == {hashX, short}
+
+
+def test_retained_status_reorg(session_mgr):
+    db, mempool = session_mgr.db, session_mgr.mempool
+    session_mgr.RETAINED_STATUS_MIN_COUNT = 4
+    hashX = bytes(11)
+    db.add_txs(hashX, 5)
+    address_status(session_mgr, hashX)
+
+    # The last retained entry was replaced by a reorg not yet signalled
+    db.histories[hashX][-1] = (104, bytes([9]) * 32, 2)
+    notify(session_mgr, 11, {hashX})
+    assert address_status(session_mgr, hashX) == expected_status(db, mempool, hashX)
+    assert db.reads[1:] == [(hashX, 103), (hashX, -1)]
+    assert session_mgr._retained_statuses[hashX].tx_hash == bytes([9]) * 32
+
+    # A reorg signalled during a full read retains nothing
+    del db.histories[hashX][-2:]
+    db.add_txs(hashX, 2, height=3)
+    session_mgr._retained_statuses.clear()
+
+    async def reorg_during_computation():
+        task = asyncio.ensure_future(session_mgr.address_status(hashX))
+        await asyncio.sleep(0)
+        session_mgr._reorg_count += 1
+        session_mgr._retained_statuses.clear()
+        return await task
+
+    notify(session_mgr, 12, {hashX})
+    status, _cost, _in_mempool = asyncio.run(reorg_during_computation())
+    assert status == expected_status(db, mempool, hashX)
+    assert hashX not in session_mgr._retained_statuses
+
+    # The status after the reorg is rebuilt in full
+    notify(session_mgr, 13, {hashX})
+    del db.reads[:]
+    assert address_status(session_mgr, hashX) == expected_status(db, mempool, hashX)
+    assert db.reads == [(hashX, -1)]
+    assert session_mgr._retained_statuses[hashX].tx_num == 104
+
+
+class Transport:
+    '''Records the messages a session sends.'''
+
+    kind = SessionKind.SERVER
+
+    def __init__(self):
+        self.messages = []
+
+    async def write(self, message):
+        self.messages.append(message)
+
+    def remote_address(self):
+        return NetAddress('1.2.3.4', 50001)
+
+    def is_closing(self):
+        return False
+
+    def proxy(self):
+        return None
+
+
+def new_session(mgr):
+    session = ElectrumX(mgr, mgr.db, mgr.mempool, mgr.peer_mgr, 'TCP', Transport())
+
+    async def asset_status(asset):
+        return None
+
+    session.asset_status = asset_status
+    return session
+
+
+def test_subscription_index(session_mgr):
+    scripthash = '11' * 32
+    hashX = scripthash_to_hashX(scripthash)
+    subscribers = session_mgr._subscribers
+
+    async def run():
+        sessions = [new_session(session_mgr) for _ in range(3)]
+        for session in sessions:
+            await session.scripthash_subscribe(scripthash)
+        await sessions[0].asset_subscribe('RVN_ASSET')
+        assert subscribers['hashX'] == {hashX: set(sessions)}
+        assert subscribers['asset'] == {'RVN_ASSET': {sessions[0]}}
+        touched = (('hashX', {hashX}), ('asset', set()))
+        assert session_mgr._touched_subscribers(touched) == set(sessions)
+
+        # Unsubscribing
+        assert await sessions[1].scripthash_unsubscribe(scripthash)
+        assert subscribers['hashX'] == {hashX: {sessions[0], sessions[2]}}
+        await sessions[0].asset_unsubscribe('RVN_ASSET')
+        assert subscribers['asset'] == {}
+        assert session_mgr._touched_subscribers(touched) == {sessions[0], sessions[2]}
+
+        # Disconnecting
+        await sessions[0].connection_lost()
+        assert subscribers['hashX'] == {hashX: {sessions[2]}}
+        await sessions[2].asset_subscribe('RVN_ASSET')
+        await sessions[2].connection_lost()
+        assert all(not keys for keys in subscribers.values())
+
+        # A subscription completing after its session disconnected
+        await sessions[2].scripthash_subscribe(scripthash)
+        assert subscribers['hashX'] == {}
+
+    asyncio.run(run())
+
+
+def test_shared_notification(session_mgr):
+    db, mempool = session_mgr.db, session_mgr.mempool
+    scripthash = '11' * 32
+    hashX = scripthash_to_hashX(scripthash)
+    db.add_txs(hashX, 1)
+
+    async def run():
+        sessions = [new_session(session_mgr) for _ in range(4)]
+        # The protocol is detected from the first message received
+        for session, message in zip(sessions, (
+                b'{"jsonrpc": "2.0", "method": "server.ping", "id": 0}',
+                b'{"jsonrpc": "2.0", "method": "server.ping", "id": 1}',
+                b'{"method": "server.ping", "id": 2}')):
+            session.connection.receive_message(message)
+        for session in sessions:
+            await session.scripthash_subscribe(scripthash)
+
+        db.add_txs(hashX, 1)
+        await session_mgr._notify_sessions(10, {hashX}, *[set()] * 7)
+        return sessions
+
+    sessions = asyncio.run(run())
+    notification = Notification('blockchain.scripthash.subscribe',
+                                (scripthash, expected_status(db, mempool, hashX)))
+    for session, protocol in zip(sessions, (JSONRPCv2, JSONRPCv2, JSONRPCLoose,
+                                            JSONRPCAutoDetect)):
+        assert session.transport.messages == [protocol.notification_message(notification)]
+    # Sessions with the same protocol share the encoded message
+    assert sessions[0].transport.messages[0] is sessions[1].transport.messages[0]
+
+
+def test_merkle_batch_protocol(session_mgr):
+    async def run():
+        session = new_session(session_mgr)
+        session.set_request_handlers((1, 11))
+        assert 'blockchain.transaction.get_merkle_batch' not in session.request_handlers
+        session.set_request_handlers(ElectrumX.PROTOCOL_MAX)
+        assert 'blockchain.transaction.get_merkle_batch' in session.request_handlers
+
+    asyncio.run(run())
+
+
+def test_headers_hex(session_mgr):
+    db = session_mgr.db
+    session_mgr.env.reorg_limit = 10
+
+    def headers_hex(start_height, count):
+        return asyncio.run(session_mgr.headers_hex(start_height, count, 10))
+
+    # The chunk ending at the reorg limit is cached, the next is not
+    chunk = b''.join(bytes([height]) * 80 for height in range(80, 90)).hex()
+    assert headers_hex(80, 10) == (chunk, 10, False)
+    assert headers_hex(80, 10) == (chunk, 10, True)
+    assert headers_hex(90, 10)[1:] == (10, False)
+    assert headers_hex(90, 10)[1:] == (10, False)
+    assert len(db.reads) == 3
+    del db.reads[:]
+
+    # Neither are partial or unaligned chunks
+    assert headers_hex(80, 5) == (chunk[:800], 5, False)
+    assert headers_hex(81, 10) == (chunk[160:] + (bytes([90]) * 80).hex(), 10, False)
+    assert headers_hex(81, 10) == (chunk[160:] + (bytes([90]) * 80).hex(), 10, False)
+    assert headers_hex(95, 10)[1:] == (5, False)
+    assert len(db.reads) == 4
+    del db.reads[:]
+
+    # Chunks become cacheable as the chain grows
+    db.state.height = 109
+    assert headers_hex(90, 10)[1:] == (10, False)
+    assert headers_hex(90, 10)[1:] == (10, True)
+    assert len(db.reads) == 1
+
+
+def test_header_merkle_proof(session_mgr):
+    db = session_mgr.db
+    session_mgr.env.reorg_limit = 10
+
+    def header_merkle_proof(cp_height, height):
+        return asyncio.run(session_mgr.header_merkle_proof(cp_height, height))
+
+    proof = {'branch': [hash_to_hex_str(bytes([5]) * 32)],
+             'root': hash_to_hex_str(bytes([90]) * 32)}
+    assert header_merkle_proof(89, 5) == proof
+    assert header_merkle_proof(89, 5) == proof
+    assert header_merkle_proof(90, 5)['root'] == hash_to_hex_str(bytes([91]) * 32)
+    assert header_merkle_proof(90, 5)['root'] == hash_to_hex_str(bytes([91]) * 32)
+    assert db.reads == [('proof', 90, 5), ('proof', 91, 5), ('proof', 91, 5)]
+
+    for cp_height, height in ((89, 90), (100, 5)):
+        with pytest.raises(RPCError):
+            header_merkle_proof(cp_height, height)
+
+
+def test_header_cache_reorg(session_mgr):
+    db = session_mgr.db
+    session_mgr.env.reorg_limit = 10
+    session_mgr.bp = SimpleNamespace(backed_up_event=Event())
+
+    async def run():
+        await session_mgr.headers_hex(0, 10, 10)
+        await session_mgr.header_merkle_proof(20, 10)
+        assert len(session_mgr._header_chunks) == 1
+        assert len(session_mgr._header_cache) == 1
+        task = asyncio.ensure_future(session_mgr._handle_chain_reorgs())
+        await asyncio.sleep(0)
+        # As the block processor signals a block backed up
+        session_mgr.bp.backed_up_event.set()
+        session_mgr.bp.backed_up_event.clear()
+        await asyncio.sleep(0)
+        task.cancel()
+        # Immutable chunks are kept; proofs are dropped
+        assert len(session_mgr._header_chunks) == 1
+        assert len(session_mgr._header_cache) == 0
+        assert (await session_mgr.headers_hex(0, 10, 10))[2]
+        await session_mgr.header_merkle_proof(20, 10)
+
+    asyncio.run(run())
+    assert len(db.reads) == 3
+
+
+def test_header_chunks_not_evicted(session_mgr):
+    db = session_mgr.db
+    session_mgr.env.reorg_limit = 10
+    # Far more chunks than the LRU bound of the proofs would hold
+    session_mgr._header_cache.max_size = 1000
+
+    async def run():
+        for start_height in range(0, 90, 10):
+            await session_mgr.headers_hex(start_height, 10, 10)
+        return [(await session_mgr.headers_hex(start_height, 10, 10))[2]
+                for start_height in range(0, 90, 10)]
+
+    assert asyncio.run(run()) == [True] * 9
+    assert len(db.reads) == 9
+    assert session_mgr._header_chunks_size == 9 * 10 * 160
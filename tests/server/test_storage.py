@@ -1,9 +1,12 @@
 import os
+import threading
 
 import pytest
 
 from electrumx.lib.util import subclasses
-from electrumx.server.storage import Storage, db_class
+from electrumx.server.storage import (
+    ColumnFamily, RocksDB, Storage, StorageStats, db_class, rocksdb_iterator,
+)
 
 # Find out which db engines to test
 # Those that are not installed will be skipped
@@ -74,3 +77,242 @@ def test_close(db):
     db.close()
     db = db_class(db.__class__.__name__)("db", False)
     assert db.get(b"a") == b"b"
+
+
+def test_batch_nosync(db):
+    with db.write_batch(sync=False) as b:
+        b.put(b"a", b"1")
+        b.put(b"b", b"2")
+        b.delete(b"a")
+    assert db.get(b"a") is None
+    assert db.get(b"b") == b"2"
+
+
+def test_snapshot(db):
+    db.put(b"a", b"1")
+    db.put(b"ab", b"2")
+    with db.snapshot() as snapshot:
+        db.put(b"a", b"3")
+        db.put(b"ac", b"4")
+        assert snapshot.get(b"a") == b"1"
+        assert snapshot.get(b"ac") is None
+        assert list(snapshot.iterator(prefix=b"a")) == [(b"a", b"1"), (b"ab", b"2")]
+    assert db.get(b"a") == b"3"
+
+
+def test_iterator_bounds(db):
+    for i in range(5):
+        db.put(b"abc" + str.encode(str(i)), str.encode(str(i)))
+    db.put(b"abd", b"x")
+    assert list(db.iterator(prefix=b"abc", start=b"abc1", stop=b"abc4")) == [
+        (b"abc1", b"1"), (b"abc2", b"2"), (b"abc3", b"3")]
+    assert list(db.iterator(prefix=b"abc", stop=b"abc2", reverse=True)) == [
+        (b"abc1", b"1"), (b"abc0", b"0")]
+    assert list(db.iterator(start=b"abc3")) == [
+        (b"abc3", b"3"), (b"abc4", b"4"), (b"abd", b"x")]
+
+
+def test_iterator_keys_only(db):
+    db.put(b"a1", b"x")
+    db.put(b"a2", b"y")
+    db.put(b"b", b"z")
+    assert list(db.iterator(prefix=b"a", include_value=False,
+                            fill_cache=False)) == [b"a1", b"a2"]
+    assert list(db.iterator(include_value=False, reverse=True)) == [
+        b"b", b"a2", b"a1"]
+
+
+def test_multi_get(db):
+    db.put(b"a", b"1")
+    db.put(b"c", b"3")
+    assert db.multi_get([b"c", b"b", b"a"]) == [b"3", None, b"1"]
+    assert db.multi_get([]) == []
+
+
+def test_delete_range(db):
+    for key in (b"a", b"b1", b"b2", b"b3", b"c"):
+        db.put(key, b"")
+    assert db.delete_range(b"b1", b"b3") == 2
+    assert list(db.iterator(include_value=False)) == [b"a", b"b3", b"c"]
+
+
+def test_column_families(db):
+    families = {
+        b"h": ColumnFamily("h", prefix_len=3),
+        b"u": ColumnFamily("u", block_size=65536),
+        b"U": ColumnFamily("undo", low_priority=True),
+        b"V": ColumnFamily("undo", low_priority=True),
+    }
+    db.close()
+    db = db_class(db.__class__.__name__)("families", False, families)
+    with db.write_batch() as b:
+        for key in (b"U1", b"V1", b"a", b"h12", b"h13", b"u1", b"u2"):
+            b.put(key, key)
+    assert db.get(b"h12") == b"h12"
+    assert db.multi_get([b"u2", b"V1", b"x"]) == [b"u2", b"V1", None]
+    assert list(db.iterator(prefix=b"u")) == [(b"u1", b"u1"), (b"u2", b"u2")]
+    assert list(db.iterator(include_value=False)) == [
+        b"U1", b"V1", b"a", b"h12", b"h13", b"u1", b"u2"]
+    assert list(db.iterator(start=b"V", stop=b"h13", reverse=True,
+                            include_value=False)) == [b"h12", b"a", b"V1"]
+    db.close()
+    db = db_class(db.__class__.__name__)("families", False, families)
+    assert db.get(b"U1") == b"U1"
+    db.close()
+
+
+def test_rocksdb_total_order_seek():
+    # A stand-in for a python-rocksdb DB, recording the read options of
+    # each family's iterator
+    class FakeRocksDB:
+        def __init__(self):
+            self.read_options = {}
+
+        def iterkeys(self, family=None, **read_options):
+            self.read_options[family] = read_options
+            return FakeIterator()
+
+    class FakeIterator:
+        def seek(self, key):
+            pass
+
+        def seek_to_first(self):
+            pass
+
+        def __next__(self):
+            raise StopIteration
+
+    handles = {ord("h"): "h", ord("u"): "u"}
+    prefix_lens = {ord("h"): 9}
+
+    def read_options(prefix=b"", **kwargs):
+        db = FakeRocksDB()
+        list(rocksdb_iterator(db, handles, prefix_lens, prefix, False, None, None, False,
+                              **kwargs))
+        return db.read_options
+
+    # Scans within one extracted prefix use it; others seek in total order
+    assert read_options(b"h" + bytes(8), fill_cache=False) == {"h": {"fill_cache": False}}
+    assert read_options(b"h") == {"h": {"total_order_seek": True}}
+    assert read_options(b"u") == {"u": {}}
+    assert read_options() == {None: {}, "h": {"total_order_seek": True}, "u": {}}
+
+
+def test_instrument(db):
+    stats = StorageStats()
+    db.instrument("utxo", stats)
+    with db.write_batch() as b:
+        b.put(b"u1", b"abc")
+        b.put(b"u2", b"de")
+        b.delete(b"h1")
+    assert db.get(b"u1") == b"abc"
+    assert db.multi_get([b"u1", b"u2"]) == [b"abc", b"de"]
+    assert list(db.iterator(prefix=b"u", include_value=False)) == [b"u1", b"u2"]
+    with db.snapshot() as snapshot:
+        assert list(snapshot.iterator(prefix=b"u")) == [(b"u1", b"abc"), (b"u2", b"de")]
+
+    rows = {(name, op, prefix): (ops, keys, nbytes)
+            for name, op, prefix, ops, keys, nbytes, _p50, _p99 in stats.rpc_data()}
+    assert rows[("utxo", "write", "u")] == (1, 2, 9)
+    assert rows[("utxo", "write", "h")] == (1, 1, 2)
+    assert rows[("utxo", "get", "u")] == (2, 3, 8)
+    assert rows[("utxo", "scan", "u")] == (2, 4, 13)
+    assert rows[("utxo", "commit", "")][:2] == (1, 3)
+    assert stats.summary()["utxo"]["reads"] == 7
+    assert stats.summary()["utxo"]["writes"] == 3
+
+
+def test_instrument_multi_get(db):
+    stats = StorageStats()
+    db.instrument("utxo", stats)
+    with db.write_batch() as b:
+        b.put(b"u1", b"abc")
+        b.put(b"h1", b"de")
+    assert db.multi_get([b"h1", b"u1", b"u2"]) == [b"de", b"abc", None]
+    rows = {(name, op, prefix): (ops, keys, nbytes)
+            for name, op, prefix, ops, keys, nbytes, _p50, _p99 in stats.rpc_data()}
+    # Each key is counted under its own prefix
+    assert rows[("utxo", "get", "h")] == (1, 1, 2)
+    assert rows[("utxo", "get", "u")] == (1, 2, 3)
+    assert stats.thread_bytes.nbytes == 5
+
+
+def test_instrument_thread_bytes(db):
+    stats = StorageStats()
+    db.instrument("utxo", stats)
+    db.put(b"u1", b"abc")
+    with db.snapshot() as snapshot:
+        assert snapshot.get(b"u1") == b"abc"
+    assert db.get(b"u1") == b"abc"
+    assert db.get(b"u2") is None
+
+    # Snapshots share the database's counters
+    rows = {(name, op, prefix): (ops, keys, nbytes)
+            for name, op, prefix, ops, keys, nbytes, _p50, _p99 in stats.rpc_data()}
+    assert rows[("utxo", "get", "u")] == (3, 3, 6)
+    assert stats.thread_bytes.nbytes == 6
+
+    # Each thread counts its own reads
+    nbytes = []
+    thread = threading.Thread(
+        target=lambda: nbytes.append((db.get(b"u1"), stats.thread_bytes.nbytes)))
+    thread.start()
+    thread.join()
+    assert nbytes == [(b"abc", 3)]
+    assert stats.thread_bytes.nbytes == 6
+
+
+def test_rocksdb_prefix_family(tmpdir):
+    # Against a real python-rocksdb build
+    pytest.importorskip("rocksdb")
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    families = {b"h": ColumnFamily("h", prefix_len=5),
+                b"u": ColumnFamily("u", block_size=65536)}
+    keys = sorted(b"h" + bytes([n, n * 7 % 256, 0, 1]) + bytes([m])
+                  for n in range(0, 256, 5) for m in range(3)) + [b"u1"]
+    try:
+        db = db_class("rocksdb")("families", False, families)
+        with db.write_batch() as b:
+            for key in keys:
+                b.put(key, key[-1:])
+        # Reopening flushes the keys to table files, which have the filters
+        db.close()
+        db = db_class("rocksdb")("families", False, families)
+        # Lookups by the extracted prefix, including misses
+        assert list(db.iterator(prefix=keys[3][:5], include_value=False)) == keys[3:6]
+        assert list(db.iterator(prefix=b"h" + bytes(3) + b"\2")) == []
+        # Scans crossing extracted prefixes see every key
+        assert list(db.iterator(include_value=False)) == keys
+        assert list(db.iterator(prefix=b"h", include_value=False)) == keys[:-1]
+        assert list(db.iterator(prefix=b"h", reverse=True, include_value=False)) == (
+            keys[-2::-1])
+        assert db.delete_range(b"h", b"i") == len(keys) - 1
+        assert list(db.iterator(include_value=False)) == [b"u1"]
+        db.close()
+    finally:
+        os.chdir(cwd)
+
+
+def test_rocksdb_total_order_seek_probe(monkeypatch):
+    # A stand-in for a python-rocksdb module whose iterators reject read
+    # options they do not know, as python-rocksdb 0.7.0 does
+    def fake_module(read_options):
+        class DB:
+            def __init__(self, name, options):
+                pass
+
+            def iterkeys(self, **kwargs):
+                if set(kwargs) - read_options:
+                    raise TypeError("unexpected keyword argument")
+                return iter(())
+
+        return type("rocksdb", (), {"DB": DB, "Options": dict})
+
+    monkeypatch.setattr(RocksDB, "module", fake_module({"fill_cache"}), raising=False)
+    monkeypatch.setattr(RocksDB, "total_order_seek", None)
+    assert RocksDB.supports_total_order_seek() is False
+    monkeypatch.setattr(RocksDB, "module", fake_module({"total_order_seek"}))
+    assert RocksDB.supports_total_order_seek() is False    # Probed once
+    monkeypatch.setattr(RocksDB, "total_order_seek", None)
+    assert RocksDB.supports_total_order_seek() is True
@@ -0,0 +1,55 @@
+# Tests of the electrumx_convert_db script
+
+import os
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+
+import pytest
+
+from electrumx.server.db import DB_FAMILIES
+from electrumx.server.storage import db_class
+
+# The script has no .py suffix
+loader = SourceFileLoader(
+    'electrumx_convert_db',
+    os.path.join(os.path.dirname(__file__), os.pardir, 'electrumx_convert_db'))
+convert_db = module_from_spec(spec_from_loader(loader.name, loader))
+loader.exec_module(convert_db)
+
+
+@pytest.fixture
+def db_dir(tmpdir, monkeypatch):
+    for name, value in (('COIN', 'Ravencoin'), ('DAEMON_URL', ''),
+                        ('DB_DIRECTORY', str(tmpdir)), ('DB_ENGINE', 'leveldb')):
+        monkeypatch.setenv(name, value)
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    yield str(tmpdir)
+    os.chdir(cwd)
+
+
+def test_convert_leveldb_to_lmdb(db_dir, monkeypatch):
+    # More than a batch, in every column family of the UTXO DB
+    monkeypatch.setattr(convert_db, 'BATCH_SIZE', 100)
+    contents = {}
+    for name in convert_db.DB_NAMES:
+        db = db_class('leveldb')(name, True, DB_FAMILIES[name])
+        items = contents[name] = sorted(
+            (prefix + os.urandom(12), os.urandom(n % 40))
+            for n in range(250) for prefix in (b'h', b'u', b'U', b'x'))
+        with db.write_batch() as batch:
+            for key, value in items:
+                batch.put(key, value)
+        db.close()
+
+    convert_db.convert_dbs('lmdb')
+    for name in convert_db.DB_NAMES:
+        assert os.path.exists(f'{name}.leveldb')
+        db = db_class('lmdb')(name, False, DB_FAMILIES[name])
+        assert list(db.iterator()) == contents[name]
+        db.close()
+
+    # Converting again is refused, as the databases already use the engine
+    monkeypatch.setenv('DB_ENGINE', 'lmdb')
+    with pytest.raises(RuntimeError):
+        convert_db.convert_dbs('lmdb')